@@ -0,0 +1,459 @@
+import base64
+import io
+import multiprocessing
+import os
+import queue
+import re
+import threading
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from functools import lru_cache
+
+from lxml import etree
+
+import db_utils
+
+# Documenti accumulati prima di ogni inserimento in blocco
+BLOCCO_IMPORT = 500
+
+# Pipeline di importazione: processi del parser (0 = uno per core), file per
+# compito inviato al pool, compiti in volo per processo e blocchi di risultati
+# in attesa dello scrittore (limiti che danno la back-pressure)
+PROCESSI_IMPORT = int(os.getenv("APPFATT_IMPORT_PROCESSI", "0"))
+FILE_PER_COMPITO = 25
+COMPITI_PER_PROCESSO = 2
+CODA_SCRITTURA = 8
+
+
+def _nome_locale(tag) -> str:
+    return tag.rpartition("}")[2] if isinstance(tag, str) else ""
+
+
+@lru_cache(maxsize=None)
+def _percorso(percorso: str) -> str:
+    return "/".join(f"{{*}}{p}" for p in percorso.split("/"))
+
+
+def _testo(el, percorso: str) -> str:
+    """findtext che ignora il namespace (alcuni produttori lo mettono su ogni elemento)."""
+    return (el.findtext(_percorso(percorso)) or "").strip()
+
+
+def _importo(testo: str) -> float:
+    return float(testo) if testo else 0.0
+
+
+def _id_fiscale(val: str) -> str:
+    """P.IVA/CF confrontabili: maiuscolo, senza prefisso paese IT sulle partite IVA."""
+    val = (val or "").strip().upper()
+    if val.startswith("IT") and val[2:].isdigit() and len(val) == 13:
+        return val[2:]
+    return val
+
+
+# ==========================
+# PARSING FATTURAPA
+# ==========================
+def _anagrafica(el) -> dict:
+    """Dati di CedentePrestatore / CessionarioCommittente nel formato della rubrica."""
+    denominazione = _testo(el, "DatiAnagrafici/Anagrafica/Denominazione")
+    if not denominazione:
+        denominazione = " ".join(
+            filter(None, [
+                _testo(el, "DatiAnagrafici/Anagrafica/Nome"),
+                _testo(el, "DatiAnagrafici/Anagrafica/Cognome"),
+            ])
+        )
+    return {
+        "Denominazione": denominazione,
+        "PIVA": _testo(el, "DatiAnagrafici/IdFiscaleIVA/IdCodice"),
+        "CF": _testo(el, "DatiAnagrafici/CodiceFiscale"),
+        "Indirizzo": _testo(el, "Sede/Indirizzo"),
+        "CAP": _testo(el, "Sede/CAP"),
+        "Comune": _testo(el, "Sede/Comune"),
+        "Provincia": _testo(el, "Sede/Provincia"),
+    }
+
+
+def _libera(el) -> None:
+    """Scarta l'elemento già elaborato e i fratelli precedenti: memoria costante."""
+    el.clear()
+    parent = el.getparent()
+    if parent is not None:
+        while el.getprevious() is not None:
+            del parent[0]
+
+
+def leggi_fattura(sorgente):
+    """
+    Legge un file FatturaPA in modo incrementale (iterparse sugli eventi "end")
+    e genera un dizionario per ogni FatturaElettronicaBody (un file può
+    contenere un lotto di fatture). Ogni dizionario contiene cedente,
+    cessionario, i dati generali, le righe e i totali del riepilogo.
+    Un XML che non è una FatturaPA (es. file di metadati) non genera nulla.
+    """
+    testata = {}
+    corpo = None
+    for _, el in etree.iterparse(
+        sorgente, events=("end",), no_network=True, resolve_entities=False, huge_tree=True,
+    ):
+        nome = _nome_locale(el.tag)
+        if nome == "CedentePrestatore":
+            testata["cedente"] = _anagrafica(el)
+        elif nome == "CessionarioCommittente":
+            testata["cessionario"] = _anagrafica(el)
+        elif nome == "CodiceDestinatario":
+            testata["codice_destinatario"] = (el.text or "").strip()
+        elif nome == "DatiGeneraliDocumento":
+            corpo = {
+                "TipoXML": _testo(el, "TipoDocumento") or "TD01",
+                "Data": _testo(el, "Data"),
+                "Numero": _testo(el, "Numero"),
+                "totale": _testo(el, "ImportoTotaleDocumento"),
+                "righe": [],
+                "riepilogo": [],
+                "imponibile": 0.0,
+                "imposta": 0.0,
+            }
+        elif nome == "DettaglioLinee" and corpo is not None:
+            corpo["righe"].append({
+                "desc": _testo(el, "Descrizione"),
+                "qta": _importo(_testo(el, "Quantita")) or 1.0,
+                "prezzo": _importo(_testo(el, "PrezzoUnitario")),
+                "iva": _importo(_testo(el, "AliquotaIVA")),
+                "natura": _testo(el, "Natura"),
+            })
+        elif nome == "DatiRiepilogo" and corpo is not None:
+            voce = {
+                "aliquota": _importo(_testo(el, "AliquotaIVA")),
+                "natura": _testo(el, "Natura"),
+                "imponibile": _importo(_testo(el, "ImponibileImporto")),
+                "imposta": _importo(_testo(el, "Imposta")),
+            }
+            corpo["riepilogo"].append(voce)
+            corpo["imponibile"] += voce["imponibile"]
+            corpo["imposta"] += voce["imposta"]
+        elif nome == "FatturaElettronicaBody" and corpo is not None:
+            yield {**testata, **corpo}
+            corpo = None
+        else:
+            continue
+        _libera(el)
+
+
+def _documento(fattura: dict, ids_emittente: set) -> tuple:
+    """(documento per db_utils, righe, riepilogo IVA, contatto per la rubrica)."""
+    cedente = fattura.get("cedente", {})
+    cessionario = fattura.get("cessionario", {})
+    emessa = bool(ids_emittente & {_id_fiscale(cedente.get("PIVA")), _id_fiscale(cedente.get("CF"))} - {""})
+    controparte = dict(cessionario if emessa else cedente)
+    controparte["CodiceDestinatario"] = fattura.get("codice_destinatario", "") if emessa else ""
+
+    imponibile = round(fattura["imponibile"], 2)
+    iva = round(fattura["imposta"], 2)
+    importo = _importo(fattura["totale"]) if fattura["totale"] else round(imponibile + iva, 2)
+    doc = {
+        "Tipo": "Emessa" if emessa else db_utils.TIPO_RICEVUTA,
+        "Numero": fattura["Numero"],
+        "Data": date.fromisoformat(fattura["Data"]),
+        "Controparte": controparte.get("Denominazione", ""),
+        "Imponibile": imponibile,
+        "IVA": iva,
+        "Importo": importo,
+        "TipoXML": fattura["TipoXML"],
+        "Stato": "Inviato" if emessa else "Ricevuto",
+        "UUID": "",
+        "PDF": "",
+        # i documenti propri hanno emittente "" come quelli creati nell'app
+        "Emittente": "" if emessa else _id_fiscale(cedente.get("PIVA") or cedente.get("CF")),
+    }
+    contatto = {**controparte, "Tipo": "Cliente" if emessa else "Fornitore"}
+    return doc, fattura["righe"], fattura["riepilogo"], contatto
+
+
+# ==========================
+# BUSTE FIRMATE (.p7m)
+# ==========================
+# OID id-signedData (1.2.840.113549.1.7.2), contenuto DER
+_OID_SIGNED_DATA = bytes.fromhex("2a864886f70d010702")
+_RE_PEM = re.compile(rb"-----(BEGIN|END)[^-]*-----")
+
+
+def _tlv(dati: bytes, pos: int) -> tuple:
+    """(tag, inizio contenuto, fine contenuto, fine elemento) di un elemento BER, anche a lunghezza indefinita."""
+    tag = dati[pos]
+    pos += 1
+    if tag & 0x1F == 0x1F:
+        while dati[pos] & 0x80:
+            pos += 1
+        pos += 1
+    lunghezza = dati[pos]
+    pos += 1
+    if lunghezza == 0x80:
+        fine = pos
+        while dati[fine:fine + 2] != b"\x00\x00":
+            fine = _tlv(dati, fine)[3]
+        return tag, pos, fine, fine + 2
+    if lunghezza & 0x80:
+        n = lunghezza & 0x7F
+        lunghezza = int.from_bytes(dati[pos:pos + n], "big")
+        pos += n
+    if pos + lunghezza > len(dati):
+        raise ValueError("busta .p7m troncata")
+    return tag, pos, pos + lunghezza, pos + lunghezza
+
+
+def _figli(dati: bytes, elemento: tuple) -> list:
+    _, pos, fine, _ = elemento
+    figli = []
+    while pos < fine:
+        figli.append(_tlv(dati, pos))
+        pos = figli[-1][3]
+    return figli
+
+
+def _ottetti(dati: bytes, elemento: tuple) -> bytes:
+    """Contenuto di un OCTET STRING, primitivo o spezzato in segmenti (BER)."""
+    tag, inizio, fine, _ = elemento
+    if tag == 0x04:
+        return dati[inizio:fine]
+    if tag == 0x24:
+        return b"".join(_ottetti(dati, figlio) for figlio in _figli(dati, elemento))
+    raise ValueError("busta .p7m senza contenuto")
+
+
+def _binario_p7m(dati: bytes) -> bytes:
+    """Busta in DER/BER così com'è; le varianti base64 (anche PEM) vengono decodificate."""
+    if dati[:1] == b"\x30":
+        return dati
+    try:
+        return base64.b64decode(b"".join(_RE_PEM.sub(b"", dati).split()), validate=True)
+    except ValueError:
+        raise ValueError("busta .p7m non riconosciuta") from None
+
+
+def estrai_p7m(dati: bytes) -> bytes:
+    """
+    Estrae in memoria il documento firmato da una busta CAdES/PKCS#7
+    (.p7m in DER, BER o base64), senza file temporanei né openssl.
+    Le buste annidate (firme multiple) vengono aperte fino al contenuto.
+    La firma non viene verificata.
+    """
+    contenuto = dati
+    while True:
+        busta = _binario_p7m(contenuto)
+        try:
+            info = _figli(busta, _tlv(busta, 0))
+            tipo, firmato = info[0], _figli(busta, info[1])[0]
+            if busta[tipo[1]:tipo[2]] != _OID_SIGNED_DATA:
+                raise ValueError("la busta .p7m non è di tipo SignedData")
+            # SignedData: version, digestAlgorithms, encapContentInfo, ...
+            incapsulato = _figli(busta, _figli(busta, firmato)[2])
+            if len(incapsulato) < 2:
+                raise ValueError("busta .p7m senza contenuto (firma detached)")
+            contenuto = _ottetti(busta, _figli(busta, incapsulato[1])[0])
+        except IndexError:
+            raise ValueError("busta .p7m troncata o non valida") from None
+        if contenuto.lstrip()[:1] == b"<" or contenuto[:3] == b"\xef\xbb\xbf":
+            return contenuto
+
+
+# ==========================
+# PACCHETTO ZIP
+# ==========================
+def _membri(zf: zipfile.ZipFile, prefisso: str = ""):
+    """(nome, file aperto) per ogni file del pacchetto, ZIP annidati compresi, senza estrarre su disco."""
+    for info in zf.infolist():
+        if info.is_dir():
+            continue
+        nome = prefisso + info.filename
+        if info.filename.lower().endswith(".zip"):
+            with zf.open(info) as f, zipfile.ZipFile(f) as annidato:
+                yield from _membri(annidato, nome + "/")
+        else:
+            with zf.open(info) as f:
+                yield nome, f
+
+
+def _conta_membri(zf: zipfile.ZipFile) -> int:
+    return sum(1 for info in zf.infolist() if not info.is_dir())
+
+
+def _radice(nome: str) -> str:
+    """Nome comune a una fattura e al suo file di metadati (IT..._00001.xml.p7m / IT..._00001_metaDato.xml)."""
+    base = nome.rpartition("/")[2].lower()
+    for suffisso in (".p7m", ".xml", "_metadato"):
+        base = base.removesuffix(suffisso)
+    return base
+
+
+def _compiti(zf: zipfile.ZipFile):
+    """
+    Lettore: blocchi di circa FILE_PER_COMPITO (nome, contenuto); si leggono
+    solo XML e .p7m. Un blocco non separa una fattura dal suo file di metadati.
+    """
+    compito = []
+    for nome, f in _membri(zf):
+        if len(compito) >= FILE_PER_COMPITO and _radice(nome) != _radice(compito[-1][0]):
+            yield compito
+            compito = []
+        leggibile = nome.lower().endswith((".xml", ".p7m"))
+        compito.append((nome, f.read() if leggibile else b""))
+    if compito:
+        yield compito
+
+
+def _analizza_file(nome: str, dati: bytes, ids_emittente: set) -> tuple:
+    """(nome, documenti, errore, ignorato) per un file del pacchetto."""
+    minuscolo = nome.lower()
+    try:
+        if minuscolo.endswith(".p7m"):
+            dati = estrai_p7m(dati)
+        elif not minuscolo.endswith(".xml"):
+            return nome, [], None, True
+        fatture = [_documento(fatt, ids_emittente) for fatt in leggi_fattura(io.BytesIO(dati))]
+        return nome, fatture, None, not fatture
+    except (etree.XMLSyntaxError, ValueError, KeyError) as e:
+        return nome, [], f"{type(e).__name__}: {e}", False
+
+
+def _analizza_metadati(nome: str, dati: bytes, id_sdi: dict) -> tuple:
+    """File di metadati SdI: registra in id_sdi radice della fattura -> IdentificativoSdI."""
+    try:
+        radice = etree.fromstring(dati, etree.XMLParser(no_network=True, resolve_entities=False))
+    except etree.XMLSyntaxError as e:
+        return nome, [], f"{type(e).__name__}: {e}", False
+    identificativo = _testo(radice, "IdentificativoSdI")
+    if identificativo:
+        id_sdi[_radice(_testo(radice, "NomeFile") or nome)] = identificativo
+    return nome, [], None, True
+
+
+def _analizza_compito(compito: list, ids_emittente: set) -> list:
+    """
+    Parser: eseguito nei processi del pool. Le fatture ricevono l'IdentificativoSdI
+    del proprio file di metadati (non per i lotti: l'identificativo è del file).
+    """
+    risultati, id_sdi = [], {}
+    for nome, dati in compito:
+        if nome.lower().endswith("_metadato.xml"):
+            risultati.append(_analizza_metadati(nome, dati, id_sdi))
+        else:
+            risultati.append(_analizza_file(nome, dati, ids_emittente))
+    for nome, fatture, _, _ in risultati:
+        if len(fatture) == 1 and _radice(nome) in id_sdi:
+            fatture[0][0]["IdSdI"] = id_sdi[_radice(nome)]
+    return risultati
+
+
+def _scrittore(coda: queue.Queue, esito: dict, guasti: list) -> None:
+    """
+    Scrittore: accumula i documenti analizzati e li inserisce a blocchi di
+    BLOCCO_IMPORT. I documenti in conflitto con uno già in archivio finiscono
+    negli errori del loro file.
+    """
+    blocco, nomi, contatti = [], [], {}
+
+    def scarica_blocco():
+        db_utils.aggiungi_controparti(contatti.values())
+        inseriti, aggiornati, conflitti = db_utils.inserisci_documenti(blocco)
+        esito["documenti"] += inseriti
+        esito["aggiornati"] += aggiornati
+        for posizione, messaggio in conflitti.items():
+            esito["errori"][nomi[posizione]] = f"DocumentoDuplicato: {messaggio}"
+        blocco.clear()
+        nomi.clear()
+        contatti.clear()
+
+    try:
+        while (risultati := coda.get()) is not None:
+            for nome, fatture, _, _ in risultati:
+                for doc, righe, riepilogo, contatto in fatture:
+                    blocco.append((doc, righe, riepilogo))
+                    nomi.append(nome)
+                    contatti.setdefault(contatto["Denominazione"], contatto)
+            if len(blocco) >= BLOCCO_IMPORT:
+                scarica_blocco()
+    except Exception as e:
+        guasti.append(e)
+        # continua a svuotare la coda fino al terminatore per non bloccare il lettore
+        while coda.get() is not None:
+            pass
+        return
+    # ultimo blocco fuori dallo svuotamento: il terminatore è già stato letto
+    try:
+        scarica_blocco()
+    except Exception as e:
+        guasti.append(e)
+
+
+def importa_pacchetto(sorgente, emittente: dict, processi: int = None, avanzamento=None) -> dict:
+    """
+    Importa le fatture di un pacchetto ZIP del cassetto fiscale (percorso o
+    file aperto, es. l'upload di Streamlit) con una pipeline a tre stadi:
+    lettore (file letti in memoria dallo ZIP, a blocchi) -> pool di processi
+    che analizza gli XML -> thread scrittore che inserisce a blocchi.
+    I compiti in volo (COMPITI_PER_PROCESSO per processo) e la coda verso lo
+    scrittore (CODA_SCRITTURA) sono limitati: se uno stadio rallenta, quelli
+    a monte si fermano e la memoria resta limitata.
+    Una fattura è "emessa" se il cedente ha la P.IVA/CF dell'emittente,
+    altrimenti è una ricevuta. Le controparti mancanti vengono aggiunte alla rubrica.
+    Reimportare un pacchetto è idempotente: i documenti già presenti (stessa
+    chiave naturale o stesso IdentificativoSdI) vengono aggiornati.
+    `avanzamento(fatti, totale, nome)` viene chiamata dopo ogni file.
+    Restituisce file, documenti (nuovi), aggiornati, emesse, ricevute, ignorati,
+    processi, secondi ed errori (file -> messaggio).
+    """
+    inizio = time.perf_counter()
+    ids_emittente = {_id_fiscale(emittente.get("PIVA")), _id_fiscale(emittente.get("CF"))} - {""}
+    esito = {"file": 0, "documenti": 0, "aggiornati": 0, "emesse": 0, "ricevute": 0, "ignorati": 0, "errori": {}}
+    coda = queue.Queue(maxsize=CODA_SCRITTURA)
+    guasti = []
+
+    with zipfile.ZipFile(sorgente) as zf:
+        totale = _conta_membri(zf)
+        processi = max(1, min(processi or PROCESSI_IMPORT or os.cpu_count() or 1, -(-totale // FILE_PER_COMPITO)))
+        esito["processi"] = processi
+
+        def registra(risultati):
+            if guasti:
+                raise guasti[0]
+            for nome, fatture, errore, ignorato in risultati:
+                esito["file"] += 1
+                if errore:
+                    esito["errori"][nome] = errore
+                esito["ignorati"] += ignorato
+                for doc, _, _, _ in fatture:
+                    esito["emesse" if doc["Tipo"] != db_utils.TIPO_RICEVUTA else "ricevute"] += 1
+                if avanzamento:
+                    avanzamento(esito["file"], max(totale, esito["file"]), nome)
+            coda.put(risultati)
+
+        scrittore = threading.Thread(target=_scrittore, args=(coda, esito, guasti), daemon=True)
+        scrittore.start()
+        try:
+            if processi == 1:
+                for compito in _compiti(zf):
+                    registra(_analizza_compito(compito, ids_emittente))
+            else:
+                # "spawn": i figli non ereditano la connessione SQLite né i thread del padre
+                contesto = multiprocessing.get_context("spawn")
+                with ProcessPoolExecutor(max_workers=processi, mp_context=contesto) as pool:
+                    in_volo = deque()
+                    for compito in _compiti(zf):
+                        in_volo.append(pool.submit(_analizza_compito, compito, ids_emittente))
+                        if len(in_volo) >= processi * COMPITI_PER_PROCESSO:
+                            registra(in_volo.popleft().result())
+                    while in_volo:
+                        registra(in_volo.popleft().result())
+        finally:
+            coda.put(None)
+            scrittore.join()
+
+    if guasti:
+        raise guasti[0]
+    esito["secondi"] = time.perf_counter() - inizio
+    return esito
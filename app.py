@@ -2,9 +2,22 @@ import streamlit as st
 import pandas as pd
 from datetime import date
 import os
-import re
-from fpdf import FPDF
 import base64
+from functools import partial
+
+import ade_utils
+import db_utils
+import importi_utils
+import pdf_utils
+import snapshot_utils
+from report_utils import (
+    MESI_LABEL,
+    anno_predefinito,
+    crea_liquidazione_iva,
+    crea_riepilogo_fatture_emesse,
+    crea_riepilogo_fatture_ricevute,
+    totali_mensili,
+)
 
 # ==========================
 # CONFIGURAZIONE PAGINA
@@ -26,68 +39,23 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 PRIMARY_BLUE = "#1f77b4"
-PDF_DIR = "fatture_pdf"
+PDF_DIR = pdf_utils.PDF_DIR
+DIMENSIONI_PAGINA = [10, 25, 50, 100]
 os.makedirs(PDF_DIR, exist_ok=True)
 
 # ==========================
 # DATI EMITTENTE (AZIENDA)
 # ==========================
 if "emittente" not in st.session_state:
-    st.session_state.emittente = {
-        "Denominazione": "FISCO CHIARO CONSULTING",
-        "Indirizzo": "Via/Piazza ... n. ...",
-        "CAP": "00000",
-        "Comune": "CITTÀ",
-        "Provincia": "XX",
-        "CF": "XXXXXXXXXXXX",
-        "PIVA": "XXXXXXXXXXXX",
-    }
+    st.session_state.emittente = dict(pdf_utils.EMITTENTE_DEFAULT)
 
 # ==========================
 # STATO DI SESSIONE
 # ==========================
-COLONNE_DOC = [
-    "Tipo",
-    "Numero",
-    "Data",
-    "Controparte",
-    "Imponibile",
-    "IVA",
-    "Importo",
-    "TipoXML",
-    "Stato",
-    "UUID",
-    "PDF",
-]
-
-CLIENTI_COLONNE = [
-    "Denominazione",
-    "PIVA",
-    "CF",
-    "Indirizzo",
-    "CAP",
-    "Comune",
-    "Provincia",
-    "CodiceDestinatario",
-    "PEC",
-    "Tipo",
-]
-
-if "documenti_emessi" not in st.session_state:
-    st.session_state.documenti_emessi = pd.DataFrame(columns=COLONNE_DOC)
-else:
-    for col in COLONNE_DOC:
-        if col not in st.session_state.documenti_emessi.columns:
-            st.session_state.documenti_emessi[col] = (
-                0.0 if col in ["Imponibile", "IVA", "Importo"] else ""
-            )
-
-if "clienti" not in st.session_state:
-    st.session_state.clienti = pd.DataFrame(columns=CLIENTI_COLONNE)
-else:
-    for col in CLIENTI_COLONNE:
-        if col not in st.session_state.clienti.columns:
-            st.session_state.clienti[col] = ""
+# I documenti e la rubrica vivono nell'archivio SQLite locale (db_utils):
+# a ogni rerun si legge la vista corrente, le scritture passano da db_utils.
+st.session_state.documenti_emessi = db_utils.carica_documenti()
+st.session_state.clienti = db_utils.carica_controparti()
 
 if "righe_correnti" not in st.session_state:
     st.session_state.righe_correnti = []
@@ -125,336 +93,240 @@ def mostra_anteprima_pdf(pdf_bytes: bytes, altezza: int = 600) -> None:
     st.markdown(pdf_display, unsafe_allow_html=True)
 
 
-def get_next_invoice_number() -> str:
-    year = date.today().year
-    prefix = f"FT{year}"
-    df = st.session_state.documenti_emessi
-    seq = 1
-    if not df.empty:
-        mask = df["Numero"].astype(str).str.startswith(prefix)
-        if mask.any():
-            existing = df.loc[mask, "Numero"].astype(str)
-            max_seq = 0
-            for num in existing:
-                m = re.search(rf"{prefix}(\d+)$", num)
-                if m:
-                    s = int(m.group(1))
-                    if s > max_seq:
-                        max_seq = s
-            seq = max_seq + 1
-    return f"{prefix}{seq:03d}"
-
-
-def crea_riepilogo_fatture_emesse(df: pd.DataFrame) -> None:
-    if df.empty:
-        st.info("Nessuna fattura emessa per creare il riepilogo.")
-        return
+def pulsanti_esportazione(df: pd.DataFrame, nome_file: str, chiave: str) -> None:
+    """Esportazione Excel/Parquet su richiesta: il file viene generato solo al clic."""
+    col_xlsx, col_parquet, _ = st.columns([1, 1, 4])
+    with col_xlsx:
+        st.download_button(
+            "⬇️ Esporta Excel",
+            data=partial(snapshot_utils.excel_bytes, df),
+            file_name=f"{nome_file}.xlsx",
+            mime=snapshot_utils.MIME_XLSX,
+            key=f"xlsx_{chiave}",
+            on_click="ignore",
+            use_container_width=True,
+        )
+    with col_parquet:
+        st.download_button(
+            "⬇️ Esporta Parquet",
+            data=partial(snapshot_utils.parquet_bytes, df),
+            file_name=f"{nome_file}{snapshot_utils.ESTENSIONE_PARQUET}",
+            mime=snapshot_utils.MIME_PARQUET,
+            key=f"parquet_{chiave}",
+            on_click="ignore",
+            use_container_width=True,
+        )
 
-    df = df.copy()
-    # FORMATO EUROPEO: DD/MM/YYYY
-    df["Data"] = pd.to_datetime(df["Data"], format="%d/%m/%Y", errors="coerce")
-    anni = sorted(df["Data"].dt.year.dropna().unique())
-    if not anni:
-        st.info("Nessuna data valida sulle fatture emesse.")
-        return
 
-    anno_default = date.today().year
-    if anno_default not in anni:
-        anno_default = anni[-1]
-    idx_default = list(anni).index(anno_default)
+# ==========================
+# LISTA DOCUMENTI
+# ==========================
+def mostra_scheda_documento(row_index, row: pd.Series, indice_cli: dict, suffisso_key: str = "") -> None:
+    """Scheda di un documento emesso con stato e menu azioni."""
+    numero = row.get("Numero", "")
+    data_doc = row["Data"].strftime("%d/%m/%Y")
+    controparte = row.get("Controparte", "")
+    importo = row.get("Importo", 0) / 100
+    tipo_xml = row.get("TipoXML", "TD01")
+    stato_doc = row.get("Stato", "Creazione")
+    pdf_path = row.get("PDF", "")
 
-    anno_sel = st.selectbox(
-        "Anno", anni, index=idx_default, key="anno_riepilogo_emesse"
-    )
-    df_anno = df[df["Data"].dt.year == anno_sel]
+    tipo_map = {
+        "TD01": "TD01 - Fattura",
+        "TD02": "TD02 - Acconto/Anticipo",
+        "TD04": "TD04 - Nota di credito",
+        "TD05": "TD05 - Nota di debito",
+    }
+    tipo_label = tipo_map.get(tipo_xml, tipo_xml)
 
-    mesi_label = [
-        "Gennaio", "Febbraio", "Marzo", "Aprile", "Maggio", "Giugno",
-        "Luglio", "Agosto", "Settembre", "Ottobre", "Novembre", "Dicembre",
-    ]
+    piva_val, cf_val = indice_cli.get(controparte, ("", ""))
+    piva_cf = piva_val or cf_val
 
-    rows = []
-    for m in range(1, 13):
-        df_m = df_anno[df_anno["Data"].dt.month == m]
-        imp_tot = df_m["Importo"].sum()
-        imp_imp = df_m["Imponibile"].sum()
-        iva_tot = df_m["IVA"].sum()
-        rows.append({
-            "Periodo": mesi_label[m - 1],
-            "Importo a pagare": _format_val_eur(imp_tot),
-            "Imponibile": _format_val_eur(imp_imp),
-            "IVA": _format_val_eur(iva_tot),
-        })
-
-    trimestri = {
-        "1° Trimestre": [1, 2, 3],
-        "2° Trimestre": [4, 5, 6],
-        "3° Trimestre": [7, 8, 9],
-        "4° Trimestre": [10, 11, 12],
-    }
-    for nome, months in trimestri.items():
-        df_q = df_anno[df_anno["Data"].dt.month.isin(months)]
-        imp_tot = df_q["Importo"].sum()
-        imp_imp = df_q["Imponibile"].sum()
-        iva_tot = df_q["IVA"].sum()
-        rows.append({
-            "Periodo": nome,
-            "Importo a pagare": _format_val_eur(imp_tot),
-            "Imponibile": _format_val_eur(imp_imp),
-            "IVA": _format_val_eur(iva_tot),
-        })
-
-    imp_tot = df_anno["Importo"].sum()
-    imp_imp = df_anno["Imponibile"].sum()
-    iva_tot = df_anno["IVA"].sum()
-    rows.append({
-        "Periodo": "Annuale",
-        "Importo a pagare": _format_val_eur(imp_tot),
-        "Imponibile": _format_val_eur(imp_imp),
-        "IVA": _format_val_eur(iva_tot),
-    })
-
-    df_riep = pd.DataFrame(rows)
-    st.markdown("### 📊 Prospetto riepilogativo fatture emesse")
-    st.dataframe(df_riep, use_container_width=True, hide_index=True)
+    with st.container(border=True):
+        col_icon, col_info, col_imp, col_stato, col_menu = st.columns([0.6, 4, 1.6, 1.4, 1.8])
 
+        with col_icon:
+            if tipo_xml == "TD01" and piva_cf:
+                st.markdown("🟥 **B2B**")
+            else:
+                st.markdown("📄")
+
+        with col_info:
+            info_lines = []
+            info_lines.append(f"**{tipo_label}**")
+            info_lines.append(f"{numero} del {data_doc}")
+            info_lines.append("")
+            info_lines.append("INVIATO A")
+            info_lines.append(controparte)
+            if piva_cf:
+                info_lines.append(f"P.IVA/C.F. {piva_cf}")
+            info_lines.append("CAUSALE")
+            info_lines.append("SERVIZIO")
+            st.markdown("  \n".join(info_lines))
+
+        with col_imp:
+            st.markdown("**IMPORTO (EUR)**")
+            st.markdown(_format_val_eur(importo))
+            st.markdown("**ESIGIBILITÀ IVA**")
+            st.markdown("IMMEDIATA")
+
+        with col_stato:
+            st.markdown("**Stato**")
+            possibili_stati = ["Creazione", "Creato", "Inviato"]
+            if stato_doc not in possibili_stati:
+                stato_doc = "Creazione"
+            new_stato = st.selectbox(
+                "",
+                possibili_stati,
+                index=possibili_stati.index(stato_doc),
+                key=f"stato{suffisso_key}_{row_index}",
+                label_visibility="collapsed",
+            )
+            if new_stato != stato_doc:
+                db_utils.aggiorna_documento(row_index, {"Stato": new_stato})
+
+        with col_menu:
+            st.markdown("**Azioni**")
+
+            with st.popover("⚙️ Azioni", use_container_width=True):
+                st.markdown("**Seleziona azione**")
+
+                # Solo stat: i byte si leggono al click che li richiede
+                pdf_ok = pdf_utils.pdf_disponibile(pdf_path)
+
+                if st.button("👁 Visualizza", key=f"vis{suffisso_key}_{row_index}", use_container_width=True):
+                    if pdf_ok:
+                        st.markdown("Anteprima PDF:")
+                        mostra_anteprima_pdf(pdf_utils.leggi_pdf(pdf_path), altezza=400)
+                    else:
+                        st.warning("PDF non disponibile")
+
+                if pdf_ok:
+                    st.download_button(
+                        "📄 Scarica PDF fattura",
+                        data=partial(pdf_utils.leggi_pdf, pdf_path),
+                        file_name=os.path.basename(pdf_path),
+                        mime="application/pdf",
+                        key=f"dl{suffisso_key}_{row_index}",
+                        use_container_width=True,
+                    )
+                else:
+                    st.info("PDF non disponibile")
 
-# ==========================
-# GENERAZIONE PDF FATTURA
-# ==========================
-def genera_pdf_fattura(
-    numero: str,
-    data_f: date,
-    cliente: dict,
-    righe: list,
-    imponibile: float,
-    iva: float,
-    totale: float,
-    tipo_xml_codice: str = "TD01",
-    modalita_pagamento: str = "",
-    note: str = "",
-) -> bytes:
-    """PDF di cortesia con layout tipo Effatta."""
-    EMITTENTE = st.session_state.emittente
-    
-    pdf = FPDF()
-    pdf.set_auto_page_break(auto=True, margin=15)
-    pdf.add_page()
-    row_height = 6
-
-    pdf.set_font("Helvetica", "B", 14)
-    pdf.cell(0, 8, EMITTENTE["Denominazione"], ln=1)
-    pdf.set_font("Helvetica", "", 9)
-    pdf.cell(0, 5, EMITTENTE["Indirizzo"], ln=1)
-    pdf.cell(0, 5, f'{EMITTENTE["CAP"]} {EMITTENTE["Comune"]} ({EMITTENTE["Provincia"]}) IT', ln=1)
-    pdf.cell(0, 5, f'CODICE FISCALE {EMITTENTE["CF"]}', ln=1)
-    pdf.cell(0, 5, f'PARTITA IVA {EMITTENTE["PIVA"]}', ln=1)
-
-    current_y = pdf.get_y()
-    pdf.set_xy(120, current_y)
-    pdf.set_font("Helvetica", "B", 9)
-    pdf.cell(0, 5, "Spett.le", ln=1)
-    pdf.set_x(120)
-    pdf.set_font("Helvetica", "B", 10)
-    pdf.cell(0, 5, cliente.get("Denominazione", ""), ln=1)
-    pdf.set_font("Helvetica", "", 9)
-
-    indirizzo_cli = cliente.get("Indirizzo", "")
-    if indirizzo_cli:
-        pdf.set_x(120)
-        pdf.cell(0, 5, indirizzo_cli, ln=1)
-
-    pdf.set_x(120)
-    pdf.cell(0, 5, f"{cliente.get('CAP','')} {cliente.get('Comune','')} ({cliente.get('Provincia','')}) IT", ln=1)
-
-    if cliente.get("PIVA"):
-        pdf.set_x(120)
-        pdf.cell(0, 5, f"P.IVA {cliente.get('PIVA','')}", ln=1)
-    elif cliente.get("CF"):
-        pdf.set_x(120)
-        pdf.cell(0, 5, f"CF {cliente.get('CF','')}", ln=1)
-
-    pdf.ln(6)
-
-    left_x = 10
-    right_x = 110
-    col_width = 90
-
-    pdf.set_fill_color(31, 119, 180)
-    pdf.set_text_color(255, 255, 255)
-    pdf.set_font("Helvetica", "B", 9)
-    pdf.set_xy(left_x, pdf.get_y())
-    pdf.cell(col_width, row_height, "DATI DOCUMENTO", border=1, ln=0, fill=True)
-    pdf.set_xy(right_x, pdf.get_y())
-    pdf.cell(col_width, row_height, "DATI TRASMISSIONE", border=1, ln=1, fill=True)
-
-    pdf.set_text_color(0, 0, 0)
-    pdf.set_font("Helvetica", "", 8)
-
-    def row_left(label: str, value: str):
-        pdf.set_x(left_x)
-        pdf.cell(col_width * 0.25, row_height, label, border=1)
-        pdf.cell(col_width * 0.75, row_height, value, border=1, ln=0)
-
-    def row_right(label: str, value: str, last: bool = True):
-        pdf.set_x(right_x)
-        pdf.cell(col_width * 0.35, row_height, label, border=1)
-        pdf.cell(col_width * 0.65, row_height, value, border=1, ln=1 if last else 0)
+                if st.button("📦 Scarica pacchetto", key=f"pac{suffisso_key}_{row_index}", use_container_width=True):
+                    st.info("Funzione in sviluppo")
 
-    tipo_map = {
-        "TD01": "TD01 FATTURA - B2B",
-        "TD02": "TD02 ACCONTO/ANTICIPO SU FATTURA",
-        "TD04": "TD04 NOTA DI CREDITO",
-        "TD05": "TD05 NOTA DI DEBITO",
-    }
-    tipo_label = tipo_map.get(tipo_xml_codice, tipo_xml_codice)
-
-    row_left("TIPO", tipo_label)
-    row_right("CODICE DESTINATARIO", cliente.get("CodiceDestinatario", "0000000"))
-    row_left("NUMERO", str(numero))
-    row_right("PEC DESTINATARIO", cliente.get("PEC", ""))
-    row_left("DATA", data_f.strftime("%d/%m/%Y"))
-    row_right("DATA INVIO", "")
-    causale = note.strip() if note else "SERVIZIO"
-    row_left("CAUSALE", causale)
-    row_right("IDENTIFICATIVO SDI", "")
-    pdf.ln(2)
-
-    pdf.set_fill_color(31, 119, 180)
-    pdf.set_text_color(255, 255, 255)
-    pdf.set_font("Helvetica", "B", 9)
-    pdf.set_x(10)
-    pdf.cell(190 - 20, row_height, "DETTAGLIO DOCUMENTO", border=1, ln=1, fill=True)
-
-    pdf.set_font("Helvetica", "B", 8)
-    headers = ["#", "DESCRIZIONE", "U.M.", "PREZZO", "QTA", "TOTALE", "IVA %", "RIT.", "NAT."]
-    widths = [8, 78, 10, 28, 12, 28, 12, 10, 14]
-
-    pdf.set_x(10)
-    for h, w in zip(headers, widths):
-        pdf.cell(w, row_height, h, border=1, align="C")
-    pdf.ln(row_height)
-
-    pdf.set_text_color(0, 0, 0)
-    pdf.set_font("Helvetica", "", 8)
-
-    righe_locali = righe if righe else [{"desc": "", "qta": 0, "prezzo": 0.0, "iva": 22}]
-
-    for idx, r in enumerate(righe_locali, start=1):
-        desc = (r.get("desc") or "").replace("\n", " ").strip()
-        if len(desc) > 70:
-            desc = desc[:67] + "..."
-        qta = float(r.get("qta", 0) or 0)
-        prezzo = float(r.get("prezzo", 0.0) or 0.0)
-        iva_r = float(r.get("iva", 22) or 0.0)
-        totale_riga = qta * prezzo
-
-        pdf.set_x(10)
-        pdf.cell(widths[0], row_height, str(idx), border=1, align="C")
-        pdf.cell(widths[1], row_height, desc, border=1)
-        pdf.cell(widths[2], row_height, "", border=1, align="C")
-        pdf.cell(widths[3], row_height, _format_val_eur(prezzo), border=1, align="R")
-        pdf.cell(widths[4], row_height, f"{qta:.2f}", border=1, align="R")
-        pdf.cell(widths[5], row_height, _format_val_eur(totale_riga), border=1, align="R")
-        pdf.cell(widths[6], row_height, f"{iva_r:.2f}", border=1, align="R")
-        pdf.cell(widths[7], row_height, "", border=1, align="C")
-        pdf.cell(widths[8], row_height, "", border=1, align="C")
-        pdf.ln(row_height)
-
-    pdf.ln(2)
-    pdf.set_x(10)
-    pdf.set_font("Helvetica", "", 8)
-    pdf.cell(40, row_height, "IMPORTO", border=1)
-    pdf.cell(50, row_height, _format_val_eur(imponibile), border=1, ln=1, align="R")
-    pdf.set_x(10)
-    pdf.cell(40, row_height, "TOTALE IMPONIBILE", border=1)
-    pdf.cell(50, row_height, _format_val_eur(imponibile), border=1, ln=1, align="R")
-    pdf.set_x(10)
-    pdf.cell(40, row_height, "IVA (SU IMPONIBILE)", border=1)
-    pdf.cell(50, row_height, _format_val_eur(iva), border=1, ln=1, align="R")
-    pdf.set_x(10)
-    pdf.cell(40, row_height, "IMPORTO TOTALE", border=1)
-    pdf.cell(50, row_height, _format_val_eur(totale), border=1, ln=1, align="R")
-    pdf.set_x(10)
-    pdf.set_font("Helvetica", "B", 9)
-    pdf.cell(40, row_height, "NETTO A PAGARE", border=1)
-    pdf.cell(50, row_height, _format_val_eur(totale), border=1, ln=1, align="R")
-
-    pdf.ln(3)
-    pdf.set_fill_color(31, 119, 180)
-    pdf.set_text_color(255, 255, 255)
-    pdf.set_font("Helvetica", "B", 9)
-    pdf.set_x(10)
-    pdf.cell(190 - 20, row_height, "RIEPILOGHI", border=1, ln=1, fill=True)
-
-    pdf.set_text_color(0, 0, 0)
-    pdf.set_font("Helvetica", "B", 8)
-
-    riepi_headers = ["IVA %", "NAT.", "RIFERIMENTO NORMATIVO", "IMPONIBILE", "IMPOSTA", "ESIG. IVA", "ARROT.", "SPESE ACC.", "TOTALE"]
-    riepi_w = [14, 14, 40, 24, 20, 20, 14, 24, 24]
-
-    pdf.set_x(10)
-    for h, w in zip(riepi_headers, riepi_w):
-        pdf.cell(w, row_height, h, border=1, align="C")
-    pdf.ln(row_height)
-
-    pdf.set_font("Helvetica", "", 8)
-    pdf.set_x(10)
-    pdf.cell(riepi_w[0], row_height, "22,00", border=1, align="R")
-    pdf.cell(riepi_w[1], row_height, "", border=1)
-    pdf.cell(riepi_w[2], row_height, "", border=1)
-    pdf.cell(riepi_w[3], row_height, _format_val_eur(imponibile), border=1, align="R")
-    pdf.cell(riepi_w[4], row_height, _format_val_eur(iva), border=1, align="R")
-    pdf.cell(riepi_w[5], row_height, "IMMEDIATA", border=1, align="C")
-    pdf.cell(riepi_w[6], row_height, "0,00", border=1, align="R")
-    pdf.cell(riepi_w[7], row_height, "0,00", border=1, align="R")
-    pdf.cell(riepi_w[8], row_height, _format_val_eur(totale), border=1, align="R")
-    pdf.ln(4)
-
-    pdf.set_fill_color(31, 119, 180)
-    pdf.set_text_color(255, 255, 255)
-    pdf.set_font("Helvetica", "B", 9)
-    pdf.set_x(10)
-    pdf.cell(190 - 20, row_height, "MODALITA' DI PAGAMENTO ACCETTATE: PAGAMENTO COMPLETO", border=1, ln=1, fill=True)
-
-    pdf.set_text_color(0, 0, 0)
-    pdf.set_font("Helvetica", "B", 8)
-    pdf.set_x(10)
-
-    pag_headers = ["MODALITA'", "DETTAGLI", "DATA RIF. TERMINI", "GIORNI TERMINI", "DATA SCADENZA"]
-    pag_w = [30, 60, 30, 30, 40]
-
-    for h, w in zip(pag_headers, pag_w):
-        pdf.cell(w, row_height, h, border=1, align="C")
-    pdf.ln(row_height)
-
-    pdf.set_font("Helvetica", "", 8)
-    pdf.set_x(10)
-    pdf.cell(pag_w[0], row_height, "CONTANTI", border=1)
-    pdf.cell(pag_w[1], row_height, modalita_pagamento[:40], border=1)
-    pdf.cell(pag_w[2], row_height, "", border=1)
-    pdf.cell(pag_w[3], row_height, "0", border=1, align="C")
-    pdf.cell(pag_w[4], row_height, "", border=1, align="C")
-    pdf.ln(row_height + 2)
-
-    pdf.set_font("Helvetica", "B", 9)
-    pdf.set_x(10)
-    pdf.cell(190 - 20, row_height, f"TOTALE A PAGARE EUR {_format_val_eur(totale)}", ln=1)
-
-    pdf.set_y(-25)
-    pdf.set_font("Helvetica", "I", 7)
-    pdf.multi_cell(
-        0, 4,
-        ("Copia di cortesia priva di valore ai fini fiscali e giuridici ai sensi dell'articolo 21 del D.P.R. 633/72. "
-         "L'originale del documento è consultabile presso l'indirizzo PEC o il codice SDI registrato "
-         "o nell'area riservata Fatture e Corrispettivi."),
-        align="C",
-    )
+                if st.button("📑 Scarica PDF proforma", key=f"prof{suffisso_key}_{row_index}", use_container_width=True):
+                    st.info("Funzione in sviluppo")
+
+                if st.button("✏️ Modifica", key=f"mod{suffisso_key}_{row_index}", use_container_width=True):
+                    st.session_state.fattura_in_modifica = row_index
+                    st.session_state.modalita_modifica = True
+                    st.session_state.pagina_corrente = "➕ Crea nuova fattura"
+                    st.rerun()
+
+                if st.button("🧬 Duplica", key=f"dup{suffisso_key}_{row_index}", use_container_width=True):
+                    try:
+                        _, nuovo_num = db_utils.duplica_documento(row_index)
+                    except db_utils.DocumentoDuplicato as e:
+                        st.error(f"⚠️ {e}")
+                    else:
+                        st.success(f"Fattura duplicata come {nuovo_num}.")
+                        st.rerun()
+
+                if st.button("🗑 Elimina", key=f"del{suffisso_key}_{row_index}", use_container_width=True, type="secondary"):
+                    db_utils.elimina_documento(row_index)
+                    st.warning("Fattura eliminata.")
+                    st.rerun()
 
-    out = pdf.output(dest="S")
-    if isinstance(out, (bytes, bytearray)):
-        return bytes(out)
-    return out.encode("latin1")
+                if st.button("📨 Invia", key=f"inv{suffisso_key}_{row_index}", use_container_width=True):
+                    st.info("Funzione in sviluppo")
+
+
+def _azzera_pagine(chiave: str) -> None:
+    st.session_state[f"cursori_{chiave}"] = [None]
+
+
+def mostra_lista_documenti(indice_cli: dict, chiave: str, suffisso_key: str = "", mese: int = None) -> None:
+    """
+    Lista documenti emessi: schede paginate (keyset su Data/Numero, solo la
+    pagina visibile crea widget) oppure tabella compatta con selezione riga.
+    """
+    col_mod, col_dim, _ = st.columns([2, 1, 3])
+    with col_mod:
+        modalita = st.radio(
+            "Visualizzazione",
+            ["Schede", "Tabella compatta"],
+            horizontal=True,
+            key=f"modalita_{chiave}",
+        )
+
+    if modalita == "Tabella compatta":
+        df = st.session_state.documenti_emessi.copy()
+        if mese is not None:
+            df = df[df["Mese"] == mese]
+        df = df.sort_values(["Data", "Numero"], ascending=False)
+        df["P.IVA/C.F."] = [
+            piva or cf for piva, cf in (indice_cli.get(c, ("", "")) for c in df["Controparte"])
+        ]
+        vista = db_utils.importi_in_euro(
+            df[["Numero", "Data", "Controparte", "P.IVA/C.F.", "Importo", "TipoXML", "Stato"]]
+        )
+        evento = st.dataframe(
+            vista,
+            use_container_width=True,
+            hide_index=True,
+            on_select="rerun",
+            selection_mode="single-row",
+            column_config={"Data": st.column_config.DateColumn("Data", format="DD/MM/YYYY")},
+            key=f"tabella_{chiave}",
+        )
+        selezione = evento.selection.rows
+        if selezione:
+            row_index = vista.index[selezione[0]]
+            mostra_scheda_documento(row_index, df.loc[row_index], indice_cli, suffisso_key)
+        else:
+            st.caption("Seleziona una riga per aprire la scheda con le azioni.")
+        return
+
+    with col_dim:
+        dimensione = st.selectbox(
+            "Per pagina",
+            DIMENSIONI_PAGINA,
+            index=DIMENSIONI_PAGINA.index(25),
+            key=f"dim_{chiave}",
+            on_change=_azzera_pagine,
+            args=(chiave,),
+        )
+
+    # Pila delle chiavi di inizio pagina: la prima pagina parte da None
+    chiave_cursori = f"cursori_{chiave}"
+    if chiave_cursori not in st.session_state:
+        _azzera_pagine(chiave)
+    cursori = st.session_state[chiave_cursori]
+
+    df_pagina, successiva = db_utils.pagina_documenti(dimensione, dopo=cursori[-1], mese=mese)
+    if df_pagina.empty and len(cursori) > 1:
+        # la pagina corrente si è svuotata (es. eliminazioni): torno alla prima
+        _azzera_pagine(chiave)
+        st.rerun()
+
+    for row_index, row in df_pagina.iterrows():
+        mostra_scheda_documento(row_index, row, indice_cli, suffisso_key)
+
+    totale = db_utils.conta_documenti(mese)
+    n_pagine = max(1, -(-totale // dimensione))
+    col_prec, col_info, col_succ = st.columns([1, 2, 1])
+    with col_prec:
+        if st.button("◀ Precedente", key=f"prec_{chiave}", disabled=len(cursori) == 1, use_container_width=True):
+            cursori.pop()
+            st.rerun()
+    with col_info:
+        st.caption(f"Pagina {len(cursori)} di {n_pagine} · {totale} documenti")
+    with col_succ:
+        if st.button("Successiva ▶", key=f"succ_{chiave}", disabled=successiva is None, use_container_width=True):
+            cursori.append(successiva)
+            st.rerun()
 
 
 # ==========================
@@ -464,6 +336,8 @@ PAGINE = [
     "📊 Dashboard",
     "📝 Anagrafica azienda",
     "📋 Lista documenti",
+    "📥 Fatture ricevute",
+    "🧮 Liquidazione IVA",
     "➕ Crea nuova fattura",
     "📥 Download documenti",
     "📦 Carica pacchetto AdE",
@@ -504,13 +378,7 @@ st.markdown("---")
 # ==========================
 # CONTATORI DOCUMENTI PER MESE
 # ==========================
-docs_per_month = {m: 0 for m in range(1, 13)}
-df_tmp = st.session_state.documenti_emessi.copy()
-if not df_tmp.empty:
-    # FORMATO EUROPEO
-    df_tmp["Data"] = pd.to_datetime(df_tmp["Data"], format="%d/%m/%Y", errors="coerce")
-    for m in range(1, 13):
-        docs_per_month[m] = (df_tmp["Data"].dt.month == m).sum()
+docs_per_month = st.session_state.documenti_emessi["Mese"].value_counts().to_dict()
 
 # ==========================
 # GESTIONE PAGINE
@@ -603,7 +471,7 @@ elif pagina == "📋 Lista documenti":
             st.rerun()
     with col_ricevute:
         if st.button("📥 RICEVUTE"):
-            st.session_state.pagina_corrente = "📥 Download documenti"
+            st.session_state.pagina_corrente = "📥 Fatture ricevute"
             st.rerun()
     with col_agg:
         if st.button("🔄 AGGIORNA"):
@@ -622,6 +490,9 @@ elif pagina == "📋 Lista documenti":
 
     tabs = st.tabs(mesi)
 
+    # P.IVA / CF per denominazione, dalla cache della rubrica
+    indice_cli = db_utils.indice_controparti()
+
     for i, tab in enumerate(tabs):
         with tab:
             if i == 0:
@@ -629,300 +500,93 @@ elif pagina == "📋 Lista documenti":
                 
                 st.markdown("---")
                 st.markdown("### 📋 Tutte le fatture emesse")
-                
-                df_tutte = st.session_state.documenti_emessi.copy()
-                
-                if df_tutte.empty:
+
+                if st.session_state.documenti_emessi.empty:
                     st.info("Nessun documento emesso.")
                 else:
-                    # FORMATO EUROPEO
-                    df_tutte["DataSort"] = pd.to_datetime(df_tutte["Data"], format="%d/%m/%Y", errors="coerce")
-                    df_tutte = df_tutte.sort_values("DataSort", ascending=False)
-                    
-                    for row_index, row in df_tutte.iterrows():
-                        numero = row.get("Numero", "")
-                        data_doc = row.get("Data", "")
-                        controparte = row.get("Controparte", "")
-                        importo = float(row.get("Importo", 0) or 0)
-                        tipo_xml = row.get("TipoXML", "TD01")
-                        stato_doc = row.get("Stato", "Creazione")
-                        pdf_path = row.get("PDF", "")
-
-                        tipo_map = {
-                            "TD01": "TD01 - Fattura",
-                            "TD02": "TD02 - Acconto/Anticipo",
-                            "TD04": "TD04 - Nota di credito",
-                            "TD05": "TD05 - Nota di debito",
-                        }
-                        tipo_label = tipo_map.get(tipo_xml, tipo_xml)
-
-                        piva_cf = ""
-                        cli_df = st.session_state.clienti[st.session_state.clienti["Denominazione"] == controparte]
-                        if not cli_df.empty:
-                            cli_row = cli_df.iloc[0]
-                            piva_val = (cli_row.get("PIVA") or "").strip()
-                            cf_val = (cli_row.get("CF") or "").strip()
-                            if piva_val:
-                                piva_cf = piva_val
-                            elif cf_val:
-                                piva_cf = cf_val
-
-                        with st.container(border=True):
-                            col_icon, col_info, col_imp, col_stato, col_menu = st.columns([0.6, 4, 1.6, 1.4, 1.8])
-
-                            with col_icon:
-                                if tipo_xml == "TD01" and piva_cf:
-                                    st.markdown("🟥 **B2B**")
-                                else:
-                                    st.markdown("📄")
-
-                            with col_info:
-                                info_lines = []
-                                info_lines.append(f"**{tipo_label}**")
-                                info_lines.append(f"{numero} del {data_doc}")
-                                info_lines.append("")
-                                info_lines.append("INVIATO A")
-                                info_lines.append(controparte)
-                                if piva_cf:
-                                    info_lines.append(f"P.IVA/C.F. {piva_cf}")
-                                info_lines.append("CAUSALE")
-                                info_lines.append("SERVIZIO")
-                                st.markdown("  \n".join(info_lines))
-
-                            with col_imp:
-                                st.markdown("**IMPORTO (EUR)**")
-                                st.markdown(_format_val_eur(importo))
-                                st.markdown("**ESIGIBILITÀ IVA**")
-                                st.markdown("IMMEDIATA")
-
-                            with col_stato:
-                                st.markdown("**Stato**")
-                                possibili_stati = ["Creazione", "Creato", "Inviato"]
-                                if stato_doc not in possibili_stati:
-                                    stato_doc = "Creazione"
-                                new_stato = st.selectbox(
-                                    "",
-                                    possibili_stati,
-                                    index=possibili_stati.index(stato_doc),
-                                    key=f"stato_riep_{row_index}",
-                                    label_visibility="collapsed",
-                                )
-                                st.session_state.documenti_emessi.loc[row_index, "Stato"] = new_stato
-
-                            with col_menu:
-                                st.markdown("**Azioni**")
-
-                                with st.popover("⚙️ Azioni", use_container_width=True):
-                                    st.markdown("**Seleziona azione**")
-
-                                    pdf_bytes = None
-                                    if pdf_path and os.path.exists(pdf_path):
-                                        with open(pdf_path, "rb") as f:
-                                            pdf_bytes = f.read()
-
-                                    if st.button("👁 Visualizza", key=f"vis_riep_{row_index}", use_container_width=True):
-                                        if pdf_bytes:
-                                            st.markdown("Anteprima PDF:")
-                                            mostra_anteprima_pdf(pdf_bytes, altezza=400)
-                                        else:
-                                            st.warning("PDF non disponibile")
-
-                                    if pdf_bytes:
-                                        st.download_button(
-                                            "📄 Scarica PDF fattura",
-                                            data=pdf_bytes,
-                                            file_name=os.path.basename(pdf_path),
-                                            mime="application/pdf",
-                                            key=f"dl_riep_{row_index}",
-                                            use_container_width=True,
-                                        )
-                                    else:
-                                        st.info("PDF non disponibile")
-
-                                    if st.button("📦 Scarica pacchetto", key=f"pac_riep_{row_index}", use_container_width=True):
-                                        st.info("Funzione in sviluppo")
-
-                                    if st.button("📑 Scarica PDF proforma", key=f"prof_riep_{row_index}", use_container_width=True):
-                                        st.info("Funzione in sviluppo")
-
-                                    if st.button("✏️ Modifica", key=f"mod_riep_{row_index}", use_container_width=True):
-                                        st.session_state.fattura_in_modifica = row_index
-                                        st.session_state.modalita_modifica = True
-                                        st.session_state.pagina_corrente = "➕ Crea nuova fattura"
-                                        st.rerun()
-
-                                    if st.button("🧬 Duplica", key=f"dup_riep_{row_index}", use_container_width=True):
-                                        nuovo_num = get_next_invoice_number()
-                                        nuova_riga = row.copy()
-                                        nuova_riga["Numero"] = nuovo_num
-                                        # FORMATO EUROPEO
-                                        nuova_riga["Data"] = date.today().strftime("%d/%m/%Y")
-                                        st.session_state.documenti_emessi = pd.concat(
-                                            [st.session_state.documenti_emessi, pd.DataFrame([nuova_riga])],
-                                            ignore_index=True,
-                                        )
-                                        st.success(f"Fattura duplicata come {nuovo_num}.")
-                                        st.rerun()
-
-                                    if st.button("🗑 Elimina", key=f"del_riep_{row_index}", use_container_width=True, type="secondary"):
-                                        st.session_state.documenti_emessi = (
-                                            st.session_state.documenti_emessi.drop(row_index).reset_index(drop=True)
-                                        )
-                                        st.warning("Fattura eliminata.")
-                                        st.rerun()
-
-                                    if st.button("📨 Invia", key=f"inv_riep_{row_index}", use_container_width=True):
-                                        st.info("Funzione in sviluppo")
+                    pulsanti_esportazione(st.session_state.documenti_emessi, "documenti_emessi", "emesse")
+                    mostra_lista_documenti(indice_cli, "riep", suffisso_key="_riep")
             
             else:
-                mese_idx = i
-                df_mese = st.session_state.documenti_emessi.copy()
-                if not df_mese.empty:
-                    # FORMATO EUROPEO
-                    df_mese["DataSort"] = pd.to_datetime(df_mese["Data"], format="%d/%m/%Y", errors="coerce")
-                    df_mese = df_mese[df_mese["DataSort"].dt.month == mese_idx]
-
-                if df_mese.empty:
+                if db_utils.conta_documenti(mese=i) == 0:
                     st.info("Nessun documento in questo periodo.")
                     continue
 
                 st.caption("Elenco fatture emesse")
-                df_mese = df_mese.sort_values("DataSort", ascending=False)
-                
-                for row_index, row in df_mese.iterrows():
-                    numero = row.get("Numero", "")
-                    data_doc = row.get("Data", "")
-                    controparte = row.get("Controparte", "")
-                    importo = float(row.get("Importo", 0) or 0)
-                    tipo_xml = row.get("TipoXML", "TD01")
-                    stato_doc = row.get("Stato", "Creazione")
-                    pdf_path = row.get("PDF", "")
-
-                    tipo_map = {
-                        "TD01": "TD01 - Fattura",
-                        "TD02": "TD02 - Acconto/Anticipo",
-                        "TD04": "TD04 - Nota di credito",
-                        "TD05": "TD05 - Nota di debito",
-                    }
-                    tipo_label = tipo_map.get(tipo_xml, tipo_xml)
-
-                    piva_cf = ""
-                    cli_df = st.session_state.clienti[st.session_state.clienti["Denominazione"] == controparte]
-                    if not cli_df.empty:
-                        cli_row = cli_df.iloc[0]
-                        piva_val = (cli_row.get("PIVA") or "").strip()
-                        cf_val = (cli_row.get("CF") or "").strip()
-                        if piva_val:
-                            piva_cf = piva_val
-                        elif cf_val:
-                            piva_cf = cf_val
-
-                    with st.container(border=True):
-                        col_icon, col_info, col_imp, col_stato, col_menu = st.columns([0.6, 4, 1.6, 1.4, 1.8])
-
-                        with col_icon:
-                            if tipo_xml == "TD01" and piva_cf:
-                                st.markdown("🟥 **B2B**")
-                            else:
-                                st.markdown("📄")
-
-                        with col_info:
-                            info_lines = []
-                            info_lines.append(f"**{tipo_label}**")
-                            info_lines.append(f"{numero} del {data_doc}")
-                            info_lines.append("")
-                            info_lines.append("INVIATO A")
-                            info_lines.append(controparte)
-                            if piva_cf:
-                                info_lines.append(f"P.IVA/C.F. {piva_cf}")
-                            info_lines.append("CAUSALE")
-                            info_lines.append("SERVIZIO")
-                            st.markdown("  \n".join(info_lines))
-
-                        with col_imp:
-                            st.markdown("**IMPORTO (EUR)**")
-                            st.markdown(_format_val_eur(importo))
-                            st.markdown("**ESIGIBILITÀ IVA**")
-                            st.markdown("IMMEDIATA")
-
-                        with col_stato:
-                            st.markdown("**Stato**")
-                            possibili_stati = ["Creazione", "Creato", "Inviato"]
-                            if stato_doc not in possibili_stati:
-                                stato_doc = "Creazione"
-                            new_stato = st.selectbox(
-                                "",
-                                possibili_stati,
-                                index=possibili_stati.index(stato_doc),
-                                key=f"stato_{row_index}",
-                                label_visibility="collapsed",
-                            )
-                            st.session_state.documenti_emessi.loc[row_index, "Stato"] = new_stato
-
-                        with col_menu:
-                            st.markdown("**Azioni**")
-
-                            with st.popover("⚙️ Azioni", use_container_width=True):
-                                st.markdown("**Seleziona azione**")
-
-                                pdf_bytes = None
-                                if pdf_path and os.path.exists(pdf_path):
-                                    with open(pdf_path, "rb") as f:
-                                        pdf_bytes = f.read()
-
-                                if st.button("👁 Visualizza", key=f"vis_{row_index}", use_container_width=True):
-                                    if pdf_bytes:
-                                        st.markdown("Anteprima PDF:")
-                                        mostra_anteprima_pdf(pdf_bytes, altezza=400)
-                                    else:
-                                        st.warning("PDF non disponibile")
-
-                                if pdf_bytes:
-                                    st.download_button(
-                                        "📄 Scarica PDF fattura",
-                                        data=pdf_bytes,
-                                        file_name=os.path.basename(pdf_path),
-                                        mime="application/pdf",
-                                        key=f"dl_{row_index}",
-                                        use_container_width=True,
-                                    )
-                                else:
-                                    st.info("PDF non disponibile")
-
-                                if st.button("📦 Scarica pacchetto", key=f"pac_{row_index}", use_container_width=True):
-                                    st.info("Funzione in sviluppo")
-
-                                if st.button("📑 Scarica PDF proforma", key=f"prof_{row_index}", use_container_width=True):
-                                    st.info("Funzione in sviluppo")
-
-                                if st.button("✏️ Modifica", key=f"mod_{row_index}", use_container_width=True):
-                                    st.session_state.fattura_in_modifica = row_index
-                                    st.session_state.modalita_modifica = True
-                                    st.session_state.pagina_corrente = "➕ Crea nuova fattura"
-                                    st.rerun()
-
-                                if st.button("🧬 Duplica", key=f"dup_{row_index}", use_container_width=True):
-                                    nuovo_num = get_next_invoice_number()
-                                    nuova_riga = row.copy()
-                                    nuova_riga["Numero"] = nuovo_num
-                                    # FORMATO EUROPEO
-                                    nuova_riga["Data"] = date.today().strftime("%d/%m/%Y")
-                                    st.session_state.documenti_emessi = pd.concat(
-                                        [st.session_state.documenti_emessi, pd.DataFrame([nuova_riga])],
-                                        ignore_index=True,
-                                    )
-                                    st.success(f"Fattura duplicata come {nuovo_num}.")
-                                    st.rerun()
-
-                                if st.button("🗑 Elimina", key=f"del_{row_index}", use_container_width=True, type="secondary"):
-                                    st.session_state.documenti_emessi = (
-                                        st.session_state.documenti_emessi.drop(row_index).reset_index(drop=True)
-                                    )
-                                    st.warning("Fattura eliminata.")
-                                    st.rerun()
-
-                                if st.button("📨 Invia", key=f"inv_{row_index}", use_container_width=True):
-                                    st.info("Funzione in sviluppo")
+                mostra_lista_documenti(indice_cli, f"mese_{i}", mese=i)
+
+elif pagina == "📥 Fatture ricevute":
+    st.subheader("📥 Fatture ricevute")
+
+    ricevute = db_utils.carica_ricevute()
+    if ricevute.empty:
+        st.info("Nessuna fattura ricevuta: importa il pacchetto del cassetto fiscale da \"📦 Carica pacchetto AdE\".")
+    else:
+        fornitori = db_utils.indice_fornitori()
+        etichette_fornitori = {
+            emittente: f"{nome} ({emittente}) · {n} documenti"
+            for emittente, nome, n in zip(fornitori["Emittente"], fornitori["Fornitore"], fornitori["Documenti"])
+        }
+        anni = sorted(int(a) for a in ricevute["Anno"].unique())
+
+        col_anno, col_fornitore = st.columns([1, 3])
+        with col_anno:
+            anno = st.selectbox("Anno", anni, index=anni.index(anno_predefinito(anni)), key="anno_ricevute")
+        with col_fornitore:
+            fornitore = st.selectbox(
+                "Fornitore",
+                [None, *etichette_fornitori],
+                format_func=lambda e: "Tutti i fornitori" if e is None else etichette_fornitori[e],
+                key="fornitore_ricevute",
+            )
+
+        df_anno = ricevute[ricevute["Anno"] == anno]
+        if fornitore is not None:
+            df_anno = df_anno[df_anno["Emittente"] == fornitore]
+
+        # un solo passaggio per i contatori delle schede e uno per dividere i mesi
+        conteggi = totali_mensili(df_anno, anno)["Documenti"]
+        per_mese = dict(tuple(df_anno.groupby("Mese")))
+        tabs = st.tabs(
+            ["📊 Riepilogo"]
+            + [f"📅 {nome} ({n})" if n else f"📅 {nome}" for nome, n in zip(MESI_LABEL, conteggi)]
+        )
+
+        with tabs[0]:
+            crea_riepilogo_fatture_ricevute(anno, df_anno if fornitore is not None else None)
+            pulsanti_esportazione(df_anno, f"ricevute_{anno}", "ricevute")
+            if fornitore is None:
+                st.markdown("---")
+                st.markdown("### 🏢 Fornitori")
+                st.dataframe(
+                    db_utils.importi_in_euro(fornitori).rename(columns={"Emittente": "P.IVA/C.F.", "Ultimo": "Ultimo documento"}),
+                    use_container_width=True,
+                    hide_index=True,
+                    column_config={
+                        "Importo": st.column_config.NumberColumn("Importo", format="€ %.2f"),
+                        "Ultimo documento": st.column_config.DateColumn("Ultimo documento", format="DD/MM/YYYY"),
+                    },
+                )
+
+        for mese, tab in enumerate(tabs[1:], start=1):
+            with tab:
+                df_mese = per_mese.get(mese)
+                if df_mese is None:
+                    st.info("Nessuna fattura ricevuta in questo periodo.")
+                    continue
+                vista = db_utils.importi_in_euro(df_mese.sort_values(["Data", "Numero"], ascending=False)[
+                    ["Numero", "Data", "Controparte", "Emittente", "Imponibile", "IVA", "Importo", "TipoXML", "IdSdI"]
+                ]).rename(columns={"Controparte": "Fornitore", "Emittente": "P.IVA/C.F.", "IdSdI": "Id SdI"})
+                st.dataframe(
+                    vista,
+                    use_container_width=True,
+                    hide_index=True,
+                    column_config={"Data": st.column_config.DateColumn("Data", format="DD/MM/YYYY")},
+                )
+
+elif pagina == "🧮 Liquidazione IVA":
+    st.subheader("🧮 Liquidazione IVA")
+    crea_liquidazione_iva()
 
 elif pagina == "➕ Crea nuova fattura":
     if st.session_state.modalita_modifica and st.session_state.fattura_in_modifica is not None:
@@ -931,11 +595,13 @@ elif pagina == "➕ Crea nuova fattura":
         fattura_da_modificare = st.session_state.documenti_emessi.loc[st.session_state.fattura_in_modifica]
         
         if not st.session_state.righe_correnti:
-            st.session_state.righe_correnti = [{"desc": "SERVIZIO", "qta": 1.0, "prezzo": float(fattura_da_modificare["Imponibile"]), "iva": 22}]
+            st.session_state.righe_correnti = db_utils.carica_righe(st.session_state.fattura_in_modifica)
+        if not st.session_state.righe_correnti:
+            st.session_state.righe_correnti = [{"desc": "SERVIZIO", "qta": 1.0, "prezzo": fattura_da_modificare["Imponibile"] / 100, "iva": 22}]
         
         numero_originale = fattura_da_modificare["Numero"]
         # FORMATO EUROPEO
-        data_originale = pd.to_datetime(fattura_da_modificare["Data"], format="%d/%m/%Y").date()
+        data_originale = fattura_da_modificare["Data"].date()
         controparte_originale = fattura_da_modificare["Controparte"]
         tipo_xml_originale = fattura_da_modificare["TipoXML"]
         stato_originale = fattura_da_modificare["Stato"]
@@ -1051,7 +717,8 @@ elif pagina == "➕ Crea nuova fattura":
         if st.session_state.modalita_modifica:
             numero = st.text_input("Numero fattura", numero_originale, disabled=True)
         else:
-            numero = st.text_input("Numero fattura", get_next_invoice_number())
+            numero_proposto = db_utils.prossimo_numero(db_utils.serie_per_tipo(tipo_xml_codice))
+            numero = st.text_input("Numero fattura", numero_proposto)
     with col_n2:
         if st.session_state.modalita_modifica:
             data_f = st.date_input("Data fattura", data_originale)
@@ -1068,9 +735,6 @@ elif pagina == "➕ Crea nuova fattura":
         st.session_state.righe_correnti.append({"desc": "", "qta": 1.0, "prezzo": 0.0, "iva": 22})
         st.rerun()
 
-    imponibile = 0.0
-    iva_tot = 0.0
-
     for i, r in enumerate(st.session_state.righe_correnti):
         c1, c2, c3, c4, c5 = st.columns([4, 1, 1, 1, 0.5])
         with c1:
@@ -1081,17 +745,27 @@ elif pagina == "➕ Crea nuova fattura":
             r["prezzo"] = st.number_input("Prezzo", min_value=0.0, value=r["prezzo"], key=f"prz{i}")
         with c4:
             r["iva"] = st.selectbox("IVA %", [22, 10, 5, 4, 0], index=[22, 10, 5, 4, 0].index(r["iva"]), key=f"iva{i}")
+            if r["iva"] == 0:
+                nature = list(importi_utils.NATURE_IVA)
+                r["natura"] = st.selectbox(
+                    "Natura",
+                    nature,
+                    index=nature.index(r["natura"]) if r.get("natura") in nature else 0,
+                    format_func=lambda n: f"{n} - {importi_utils.NATURE_IVA[n]}",
+                    key=f"nat{i}",
+                )
+            else:
+                r["natura"] = ""
         with c5:
             if st.button("🗑", key=f"del{i}"):
                 st.session_state.righe_correnti.pop(i)
                 st.rerun()
 
-        imp_riga = r["qta"] * r["prezzo"]
-        iva_riga = imp_riga * (r["iva"] / 100)
-        imponibile += imp_riga
-        iva_tot += iva_riga
-
-    totale = imponibile + iva_tot
+    # totali esatti in centesimi, IVA arrotondata per aliquota come nel riepilogo XML
+    totali = importi_utils.totali_fattura(st.session_state.righe_correnti)
+    imponibile, iva_tot, totale = (
+        db_utils.euro(totali[col]) for col in ("Imponibile", "IVA", "Importo")
+    )
 
     st.markdown("---")
     col_t1, col_t2, col_t3 = st.columns(3)
@@ -1115,77 +789,78 @@ elif pagina == "➕ Crea nuova fattura":
             btn_label = "💾 Salva fattura"
             
         if st.button(btn_label, type="primary", use_container_width=True):
+            salvato = False
             if not cliente_corrente["Denominazione"]:
                 st.error("⚠️ Inserisci la denominazione del cliente")
             elif not st.session_state.righe_correnti:
                 st.error("⚠️ Inserisci almeno una riga")
             else:
-                if (cliente_corrente["Denominazione"] and 
-                    cliente_corrente["Denominazione"] not in st.session_state.clienti["Denominazione"].tolist()):
-                    nuovo_cli = pd.DataFrame([{
-                        "Denominazione": cliente_corrente["Denominazione"],
-                        "PIVA": cliente_corrente["PIVA"],
-                        "CF": cliente_corrente["CF"],
-                        "Indirizzo": cliente_corrente["Indirizzo"],
-                        "CAP": cliente_corrente["CAP"],
-                        "Comune": cliente_corrente["Comune"],
-                        "Provincia": cliente_corrente["Provincia"],
-                        "CodiceDestinatario": cliente_corrente["CodiceDestinatario"],
-                        "PEC": cliente_corrente["PEC"],
-                        "Tipo": "Cliente",
-                    }])
-                    st.session_state.clienti = pd.concat([st.session_state.clienti, nuovo_cli], ignore_index=True)
+                # numero proposto: viene riservato nella transazione dell'inserimento,
+                # così un salvataggio fallito non lascia buchi nella numerazione
+                numero_da_assegnare = not st.session_state.modalita_modifica and numero == numero_proposto
+
+                def percorso_pdf(numero):
+                    return os.path.join(PDF_DIR, pdf_utils.nome_file_pdf(numero, data_f, tipo_xml_codice))
+
+                if not numero_da_assegnare and db_utils.trova_documento(numero, data_f, tipo_xml_codice) not in (None, st.session_state.fattura_in_modifica):
+                    st.error(f"⚠️ Esiste già un documento {numero} del {data_f.strftime('%d/%m/%Y')}")
                 else:
-                    mask = st.session_state.clienti["Denominazione"] == cliente_corrente["Denominazione"]
-                    for campo in ["PIVA", "CF", "Indirizzo", "CAP", "Comune", "Provincia", "CodiceDestinatario", "PEC"]:
-                        st.session_state.clienti.loc[mask, campo] = cliente_corrente[campo]
+                    if cliente_corrente["Denominazione"] not in st.session_state.clienti["Denominazione"].tolist():
+                        db_utils.salva_controparte({**cliente_corrente, "Tipo": "Cliente"})
+                    else:
+                        db_utils.salva_controparte(cliente_corrente)
 
-                pdf_bytes = genera_pdf_fattura(
+                    documento = {
+                        "Data": data_f,
+                        "Controparte": cliente_corrente["Denominazione"],
+                        "Imponibile": imponibile,
+                        "IVA": iva_tot,
+                        "Importo": totale,
+                        "TipoXML": tipo_xml_codice,
+                        "Stato": stato,
+                    }
+                    # il PDF si scrive solo dopo il salvataggio: un duplicato non tocca file altrui
+                    try:
+                        if st.session_state.modalita_modifica:
+                            db_utils.aggiorna_documento(
+                                st.session_state.fattura_in_modifica,
+                                {**documento, "PDF": percorso_pdf(numero)},
+                                righe=st.session_state.righe_correnti,
+                            )
+                        elif numero_da_assegnare:
+                            _, numero = db_utils.inserisci_con_numero(
+                                {**documento, "Tipo": "Emessa", "UUID": ""},
+                                righe=st.session_state.righe_correnti,
+                                serie=db_utils.serie_per_tipo(tipo_xml_codice),
+                                pdf=percorso_pdf,
+                            )
+                        else:
+                            db_utils.inserisci_documento(
+                                {**documento, "Tipo": "Emessa", "Numero": numero, "UUID": "", "PDF": percorso_pdf(numero)},
+                                righe=st.session_state.righe_correnti,
+                            )
+                        salvato = True
+                    except db_utils.DocumentoDuplicato as e:
+                        st.error(f"⚠️ {e}")
+
+            if salvato:
+                pdf_path = percorso_pdf(numero)
+                pdf_filename = os.path.basename(pdf_path)
+                pdf_bytes = pdf_utils.genera_pdf_fattura(
                     numero, data_f, cliente_corrente, st.session_state.righe_correnti,
-                    imponibile, iva_tot, totale, tipo_xml_codice=tipo_xml_codice,
+                    imponibile, iva_tot, totale, emittente=st.session_state.emittente,
+                    tipo_xml_codice=tipo_xml_codice,
                     modalita_pagamento=modalita_pagamento, note=note,
                 )
-
-                pdf_filename = f"{numero.replace('/', '-')}.pdf"
-                pdf_path = os.path.join(PDF_DIR, pdf_filename)
-                with open(pdf_path, "wb") as f:
-                    f.write(pdf_bytes)
+                pdf_utils.scrivi_pdf(pdf_path, pdf_bytes)
 
                 if st.session_state.modalita_modifica:
-                    idx = st.session_state.fattura_in_modifica
-                    # FORMATO EUROPEO
-                    st.session_state.documenti_emessi.loc[idx, "Data"] = data_f.strftime("%d/%m/%Y")
-                    st.session_state.documenti_emessi.loc[idx, "Controparte"] = cliente_corrente["Denominazione"]
-                    st.session_state.documenti_emessi.loc[idx, "Imponibile"] = imponibile
-                    st.session_state.documenti_emessi.loc[idx, "IVA"] = iva_tot
-                    st.session_state.documenti_emessi.loc[idx, "Importo"] = totale
-                    st.session_state.documenti_emessi.loc[idx, "TipoXML"] = tipo_xml_codice
-                    st.session_state.documenti_emessi.loc[idx, "Stato"] = stato
-                    st.session_state.documenti_emessi.loc[idx, "PDF"] = pdf_path
-                    
                     st.success("✅ Fattura modificata con successo!")
-                    
+
                     st.session_state.modalita_modifica = False
                     st.session_state.fattura_in_modifica = None
                     st.session_state.righe_correnti = []
                 else:
-                    nuova = pd.DataFrame([{
-                        "Tipo": "Emessa",
-                        "Numero": numero,
-                        # FORMATO EUROPEO
-                        "Data": data_f.strftime("%d/%m/%Y"),
-                        "Controparte": cliente_corrente["Denominazione"],
-                        "Imponibile": imponibile,
-                        "IVA": iva_tot,
-                        "Importo": totale,
-                        "TipoXML": tipo_xml_codice,
-                        "Stato": stato,
-                        "UUID": "",
-                        "PDF": pdf_path,
-                    }], columns=COLONNE_DOC)
-                    st.session_state.documenti_emessi = pd.concat(
-                        [st.session_state.documenti_emessi, nuova], ignore_index=True
-                    )
                     st.session_state.righe_correnti = []
                     st.success("✅ Fattura salvata con successo!")
 
@@ -1214,12 +889,43 @@ elif pagina == "📥 Download documenti":
 
 elif pagina == "📦 Carica pacchetto AdE":
     st.subheader("📦 Carica pacchetto AdE")
-    st.info("Carica il file ZIP scaricato dal cassetto fiscale dell'Agenzia delle Entrate")
+    st.info(
+        "Carica il file ZIP scaricato dal cassetto fiscale dell'Agenzia delle Entrate "
+        "(fatture .xml e firmate .xml.p7m, anche in base64)"
+    )
     
     uploaded_zip = st.file_uploader("📁 Seleziona file ZIP", type=["zip"])
     if uploaded_zip:
         st.write("📄 File caricato:", uploaded_zip.name)
-        st.info("🔧 Parsing del pacchetto in sviluppo")
+        processi = st.number_input(
+            "Processi di analisi",
+            min_value=1,
+            max_value=2 * (os.cpu_count() or 1),
+            value=ade_utils.PROCESSI_IMPORT or os.cpu_count() or 1,
+            key="processi_import",
+        )
+        if st.button("📥 Importa fatture", key="importa_pacchetto"):
+            barra = st.progress(0.0)
+            esito = ade_utils.importa_pacchetto(
+                uploaded_zip,
+                st.session_state.emittente,
+                processi=int(processi),
+                avanzamento=lambda fatti, totale, nome: barra.progress(fatti / totale, text=nome),
+            )
+            st.success(
+                f"{esito['documenti']} documenti importati e {esito['aggiornati']} già presenti "
+                f"aggiornati da {esito['file']} file "
+                f"({esito['emesse']} emesse, {esito['ricevute']} ricevute, "
+                f"{esito['ignorati']} file ignorati) in {esito['secondi']:.1f}s "
+                f"con {esito['processi']} processi"
+            )
+            if esito["errori"]:
+                st.error(f"{len(esito['errori'])} file non importati")
+                st.dataframe(
+                    pd.DataFrame(list(esito["errori"].items()), columns=["File", "Errore"]),
+                    use_container_width=True,
+                    hide_index=True,
+                )
 
 elif pagina == "👥 Rubrica clienti":
     st.subheader("👥 Rubrica clienti e fornitori")
@@ -1242,6 +948,7 @@ elif pagina == "👥 Rubrica clienti":
                 mask.append(False)
         df_c = df_c[pd.Series(mask)]
         st.dataframe(df_c, use_container_width=True)
+        pulsanti_esportazione(df_c, "rubrica", "rubrica")
     else:
         st.info("Nessun contatto in rubrica")
 
@@ -1274,27 +981,29 @@ elif pagina == "👥 Rubrica clienti":
         tipo = st.selectbox("Tipo", ["Cliente", "Fornitore"])
 
         if st.form_submit_button("💾 Salva contatto", use_container_width=True):
-            nuovo = pd.DataFrame([{
-                "Denominazione": den,
-                "PIVA": piva,
-                "CF": cf,
-                "Indirizzo": ind,
-                "CAP": cap,
-                "Comune": com,
-                "Provincia": prov,
-                "CodiceDestinatario": cod_dest,
-                "PEC": pec,
-                "Tipo": tipo,
-            }])
-            st.session_state.clienti = pd.concat([st.session_state.clienti, nuovo], ignore_index=True)
-            st.success("✅ Contatto salvato!")
+            if not den:
+                st.error("⚠️ Inserisci la denominazione del contatto")
+            else:
+                db_utils.salva_controparte({
+                    "Denominazione": den,
+                    "PIVA": piva,
+                    "CF": cf,
+                    "Indirizzo": ind,
+                    "CAP": cap,
+                    "Comune": com,
+                    "Provincia": prov,
+                    "CodiceDestinatario": cod_dest,
+                    "PEC": pec,
+                    "Tipo": tipo,
+                })
+                st.success("✅ Contatto salvato!")
 
 else:
     st.subheader("📊 Dashboard")
 
     df_e = st.session_state.documenti_emessi
     num_emesse = len(df_e)
-    tot_emesse = df_e["Importo"].sum() if not df_e.empty else 0.0
+    tot_emesse = df_e["Importo"].sum() / 100
 
     col1, col2, col3 = st.columns(3)
     col1.metric("📄 Fatture emesse", num_emesse)
@@ -1305,11 +1014,13 @@ else:
     
     if not df_e.empty:
         st.markdown("### 📊 Ultime fatture emesse")
-        df_recenti = df_e.copy()
-        # FORMATO EUROPEO
-        df_recenti["DataSort"] = pd.to_datetime(df_recenti["Data"], format="%d/%m/%Y", errors="coerce")
-        df_recenti = df_recenti.sort_values("DataSort", ascending=False).head(5)
-        st.dataframe(df_recenti[["Numero", "Data", "Controparte", "Importo"]], use_container_width=True, hide_index=True)
+        df_recenti = df_e.sort_values("Data", ascending=False).head(5)
+        st.dataframe(
+            db_utils.importi_in_euro(df_recenti[["Numero", "Data", "Controparte", "Importo"]]),
+            use_container_width=True,
+            hide_index=True,
+            column_config={"Data": st.column_config.DateColumn("Data", format="DD/MM/YYYY")},
+        )
     
     st.markdown("---")
     st.caption("🎛️ Fisco Chiaro Consulting - Pannello di controllo | Versione 1.0 | © 2025")
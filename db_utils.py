@@ -0,0 +1,1241 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+from datetime import date, datetime
+from decimal import Decimal, ROUND_HALF_UP
+
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+import importi_utils
+
+DB_PATH = os.getenv("APPFATT_DB_PATH", "appfatt.db")
+
+COLONNE_DOC = [
+    "Tipo",
+    "Numero",
+    "Data",
+    "Controparte",
+    "Imponibile",
+    "IVA",
+    "Importo",
+    "TipoXML",
+    "Stato",
+    "UUID",
+    "PDF",
+]
+
+CLIENTI_COLONNE = [
+    "Denominazione",
+    "PIVA",
+    "CF",
+    "Indirizzo",
+    "CAP",
+    "Comune",
+    "Provincia",
+    "CodiceDestinatario",
+    "PEC",
+    "Tipo",
+]
+
+COLONNE_IMPORTI = ["Imponibile", "IVA", "Importo"]
+
+# Serie di numerazione per tipo documento XML (default: FT)
+SERIE_DEFAULT = "FT"
+SERIE_PER_TIPO = {
+    "TD04": "NC",
+}
+
+_RE_NUMERO = re.compile(r"^(?P<serie>[A-Za-z]+)(?P<anno>\d{4})(?P<seq>\d+)$")
+
+# Chiavi di periodo derivate da Data al caricamento (mai ricalcolate nelle pagine)
+COLONNE_PERIODO = ["Anno", "Mese"]
+
+# Identità del documento, fuori dal DataFrame delle liste: P.IVA/CF di chi
+# l'ha emesso ("" per i documenti propri) e identificativo SdI, se noto
+COLONNE_IDENTITA = ["Emittente", "IdSdI"]
+
+# Campi che un reimport non svuota se il documento già presente li ha valorizzati
+_CONSERVA_SE_VUOTI = ("UUID", "PDF", "IdSdI")
+
+# Tipo dei documenti passivi: esclusi da liste, riepiloghi e numerazione delle emesse
+TIPO_RICEVUTA = "Ricevuta"
+
+# Tipi delle colonne dei DataFrame documenti/ricevute: importi in centesimi
+# (int64, somme esatte), valori ripetuti come categorie (Controparte ed
+# Emittente: codici interi su un dizionario, una sola stringa per controparte)
+SCHEMA_DOC = {
+    "Tipo": "category",
+    "Numero": "object",
+    "Data": "datetime64[ns]",
+    "Controparte": "category",
+    "Imponibile": "int64",
+    "IVA": "int64",
+    "Importo": "int64",
+    "TipoXML": "category",
+    "Stato": "category",
+    "UUID": "object",
+    "PDF": "object",
+    "Anno": "int16",
+    "Mese": "int8",
+    "Emittente": "category",
+    "IdSdI": "object",
+}
+
+# Gli importi sono salvati in centesimi (INTEGER), la data in formato ISO
+# (YYYY-MM-DD) così che l'indice su Data sia ordinabile.
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documenti (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    Tipo        TEXT    NOT NULL DEFAULT '',
+    Numero      TEXT    NOT NULL,
+    Data        TEXT    NOT NULL,
+    Controparte TEXT    NOT NULL DEFAULT '',
+    Imponibile  INTEGER NOT NULL DEFAULT 0,
+    IVA         INTEGER NOT NULL DEFAULT 0,
+    Importo     INTEGER NOT NULL DEFAULT 0,
+    TipoXML     TEXT    NOT NULL DEFAULT 'TD01',
+    Stato       TEXT    NOT NULL DEFAULT 'Creazione',
+    UUID        TEXT    NOT NULL DEFAULT '',
+    PDF         TEXT    NOT NULL DEFAULT '',
+    Emittente   TEXT    NOT NULL DEFAULT '',
+    IdSdI       TEXT    NOT NULL DEFAULT '',
+    Chiave      TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_documenti_numero ON documenti(Numero);
+CREATE INDEX IF NOT EXISTS idx_documenti_data ON documenti(Data);
+CREATE INDEX IF NOT EXISTS idx_documenti_controparte ON documenti(Controparte);
+CREATE INDEX IF NOT EXISTS idx_documenti_ordine ON documenti(Data, Numero, id);
+
+CREATE TABLE IF NOT EXISTS righe_documento (
+    id           INTEGER PRIMARY KEY AUTOINCREMENT,
+    documento_id INTEGER NOT NULL REFERENCES documenti(id) ON DELETE CASCADE,
+    linea        INTEGER NOT NULL,
+    descrizione  TEXT    NOT NULL DEFAULT '',
+    quantita     REAL    NOT NULL DEFAULT 0,
+    prezzo       REAL    NOT NULL DEFAULT 0,
+    aliquota_iva REAL    NOT NULL DEFAULT 22,
+    natura       TEXT    NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS idx_righe_documento ON righe_documento(documento_id, linea);
+
+-- Riepilogo IVA di ogni documento (una voce per aliquota/natura), riscritto
+-- insieme alle righe: il registro per aliquota si somma da qui
+CREATE TABLE IF NOT EXISTS riepilogo_iva (
+    documento_id INTEGER NOT NULL REFERENCES documenti(id) ON DELETE CASCADE,
+    aliquota     REAL    NOT NULL,
+    natura       TEXT    NOT NULL DEFAULT '',
+    imponibile   INTEGER NOT NULL DEFAULT 0,
+    imposta      INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (documento_id, aliquota, natura)
+);
+
+CREATE TABLE IF NOT EXISTS controparti (
+    id                 INTEGER PRIMARY KEY AUTOINCREMENT,
+    Denominazione      TEXT NOT NULL UNIQUE,
+    PIVA               TEXT NOT NULL DEFAULT '',
+    CF                 TEXT NOT NULL DEFAULT '',
+    Indirizzo          TEXT NOT NULL DEFAULT '',
+    CAP                TEXT NOT NULL DEFAULT '',
+    Comune             TEXT NOT NULL DEFAULT '',
+    Provincia          TEXT NOT NULL DEFAULT '',
+    CodiceDestinatario TEXT NOT NULL DEFAULT '',
+    PEC                TEXT NOT NULL DEFAULT '',
+    Tipo               TEXT NOT NULL DEFAULT ''
+);
+
+CREATE TABLE IF NOT EXISTS sequenze (
+    serie  TEXT    NOT NULL,
+    anno   INTEGER NOT NULL,
+    ultimo INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (serie, anno)
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    chiave TEXT PRIMARY KEY,
+    valore INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta (chiave, valore) VALUES ('documenti', 0);
+INSERT OR IGNORE INTO meta (chiave, valore) VALUES ('controparti', 0);
+"""
+
+# Colonne aggiunte dopo la prima versione dello schema (archivi esistenti)
+_COLONNE_AGGIUNTE = {
+    "Emittente": "TEXT NOT NULL DEFAULT ''",
+    "IdSdI": "TEXT NOT NULL DEFAULT ''",
+    "Chiave": "TEXT",
+}
+
+# Chiave = hash di (emittente, numero, data, tipo documento); l'indice su
+# IdSdI è parziale perché i documenti creati nell'app non lo hanno
+_SCHEMA_IDENTITA = """
+CREATE UNIQUE INDEX IF NOT EXISTS idx_documenti_chiave ON documenti(Chiave);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_documenti_sdi ON documenti(IdSdI) WHERE IdSdI <> '';
+"""
+
+# Indici parziali del ciclo passivo: solo le righe delle ricevute, per mese
+# (Data) e per fornitore (Emittente). Il tipo è letterale perché SQLite usa
+# un indice parziale solo se la query ripete la stessa condizione.
+_FILTRO_RICEVUTE = f"Tipo = '{TIPO_RICEVUTA}'"
+_SCHEMA_RICEVUTE = f"""
+CREATE INDEX IF NOT EXISTS idx_ricevute_data ON documenti(Data, id) WHERE {_FILTRO_RICEVUTE};
+CREATE INDEX IF NOT EXISTS idx_ricevute_fornitore ON documenti(Emittente, Data) WHERE {_FILTRO_RICEVUTE};
+"""
+
+# Colonne del DataFrame delle ricevute (le liste delle emesse non le usano)
+COLONNE_RICEVUTE = COLONNE_DOC + COLONNE_IDENTITA
+
+# Tipi documento che stornano l'IVA (note di credito): entrano nei periodi con segno meno
+TIPI_STORNO = ("TD04", "TD08")
+# Gli stessi tipi come lista SQL letterale, per trigger e query dei periodi
+_SQL_TIPI_STORNO = "(" + ", ".join(f"'{t}'" for t in TIPI_STORNO) + ")"
+
+
+def _segno_storno(doc: str) -> str:
+    """Espressione SQL -1/1 per i documenti di `doc` che stornano l'IVA."""
+    return f"(CASE WHEN {doc}.TipoXML IN {_SQL_TIPI_STORNO} THEN -1 ELSE 1 END)"
+
+
+def _voce_periodo(doc: str, fattore: str, imponibile: str, imposta: str, origine: str) -> str:
+    """
+    Upsert nei totali per periodo di una voce del documento `doc` (NEW, OLD o
+    documenti). Un'istruzione sola, senza ";" finale.
+    """
+    segno = _segno_storno(doc)
+    return f"""
+    INSERT INTO iva_periodi (anno, mese, ricevute, imponibile, imposta)
+    SELECT CAST(substr({doc}.Data, 1, 4) AS INTEGER), CAST(substr({doc}.Data, 6, 2) AS INTEGER),
+           {doc}.Tipo = '{TIPO_RICEVUTA}', {fattore} * {segno} * {imponibile}, {fattore} * {segno} * {imposta}
+    {origine}
+    ON CONFLICT (anno, mese, ricevute) DO UPDATE SET
+        imponibile = imponibile + excluded.imponibile,
+        imposta = imposta + excluded.imposta"""
+
+
+# Totali IVA per mese (ricevute = 0 vendite, 1 acquisti), tenuti allineati dai
+# trigger a ogni scrittura del riepilogo IVA o cambio di data/tipo di un
+# documento: la liquidazione legge poche righe invece di tutto l'archivio.
+# Un documento eliminato toglie prima il proprio riepilogo (il suo periodo
+# è ancora leggibile), poi il cascade non trova più nulla.
+_SCHEMA_PERIODI_IVA = f"""
+CREATE TABLE IF NOT EXISTS iva_periodi (
+    anno       INTEGER NOT NULL,
+    mese       INTEGER NOT NULL,
+    ricevute   INTEGER NOT NULL,
+    imponibile INTEGER NOT NULL DEFAULT 0,
+    imposta    INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (anno, mese, ricevute)
+) WITHOUT ROWID;
+
+CREATE TRIGGER IF NOT EXISTS trg_periodi_riepilogo_ins AFTER INSERT ON riepilogo_iva BEGIN
+{_voce_periodo("documenti", "1", "NEW.imponibile", "NEW.imposta", "FROM documenti WHERE documenti.id = NEW.documento_id")};
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_periodi_riepilogo_del AFTER DELETE ON riepilogo_iva BEGIN
+{_voce_periodo("documenti", "-1", "OLD.imponibile", "OLD.imposta", "FROM documenti WHERE documenti.id = OLD.documento_id")};
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_periodi_documento_del BEFORE DELETE ON documenti BEGIN
+    DELETE FROM riepilogo_iva WHERE documento_id = OLD.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_periodi_documento_upd AFTER UPDATE OF Data, Tipo, TipoXML ON documenti
+WHEN OLD.Data <> NEW.Data OR OLD.Tipo <> NEW.Tipo OR OLD.TipoXML <> NEW.TipoXML BEGIN
+{_voce_periodo("OLD", "-1", "SUM(imponibile)", "SUM(imposta)", "FROM riepilogo_iva WHERE documento_id = OLD.id GROUP BY documento_id")};
+{_voce_periodo("NEW", "1", "SUM(imponibile)", "SUM(imposta)", "FROM riepilogo_iva WHERE documento_id = NEW.id GROUP BY documento_id")};
+END;
+"""
+
+
+class DocumentoDuplicato(ValueError):
+    """Esiste già un documento con la stessa chiave naturale o lo stesso identificativo SdI."""
+
+_lock = threading.RLock()
+_conn = None
+
+# Cache in memoria dei DataFrame, invalidata dal contatore di versione
+_cache = {}
+
+
+# ==========================
+# CONNESSIONE
+# ==========================
+def _get_conn() -> sqlite3.Connection:
+    """Connessione unica per processo, creata (con lo schema) al primo uso."""
+    global _conn
+    with _lock:
+        if _conn is None:
+            cartella = os.path.dirname(os.path.abspath(DB_PATH))
+            os.makedirs(cartella, exist_ok=True)
+            conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            conn.executescript(_SCHEMA)
+            _migra_identita(conn)
+            conn.executescript(_SCHEMA_RICEVUTE)
+            _migra_riepilogo(conn)
+            _migra_periodi_iva(conn)
+            conn.commit()
+            _conn = conn
+        return _conn
+
+
+def _migra_identita(conn: sqlite3.Connection) -> None:
+    """
+    Aggiunge le colonne di identità agli archivi esistenti e calcola la chiave
+    dei documenti che non l'hanno ancora. Dei duplicati già presenti solo il
+    primo riceve la chiave: gli altri restano senza, come prima dell'indice.
+    """
+    presenti = {riga[1] for riga in conn.execute("PRAGMA table_info(documenti)")}
+    for colonna, tipo in _COLONNE_AGGIUNTE.items():
+        if colonna not in presenti:
+            conn.execute(f"ALTER TABLE documenti ADD COLUMN {colonna} {tipo}")
+
+    senza_chiave = conn.execute(
+        "SELECT id, Emittente, Numero, Data, TipoXML FROM documenti "
+        "WHERE Chiave IS NULL ORDER BY id"
+    ).fetchall()
+    if senza_chiave:
+        usate = {k for (k,) in conn.execute("SELECT Chiave FROM documenti WHERE Chiave IS NOT NULL")}
+        nuove = []
+        for doc_id, emittente, numero, data_doc, tipo_xml in senza_chiave:
+            chiave = chiave_documento(numero, data_doc, tipo_xml, emittente)
+            if chiave not in usate:
+                usate.add(chiave)
+                nuove.append((chiave, doc_id))
+        conn.executemany("UPDATE documenti SET Chiave = ? WHERE id = ?", nuove)
+    conn.executescript(_SCHEMA_IDENTITA)
+
+
+def _migra_riepilogo(conn: sqlite3.Connection) -> None:
+    """
+    Aggiunge la natura alle righe degli archivi esistenti e calcola il
+    riepilogo IVA dei documenti che non l'hanno ancora (tutti insieme).
+    """
+    presenti = {riga[1] for riga in conn.execute("PRAGMA table_info(righe_documento)")}
+    if "natura" not in presenti:
+        conn.execute("ALTER TABLE righe_documento ADD COLUMN natura TEXT NOT NULL DEFAULT ''")
+    mancanti = [
+        doc_id for (doc_id,) in conn.execute(
+            "SELECT id FROM documenti WHERE id NOT IN (SELECT documento_id FROM riepilogo_iva)"
+        )
+    ]
+    if mancanti:
+        _scrivi_riepiloghi(conn, _righe_documenti(conn, mancanti))
+
+
+def _migra_periodi_iva(conn: sqlite3.Connection) -> None:
+    """Crea totali e trigger dei periodi IVA; su un archivio esistente li calcola una volta."""
+    conn.executescript(_SCHEMA_PERIODI_IVA)
+    if conn.execute("SELECT 1 FROM iva_periodi LIMIT 1").fetchone() is None:
+        ricalcola_periodi_iva(conn)
+
+
+def ricalcola_periodi_iva(conn: sqlite3.Connection = None) -> None:
+    """
+    Ricostruisce da zero i totali per periodo dal riepilogo IVA (migrazione
+    o verifica); nel normale funzionamento li aggiornano i trigger.
+    """
+    with _lock:
+        conn = conn or _get_conn()
+        with conn:
+            conn.execute("DELETE FROM iva_periodi")
+            conn.execute(
+                _voce_periodo(
+                    "d", "1", "SUM(r.imponibile)", "SUM(r.imposta)",
+                    "FROM riepilogo_iva r JOIN documenti d ON d.id = r.documento_id "
+                    f"GROUP BY 1, 2, 3, d.TipoXML IN {_SQL_TIPI_STORNO}",
+                )
+            )
+
+
+def _incrementa_versione(conn: sqlite3.Connection, tabella: str) -> None:
+    conn.execute("UPDATE meta SET valore = valore + 1 WHERE chiave = ?", (tabella,))
+
+
+def versione_dati(tabella: str = "documenti") -> int:
+    """Contatore incrementato a ogni scrittura sulla tabella: invalida le cache."""
+    with _lock:
+        row = _get_conn().execute(
+            "SELECT valore FROM meta WHERE chiave = ?", (tabella,)
+        ).fetchone()
+    return int(row[0]) if row else 0
+
+
+# ==========================
+# CONVERSIONI
+# ==========================
+def centesimi(val) -> int:
+    """Importo in euro (numero, Decimal o testo) in centesimi interi, arrotondamento commerciale."""
+    if val is None or val == "":
+        return 0
+    return int((Decimal(str(val)) * 100).quantize(Decimal("1"), rounding=ROUND_HALF_UP))
+
+
+def _data_iso(val) -> str:
+    """Accetta date, datetime, 'DD/MM/YYYY' o 'YYYY-MM-DD' e restituisce l'ISO."""
+    if isinstance(val, datetime):
+        return val.date().isoformat()
+    if isinstance(val, date):
+        return val.isoformat()
+    testo = str(val or "").strip()
+    for fmt in ("%d/%m/%Y", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(testo[:10], fmt).date().isoformat()
+        except ValueError:
+            continue
+    raise ValueError(f"Data documento non valida: {val!r}")
+
+
+def euro(centesimi) -> Decimal:
+    """Importo in euro (Decimal esatto) da centesimi interi."""
+    return Decimal(int(centesimi)).scaleb(-2)
+
+
+def _valori_documento(doc: dict) -> dict:
+    valori = {}
+    for col in COLONNE_DOC + COLONNE_IDENTITA:
+        if col not in doc:
+            continue
+        val = doc[col]
+        if col in COLONNE_IMPORTI:
+            valori[col] = centesimi(val)
+        elif col == "Data":
+            valori[col] = _data_iso(val)
+        else:
+            valori[col] = "" if val is None or pd.isna(val) else str(val)
+    return valori
+
+
+def chiave_documento(numero: str, data_doc, tipo_xml: str = "TD01", emittente: str = "") -> str:
+    """Hash della chiave naturale del documento (emittente, numero, data, tipo XML)."""
+    parti = [
+        (emittente or "").strip().upper(),
+        (numero or "").strip().upper(),
+        _data_iso(data_doc),
+        (tipo_xml or "TD01").strip().upper(),
+    ]
+    return hashlib.blake2b("\x1f".join(parti).encode(), digest_size=16).hexdigest()
+
+
+def _valori_con_chiave(doc: dict) -> dict:
+    valori = _valori_documento(doc)
+    valori["Chiave"] = chiave_documento(
+        valori["Numero"], valori["Data"], valori.get("TipoXML", "TD01"), valori.get("Emittente", "")
+    )
+    return valori
+
+
+def _duplicato(valori: dict) -> DocumentoDuplicato:
+    return DocumentoDuplicato(
+        f"Documento {valori.get('Numero', '')} del {valori.get('Data', '')} già presente"
+    )
+
+
+def _cerca_documento(conn: sqlite3.Connection, valori: dict):
+    """Id del documento con la stessa chiave o lo stesso IdSdI (ricerche sugli indici univoci)."""
+    riga = conn.execute("SELECT id FROM documenti WHERE Chiave = ?", (valori["Chiave"],)).fetchone()
+    if riga is None and valori.get("IdSdI"):
+        riga = conn.execute(
+            "SELECT id FROM documenti WHERE IdSdI = ? AND IdSdI <> ''", (valori["IdSdI"],)
+        ).fetchone()
+    return riga[0] if riga else None
+
+
+def _scrivi_righe(conn: sqlite3.Connection, doc_id: int, righe: list) -> None:
+    conn.execute("DELETE FROM righe_documento WHERE documento_id = ?", (doc_id,))
+    conn.executemany(
+        "INSERT INTO righe_documento "
+        "(documento_id, linea, descrizione, quantita, prezzo, aliquota_iva, natura) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [
+            (
+                doc_id,
+                i,
+                r.get("desc", "") or "",
+                float(r.get("qta", 0) or 0),
+                float(r.get("prezzo", 0) or 0),
+                float(r.get("iva", 22) or 0),
+                (r.get("natura", "") or "") if not float(r.get("iva", 22) or 0) else "",
+            )
+            for i, r in enumerate(righe, start=1)
+        ],
+    )
+
+
+def _scrivi_riepiloghi(conn: sqlite3.Connection, righe_per_documento: dict, espliciti: dict = None) -> None:
+    """
+    Riscrive il riepilogo IVA di più documenti (id -> righe) calcolandolo
+    dalle righe in un solo passaggio (importi_utils.riepilogo_aliquote).
+    `espliciti` (id -> voci {aliquota, natura, imponibile, imposta} in euro,
+    es. i DatiRiepilogo di un XML importato) ha la precedenza sulle righe.
+    Un documento senza righe né voci riceve una sola voce con i totali
+    salvati e l'aliquota che ne deriva.
+    """
+    espliciti = espliciti or {}
+    ids = [int(i) for i in righe_per_documento]
+    voci = [
+        (int(doc_id), float(v["aliquota"] or 0), v.get("natura", "") or "",
+         centesimi(v["imponibile"]), centesimi(v["imposta"]))
+        for doc_id, elenco in espliciti.items()
+        for v in elenco
+    ]
+    da_righe = {
+        i: righe for i, righe in righe_per_documento.items()
+        if righe and not espliciti.get(i)
+    }
+    if da_righe:
+        riepilogo = importi_utils.riepilogo_aliquote(importi_utils.righe_frame(da_righe))
+        voci += zip(
+            riepilogo["documento"].tolist(), riepilogo["Aliquota"].tolist(),
+            riepilogo["Natura"].tolist(), riepilogo["Imponibile"].tolist(), riepilogo["IVA"].tolist(),
+        )
+    senza = [i for i in ids if i not in da_righe and not espliciti.get(i)]
+    for i in range(0, len(senza), 500):
+        blocco = senza[i:i + 500]
+        for doc_id, imponibile, imposta in conn.execute(
+            f"SELECT id, Imponibile, IVA FROM documenti WHERE id IN ({', '.join('?' * len(blocco))})",
+            blocco,
+        ):
+            voci.append((doc_id, importi_utils.aliquota_media(imponibile, imposta), "", imponibile, imposta))
+    for i in range(0, len(ids), 500):
+        blocco = ids[i:i + 500]
+        conn.execute(
+            f"DELETE FROM riepilogo_iva WHERE documento_id IN ({', '.join('?' * len(blocco))})",
+            blocco,
+        )
+    conn.executemany(
+        "INSERT INTO riepilogo_iva (documento_id, aliquota, natura, imponibile, imposta) "
+        "VALUES (?, ?, ?, ?, ?)",
+        voci,
+    )
+
+
+# ==========================
+# SCHEMA DEI DATAFRAME
+# ==========================
+def _tipo_conforme(dtype, tipo: str) -> bool:
+    """Testi e date sono conformi in qualunque variante (object/str, unità ns/us)."""
+    if tipo == "object":
+        return pd.api.types.is_string_dtype(dtype) and not isinstance(dtype, pd.CategoricalDtype)
+    if tipo.startswith("datetime64"):
+        return pd.api.types.is_datetime64_dtype(dtype)
+    return dtype == tipo
+
+
+def applica_schema(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Converte le colonne presenti in SCHEMA_DOC al loro tipo (le altre restano
+    com'erano). Non copia le colonne già del tipo giusto. Gli importi non interi
+    sono letti come euro e portati in centesimi; la data accetta anche orari e
+    GG/MM/AAAA.
+    """
+    conversioni = {
+        col: tipo for col, tipo in SCHEMA_DOC.items()
+        if col in df.columns and not _tipo_conforme(df[col].dtype, tipo)
+    }
+    if not conversioni:
+        return df
+    df = df.copy(deep=False)
+    for col, tipo in conversioni.items():
+        if col == "Data":
+            df[col] = _date_documenti(df[col])
+        elif tipo == "category":
+            df[col] = df[col].fillna("").astype(str).astype("category")
+        elif tipo == "object":
+            df[col] = df[col].fillna("").astype(str)
+        elif col in COLONNE_IMPORTI and not pd.api.types.is_integer_dtype(df[col].dtype):
+            # importi in euro (float o testo): centesimi con arrotondamento, non troncati
+            df[col] = df[col].fillna(0).map(centesimi).astype(tipo)
+        else:
+            df[col] = df[col].fillna(0).astype(tipo)
+    return df
+
+
+def _date_documenti(serie: pd.Series) -> pd.Series:
+    """Date ISO in un passaggio; con orari, GG/MM/AAAA o oggetti data una voce alla volta come _data_iso."""
+    try:
+        return pd.to_datetime(serie, format="%Y-%m-%d")
+    except (ValueError, TypeError):
+        return pd.to_datetime(serie.map(_data_iso, na_action="ignore"), format="%Y-%m-%d")
+
+
+def importi_in_euro(df: pd.DataFrame) -> pd.DataFrame:
+    """Copia con gli importi in euro (float), per le tabelle a video e l'Excel."""
+    df = df.copy(deep=False)
+    for col in COLONNE_IMPORTI:
+        if col in df.columns:
+            df[col] = df[col] / 100
+    return df
+
+
+def documenti_vuoti(colonne: list = None) -> pd.DataFrame:
+    """DataFrame senza righe con i tipi di SCHEMA_DOC (default: COLONNE_DOC + COLONNE_PERIODO)."""
+    colonne = colonne or COLONNE_DOC + COLONNE_PERIODO
+    return pd.DataFrame(
+        {col: pd.Series(dtype=SCHEMA_DOC.get(col, "object")) for col in colonne}
+    )
+
+
+def concatena_documenti(parti: list, ignore_index: bool = False) -> pd.DataFrame:
+    """
+    pd.concat che conserva lo schema: le categorie di ogni colonna vengono
+    unite prima della concatenazione (altrimenti pandas ripiega su object).
+    """
+    parti = [applica_schema(p) for p in parti]
+    if not parti:
+        return documenti_vuoti()
+    categoriche = [
+        col for col in parti[0].columns
+        if all(col in p.columns and isinstance(p[col].dtype, pd.CategoricalDtype) for p in parti)
+    ]
+    if categoriche and len(parti) > 1:
+        parti = [p.copy(deep=False) for p in parti]
+        for col in categoriche:
+            categorie = union_categoricals([p[col] for p in parti]).categories
+            for p in parti:
+                p[col] = p[col].cat.set_categories(categorie)
+    df = pd.concat(parti, ignore_index=ignore_index)
+    for col in COLONNE_IMPORTI:
+        # parti già in centesimi: i NaN vengono solo dalle parti senza la colonna
+        if col in df.columns and not pd.api.types.is_integer_dtype(df[col].dtype):
+            df[col] = df[col].fillna(0).astype("int64")
+    return applica_schema(df)
+
+
+# ==========================
+# DOCUMENTI
+# ==========================
+def trova_documento(numero: str, data_doc, tipo_xml: str = "TD01", emittente: str = ""):
+    """Id del documento con questa chiave naturale, oppure None."""
+    with _lock:
+        riga = _get_conn().execute(
+            "SELECT id FROM documenti WHERE Chiave = ?",
+            (chiave_documento(numero, data_doc, tipo_xml, emittente),),
+        ).fetchone()
+    return riga[0] if riga else None
+
+
+def _inserisci(conn: sqlite3.Connection, valori: dict) -> int:
+    colonne = list(valori)
+    return conn.execute(
+        f"INSERT INTO documenti ({', '.join(colonne)}) "
+        f"VALUES ({', '.join('?' for _ in colonne)})",
+        [valori[c] for c in colonne],
+    ).lastrowid
+
+
+def _inserisci_documento(conn: sqlite3.Connection, valori: dict, righe: list) -> int:
+    try:
+        doc_id = _inserisci(conn, valori)
+    except sqlite3.IntegrityError:
+        raise _duplicato(valori) from None
+    if valori.get("Tipo") != TIPO_RICEVUTA:
+        _registra_numero(conn, valori.get("Numero", ""))
+    if righe:
+        _scrivi_righe(conn, doc_id, righe)
+    _scrivi_riepiloghi(conn, {doc_id: righe or []})
+    _incrementa_versione(conn, "documenti")
+    return doc_id
+
+
+def inserisci_documento(doc: dict, righe: list = None) -> int:
+    """
+    Inserisce un documento (con righe e riepilogo IVA) e restituisce l'id assegnato.
+    Solleva DocumentoDuplicato se la chiave naturale o l'IdSdI esistono già.
+    Le ricevute non toccano le sequenze di numerazione delle emesse.
+    """
+    valori = _valori_con_chiave(doc)
+    with _lock:
+        conn = _get_conn()
+        with conn:
+            doc_id = _inserisci_documento(conn, valori, righe)
+    return doc_id
+
+
+def inserisci_con_numero(doc: dict, righe: list = None, serie: str = SERIE_DEFAULT, pdf=None) -> tuple:
+    """
+    Come inserisci_documento, con il numero successivo della serie (anno della
+    data del documento) riservato nella stessa transazione: se l'inserimento
+    fallisce il numero non viene consumato. `pdf(numero)`, facoltativa, dà il
+    percorso del PDF da salvare nel documento. Restituisce (id, numero).
+    """
+    anno = int(_data_iso(doc["Data"])[:4])
+    with _lock:
+        conn = _get_conn()
+        with conn:
+            numero = _assegna_numero(conn, serie, anno)
+            doc = {**doc, "Numero": numero}
+            if pdf is not None:
+                doc["PDF"] = pdf(numero)
+            doc_id = _inserisci_documento(conn, _valori_con_chiave(doc), righe)
+    return doc_id, numero
+
+
+def inserisci_documenti(documenti) -> tuple:
+    """
+    Inserimento massivo idempotente di (documento, righe[, riepilogo]) in una
+    sola transazione: un documento già presente (stessa chiave naturale o
+    stesso IdSdI, cercati sugli indici univoci) viene aggiornato invece che
+    duplicato, senza svuotare UUID, PDF e IdSdI già valorizzati.
+    Il riepilogo IVA facoltativo (voci {aliquota, natura, imponibile, imposta})
+    prevale su quello calcolato dalle righe; i riepiloghi di tutto il blocco
+    sono scritti insieme. Un documento trovato per IdSdI la cui nuova chiave
+    naturale appartiene già a un altro documento non viene toccato: il blocco
+    prosegue e il conflitto viene riportato.
+    Restituisce (inseriti, aggiornati, conflitti: posizione nel blocco -> messaggio).
+    Le ricevute non toccano le sequenze di numerazione delle emesse.
+    """
+    inseriti = aggiornati = 0
+    conflitti = {}
+    righe_per_documento, espliciti = {}, {}
+    with _lock:
+        conn = _get_conn()
+        with conn:
+            for posizione, (doc, righe, *riepilogo) in enumerate(documenti):
+                valori = _valori_con_chiave(doc)
+                doc_id = _cerca_documento(conn, valori)
+                if doc_id is None:
+                    doc_id = _inserisci(conn, valori)
+                    inseriti += 1
+                else:
+                    campi = {
+                        c: v for c, v in valori.items()
+                        if v != "" or c not in _CONSERVA_SE_VUOTI
+                    }
+                    try:
+                        conn.execute(
+                            f"UPDATE documenti SET {', '.join(f'{c} = ?' for c in campi)} WHERE id = ?",
+                            [*campi.values(), doc_id],
+                        )
+                    except sqlite3.IntegrityError:
+                        # annullata solo questa istruzione, la transazione del blocco resta valida
+                        conflitti[posizione] = str(_duplicato(valori))
+                        continue
+                    aggiornati += 1
+                if valori.get("Tipo") != TIPO_RICEVUTA:
+                    _registra_numero(conn, valori.get("Numero", ""))
+                if righe:
+                    _scrivi_righe(conn, doc_id, righe)
+                righe_per_documento[doc_id] = righe or []
+                if riepilogo and riepilogo[0]:
+                    espliciti[doc_id] = riepilogo[0]
+            if righe_per_documento:
+                _scrivi_riepiloghi(conn, righe_per_documento, espliciti)
+            if inseriti or aggiornati:
+                _incrementa_versione(conn, "documenti")
+    return inseriti, aggiornati, conflitti
+
+
+def aggiorna_documento(doc_id: int, campi: dict, righe: list = None) -> None:
+    """
+    Aggiorna i campi indicati; se righe non è None le sostituisce.
+    Il riepilogo IVA si ricalcola se cambiano righe o importi.
+    Solleva DocumentoDuplicato se la nuova chiave naturale appartiene a un altro documento.
+    """
+    valori = _valori_documento(campi)
+    with _lock:
+        conn = _get_conn()
+        with conn:
+            if valori:
+                assegnazioni = ", ".join(f"{c} = ?" for c in valori)
+                conn.execute(
+                    f"UPDATE documenti SET {assegnazioni} WHERE id = ?",
+                    [*valori.values(), int(doc_id)],
+                )
+                _aggiorna_chiave(conn, int(doc_id))
+            if "Numero" in valori:
+                # il Tipo salvato, non solo quello passato: le ricevute non numerano
+                tipo = conn.execute("SELECT Tipo FROM documenti WHERE id = ?", (int(doc_id),)).fetchone()
+                if tipo and tipo[0] != TIPO_RICEVUTA:
+                    _registra_numero(conn, valori["Numero"])
+            if righe is not None:
+                _scrivi_righe(conn, int(doc_id), righe)
+            if righe is not None or set(valori) & set(COLONNE_IMPORTI):
+                _scrivi_riepiloghi(conn, _righe_documenti(conn, [int(doc_id)]))
+            _incrementa_versione(conn, "documenti")
+
+
+def _aggiorna_chiave(conn: sqlite3.Connection, doc_id: int) -> None:
+    riga = conn.execute(
+        "SELECT Emittente, Numero, Data, TipoXML FROM documenti WHERE id = ?", (doc_id,)
+    ).fetchone()
+    if riga is None:
+        return
+    emittente, numero, data_doc, tipo_xml = riga
+    try:
+        conn.execute(
+            "UPDATE documenti SET Chiave = ? WHERE id = ?",
+            (chiave_documento(numero, data_doc, tipo_xml, emittente), doc_id),
+        )
+    except sqlite3.IntegrityError:
+        raise _duplicato({"Numero": numero, "Data": data_doc}) from None
+
+
+def duplica_documento(doc_id: int, numero: str = None, data_doc=None) -> tuple:
+    """
+    Copia un documento (righe comprese) con una nuova data (default: oggi),
+    leggendo gli importi dall'archivio. Senza `numero` riceve il successivo
+    della serie del suo tipo, riservato insieme all'inserimento.
+    Restituisce (nuovo id, numero).
+    """
+    with _lock:
+        riga = _get_conn().execute(
+            f"SELECT {', '.join(COLONNE_DOC)} FROM documenti WHERE id = ?", (int(doc_id),)
+        ).fetchone()
+    doc = dict(zip(COLONNE_DOC, riga))
+    for col in COLONNE_IMPORTI:
+        doc[col] = euro(doc[col])
+    doc["Data"] = data_doc or date.today()
+    if numero is None:
+        return inserisci_con_numero(doc, carica_righe(doc_id), serie_per_tipo(doc["TipoXML"]))
+    doc["Numero"] = numero
+    return inserisci_documento(doc, carica_righe(doc_id)), numero
+
+
+def elimina_documento(doc_id: int) -> None:
+    with _lock:
+        conn = _get_conn()
+        with conn:
+            conn.execute("DELETE FROM documenti WHERE id = ?", (int(doc_id),))
+            _incrementa_versione(conn, "documenti")
+
+
+def carica_documenti() -> pd.DataFrame:
+    """
+    Restituisce i documenti emessi come DataFrame (indice = id del documento,
+    colonne COLONNE_DOC + COLONNE_PERIODO con i tipi di SCHEMA_DOC: Data come
+    datetime64, importi in centesimi int64, categorie per i valori ripetuti).
+    La data si formatta solo in visualizzazione.
+    Il DataFrame è condiviso tra le sessioni: non va modificato sul posto.
+    """
+    versione = versione_dati()
+    cached = _cache.get("documenti")
+    if cached is not None and cached[0] == versione:
+        return cached[1]
+
+    with _lock:
+        df = pd.read_sql_query(
+            f"SELECT id, {', '.join(COLONNE_DOC)} FROM documenti WHERE Tipo <> ? ORDER BY id",
+            _get_conn(),
+            params=[TIPO_RICEVUTA],
+            index_col="id",
+        )
+    df = _frame_documenti(df)
+    _cache["documenti"] = (versione, df)
+    return df
+
+
+def _frame_documenti(df: pd.DataFrame) -> pd.DataFrame:
+    df = applica_schema(df)
+    df["Anno"] = df["Data"].dt.year.astype("int16")
+    df["Mese"] = df["Data"].dt.month.astype("int8")
+    return df
+
+
+def _filtro_documenti(conn: sqlite3.Connection, mese: int = None) -> tuple:
+    """
+    Condizioni WHERE per le liste delle emesse (opzionalmente di un mese).
+    Il mese diventa un intervallo Data >= inizio AND Data < fine per ogni anno
+    presente in archivio, così la ricerca usa l'indice su Data.
+    """
+    where, params = ["Tipo <> ?"], [TIPO_RICEVUTA]
+    if mese is not None:
+        mese = int(mese)
+        prima, ultima = conn.execute("SELECT MIN(Data), MAX(Data) FROM documenti").fetchone()
+        intervalli = []
+        for anno in range(int((prima or "0")[:4]), int((ultima or "0")[:4]) + 1):
+            fine = (anno + 1, 1) if mese == 12 else (anno, mese + 1)
+            intervalli.append("(Data >= ? AND Data < ?)")
+            params += [f"{anno:04d}-{mese:02d}-01", f"{fine[0]:04d}-{fine[1]:02d}-01"]
+        where.append("(" + " OR ".join(intervalli or ["0"]) + ")")
+    return where, params
+
+
+def conta_documenti(mese: int = None) -> int:
+    with _lock:
+        conn = _get_conn()
+        where, params = _filtro_documenti(conn, mese)
+        sql = "SELECT COUNT(*) FROM documenti WHERE " + " AND ".join(where)
+        return conn.execute(sql, params).fetchone()[0]
+
+
+def pagina_documenti(limite: int, dopo: tuple = None, mese: int = None) -> tuple:
+    """
+    Paginazione keyset: documenti ordinati per (Data, Numero, id) decrescenti,
+    a partire dalla chiave `dopo` (ultima riga della pagina precedente).
+    Restituisce (DataFrame come carica_documenti, chiave per la pagina
+    successiva oppure None se questa è l'ultima).
+    """
+    with _lock:
+        conn = _get_conn()
+        where, params = _filtro_documenti(conn, mese)
+        if dopo is not None:
+            where.append("(Data, Numero, id) < (?, ?, ?)")
+            params.extend(dopo)
+        sql = f"SELECT id, {', '.join(COLONNE_DOC)} FROM documenti WHERE " + " AND ".join(where)
+        sql += " ORDER BY Data DESC, Numero DESC, id DESC LIMIT ?"
+        params.append(int(limite) + 1)
+        df = pd.read_sql_query(sql, conn, params=params, index_col="id")
+
+    successiva = None
+    if len(df) > limite:
+        df = df.iloc[:limite]
+        ultima = df.iloc[-1]
+        successiva = (ultima["Data"], ultima["Numero"], int(df.index[-1]))
+    return _frame_documenti(df.copy()), successiva
+
+
+def carica_righe(doc_id: int) -> list:
+    """Righe del documento nel formato usato dall'editor ({desc, qta, prezzo, iva, natura})."""
+    return carica_righe_documenti([doc_id])[int(doc_id)]
+
+
+def _righe_documenti(conn: sqlite3.Connection, ids: list) -> dict:
+    righe = {i: [] for i in ids}
+    rows = []
+    for i in range(0, len(ids), 500):
+        blocco = ids[i:i + 500]
+        rows += conn.execute(
+            "SELECT documento_id, descrizione, quantita, prezzo, aliquota_iva, natura "
+            f"FROM righe_documento WHERE documento_id IN ({', '.join('?' * len(blocco))}) "
+            "ORDER BY documento_id, linea",
+            blocco,
+        ).fetchall()
+    for doc_id, desc, qta, prezzo, iva, natura in rows:
+        righe[doc_id].append({
+            "desc": desc, "qta": qta, "prezzo": prezzo,
+            "iva": int(iva) if iva == int(iva) else iva, "natura": natura,
+        })
+    return righe
+
+
+def carica_righe_documenti(doc_ids: list) -> dict:
+    """Righe di più documenti (query a blocchi di id): id documento -> lista righe."""
+    ids = [int(i) for i in doc_ids]
+    if not ids:
+        return {}
+    with _lock:
+        return _righe_documenti(_get_conn(), ids)
+
+
+def carica_riepiloghi_documenti(doc_ids: list) -> dict:
+    """
+    Riepilogo IVA salvato di più documenti (query a blocchi di id): id documento
+    -> voci {Aliquota, Natura, Imponibile, IVA} in centesimi, per aliquota crescente.
+    """
+    ids = [int(i) for i in doc_ids]
+    riepiloghi = {i: [] for i in ids}
+    with _lock:
+        conn = _get_conn()
+        for i in range(0, len(ids), 500):
+            blocco = ids[i:i + 500]
+            for doc_id, aliquota, natura, imponibile, imposta in conn.execute(
+                "SELECT documento_id, aliquota, natura, imponibile, imposta FROM riepilogo_iva "
+                f"WHERE documento_id IN ({', '.join('?' * len(blocco))}) "
+                "ORDER BY documento_id, aliquota, natura",
+                blocco,
+            ):
+                riepiloghi[doc_id].append(
+                    {"Aliquota": aliquota, "Natura": natura, "Imponibile": imponibile, "IVA": imposta}
+                )
+    return riepiloghi
+
+
+def aggiorna_percorsi_pdf(percorsi: dict) -> None:
+    """Aggiorna il campo PDF di più documenti (id -> percorso) in una transazione."""
+    if not percorsi:
+        return
+    with _lock:
+        conn = _get_conn()
+        with conn:
+            conn.executemany(
+                "UPDATE documenti SET PDF = ? WHERE id = ?",
+                ((path, int(doc_id)) for doc_id, path in percorsi.items()),
+            )
+            _incrementa_versione(conn, "documenti")
+
+
+# ==========================
+# RICEVUTE (CICLO PASSIVO)
+# ==========================
+def carica_ricevute() -> pd.DataFrame:
+    """
+    Fatture ricevute come DataFrame (stesso formato di carica_documenti, più
+    Emittente e IdSdI), lette sull'indice parziale delle ricevute.
+    Condiviso tra le sessioni e memoizzato sulla versione dell'archivio.
+    """
+    versione = versione_dati()
+    cached = _cache.get("ricevute")
+    if cached is not None and cached[0] == versione:
+        return cached[1]
+
+    with _lock:
+        df = pd.read_sql_query(
+            f"SELECT id, {', '.join(COLONNE_RICEVUTE)} FROM documenti "
+            f"WHERE {_FILTRO_RICEVUTE} ORDER BY Data, id",
+            _get_conn(),
+            index_col="id",
+        )
+    df = _frame_documenti(df)
+    _cache["ricevute"] = (versione, df)
+    return df
+
+
+def indice_fornitori() -> pd.DataFrame:
+    """
+    Una riga per fornitore delle ricevute (P.IVA/CF in Emittente): denominazione,
+    numero di documenti, importo totale (centesimi) e data dell'ultimo documento.
+    Calcolato in SQLite sull'indice per fornitore e memoizzato.
+    """
+    versione = versione_dati()
+    cached = _cache.get("fornitori")
+    if cached is not None and cached[0] == versione:
+        return cached[1]
+
+    with _lock:
+        df = pd.read_sql_query(
+            "SELECT Emittente, MAX(Controparte) AS Fornitore, COUNT(*) AS Documenti, "
+            "SUM(Importo) AS Importo, MAX(Data) AS Ultimo "
+            f"FROM documenti WHERE {_FILTRO_RICEVUTE} GROUP BY Emittente",
+            _get_conn(),
+        )
+    df["Importo"] = df["Importo"].astype("int64")
+    df["Ultimo"] = pd.to_datetime(df["Ultimo"], format="%Y-%m-%d")
+    df = df.sort_values("Importo", ascending=False, ignore_index=True)
+    _cache["fornitori"] = (versione, df)
+    return df
+
+
+# ==========================
+# REGISTRO IVA PER ALIQUOTA
+# ==========================
+def registro_iva(anno: int, ricevute: bool = False) -> pd.DataFrame:
+    """
+    Imponibile e imposta per mese, aliquota e natura dei documenti emessi
+    dell'anno (con ricevute=True: delle fatture ricevute), sommati in SQLite
+    dal riepilogo IVA salvato con ogni documento, senza rileggere le righe.
+    Le note di credito (TIPI_STORNO) entrano con segno meno, come nei periodi IVA.
+    Colonne: Mese, Aliquota, Natura, Imponibile, IVA (centesimi). Memoizzato.
+    """
+    versione = versione_dati()
+    chiave = ("registro_iva", int(anno), bool(ricevute))
+    cached = _cache.get(chiave)
+    if cached is not None and cached[0] == versione:
+        return cached[1]
+
+    filtro = _FILTRO_RICEVUTE if ricevute else f"Tipo <> '{TIPO_RICEVUTA}'"
+    segno = _segno_storno("d")
+    with _lock:
+        df = pd.read_sql_query(
+            "SELECT CAST(strftime('%m', d.Data) AS INTEGER) AS Mese, r.aliquota AS Aliquota, "
+            f"r.natura AS Natura, SUM({segno} * r.imponibile) AS Imponibile, SUM({segno} * r.imposta) AS IVA "
+            "FROM documenti d JOIN riepilogo_iva r ON r.documento_id = d.id "
+            f"WHERE d.{filtro} AND d.Data >= ? AND d.Data < ? "
+            "GROUP BY Mese, Aliquota, Natura ORDER BY Mese, Aliquota DESC, Natura",
+            _get_conn(),
+            params=[f"{int(anno):04d}-01-01", f"{int(anno) + 1:04d}-01-01"],
+        )
+    df = df.astype({"Mese": "int8", "Aliquota": "float64", "Imponibile": "int64", "IVA": "int64"})
+    _cache[chiave] = (versione, df)
+    return df
+
+
+def periodi_iva() -> pd.DataFrame:
+    """
+    Totali IVA per mese di tutto l'archivio (tabella iva_periodi, aggiornata
+    dai trigger): anno, mese, ricevute (0 vendite, 1 acquisti), imponibile,
+    imposta in centesimi, note di credito già stornate. Memoizzato.
+    """
+    versione = versione_dati()
+    cached = _cache.get("periodi_iva")
+    if cached is not None and cached[0] == versione:
+        return cached[1]
+
+    with _lock:
+        df = pd.read_sql_query(
+            "SELECT anno, mese, ricevute, imponibile, imposta FROM iva_periodi "
+            "WHERE imponibile <> 0 OR imposta <> 0 ORDER BY anno, mese, ricevute",
+            _get_conn(),
+        )
+    df = df.astype({"anno": "int16", "mese": "int8", "ricevute": "bool", "imponibile": "int64", "imposta": "int64"})
+    _cache["periodi_iva"] = (versione, df)
+    return df
+
+
+# ==========================
+# NUMERAZIONE
+# ==========================
+def serie_per_tipo(tipo_xml: str) -> str:
+    return SERIE_PER_TIPO.get((tipo_xml or "").upper(), SERIE_DEFAULT)
+
+
+def _formatta_numero(serie: str, anno: int, seq: int) -> str:
+    return f"{serie}{anno}{seq:03d}"
+
+
+def _ultimo_in_archivio(conn: sqlite3.Connection, serie: str, anno: int) -> int:
+    """Progressivo più alto della serie già usato dai documenti emessi dell'anno."""
+    prefisso = f"{serie}{anno}"
+    # range sull'indice di Numero: prefisso <= Numero < prefisso successivo
+    limite = prefisso[:-1] + chr(ord(prefisso[-1]) + 1)
+    ultimo = 0
+    for (numero,) in conn.execute(
+        "SELECT Numero FROM documenti WHERE Numero >= ? AND Numero < ? AND Tipo <> ?",
+        (prefisso, limite, TIPO_RICEVUTA),
+    ):
+        m = _RE_NUMERO.match(numero)
+        if m and m["serie"] == serie and int(m["anno"]) == anno:
+            ultimo = max(ultimo, int(m["seq"]))
+    return ultimo
+
+
+def _inizializza_sequenza(conn: sqlite3.Connection, serie: str, anno: int) -> None:
+    """Alla prima richiesta per (serie, anno) parte dal massimo già in archivio."""
+    if conn.execute(
+        "SELECT 1 FROM sequenze WHERE serie = ? AND anno = ?", (serie, anno)
+    ).fetchone():
+        return
+    conn.execute(
+        "INSERT OR IGNORE INTO sequenze (serie, anno, ultimo) VALUES (?, ?, ?)",
+        (serie, anno, _ultimo_in_archivio(conn, serie, anno)),
+    )
+
+
+def _registra_numero(conn: sqlite3.Connection, numero: str) -> None:
+    """Porta avanti il contatore se viene salvato un numero inserito a mano o importato."""
+    m = _RE_NUMERO.match(numero or "")
+    if not m:
+        return
+    serie, anno, seq = m["serie"], int(m["anno"]), int(m["seq"])
+    _inizializza_sequenza(conn, serie, anno)
+    conn.execute(
+        "UPDATE sequenze SET ultimo = MAX(ultimo, ?) WHERE serie = ? AND anno = ?",
+        (seq, serie, anno),
+    )
+
+
+def prossimo_numero(serie: str = SERIE_DEFAULT, anno: int = None) -> str:
+    """
+    Numero proposto per la serie, senza riservarlo (per i valori di default
+    dei form). Solo letture: la sequenza viene creata da assegna_numero.
+    """
+    anno = anno or date.today().year
+    with _lock:
+        conn = _get_conn()
+        riga = conn.execute(
+            "SELECT ultimo FROM sequenze WHERE serie = ? AND anno = ?", (serie, anno)
+        ).fetchone()
+        ultimo = riga[0] if riga else _ultimo_in_archivio(conn, serie, anno)
+    return _formatta_numero(serie, anno, ultimo + 1)
+
+
+def _assegna_numero(conn: sqlite3.Connection, serie: str, anno: int) -> str:
+    """Avanza la sequenza nella transazione aperta del chiamante."""
+    _inizializza_sequenza(conn, serie, anno)
+    conn.execute(
+        "UPDATE sequenze SET ultimo = ultimo + 1 WHERE serie = ? AND anno = ?",
+        (serie, anno),
+    )
+    ultimo = conn.execute(
+        "SELECT ultimo FROM sequenze WHERE serie = ? AND anno = ?", (serie, anno)
+    ).fetchone()[0]
+    return _formatta_numero(serie, anno, ultimo)
+
+
+def assegna_numero(serie: str = SERIE_DEFAULT, anno: int = None) -> str:
+    """
+    Riserva il numero successivo della serie in una transazione: due sessioni
+    concorrenti non possono ricevere lo stesso numero. Per salvare un documento
+    con il numero successivo si usa inserisci_con_numero, che non lo consuma
+    se l'inserimento fallisce.
+    """
+    anno = anno or date.today().year
+    with _lock:
+        conn = _get_conn()
+        with conn:
+            numero = _assegna_numero(conn, serie, anno)
+    return numero
+
+
+# ==========================
+# CONTROPARTI (RUBRICA)
+# ==========================
+def salva_controparte(cliente: dict) -> None:
+    """Inserisce o aggiorna (per Denominazione) un contatto della rubrica."""
+    valori = {
+        col: "" if cliente.get(col) is None else str(cliente.get(col))
+        for col in CLIENTI_COLONNE
+        if col in cliente
+    }
+    if not valori.get("Denominazione"):
+        raise ValueError("Denominazione obbligatoria per la rubrica.")
+    colonne = list(valori)
+    aggiorna = [c for c in colonne if c != "Denominazione"]
+    set_clause = ", ".join(f"{c} = excluded.{c}" for c in aggiorna) or "Denominazione = excluded.Denominazione"
+    with _lock:
+        conn = _get_conn()
+        with conn:
+            conn.execute(
+                f"INSERT INTO controparti ({', '.join(colonne)}) "
+                f"VALUES ({', '.join('?' for _ in colonne)}) "
+                f"ON CONFLICT(Denominazione) DO UPDATE SET {set_clause}",
+                [valori[c] for c in colonne],
+            )
+            _incrementa_versione(conn, "controparti")
+
+
+def aggiungi_controparti(contatti) -> None:
+    """Aggiunge in blocco i contatti non ancora in rubrica (quelli esistenti non vengono toccati)."""
+    with _lock:
+        conn = _get_conn()
+        with conn:
+            cur = conn.executemany(
+                f"INSERT INTO controparti ({', '.join(CLIENTI_COLONNE)}) "
+                f"VALUES ({', '.join('?' for _ in CLIENTI_COLONNE)}) "
+                "ON CONFLICT(Denominazione) DO NOTHING",
+                (
+                    [str(c.get(col) or "") for col in CLIENTI_COLONNE]
+                    for c in contatti
+                    if c.get("Denominazione")
+                ),
+            )
+            if cur.rowcount:
+                _incrementa_versione(conn, "controparti")
+
+
+def carica_controparti() -> pd.DataFrame:
+    """Rubrica clienti/fornitori (condivisa tra le sessioni, sola lettura)."""
+    versione = versione_dati("controparti")
+    cached = _cache.get("controparti")
+    if cached is not None and cached[0] == versione:
+        return cached[1]
+
+    with _lock:
+        df = pd.read_sql_query(
+            f"SELECT {', '.join(CLIENTI_COLONNE)} FROM controparti ORDER BY id",
+            _get_conn(),
+        )
+    _cache["controparti"] = (versione, df)
+    return df
+
+
+def indice_controparti() -> dict:
+    """
+    Mappa Denominazione -> (PIVA, CF) per la lista documenti.
+    Ricostruita solo quando cambia la rubrica, non a ogni rerun.
+    """
+    versione = versione_dati("controparti")
+    cached = _cache.get("indice_controparti")
+    if cached is not None and cached[0] == versione:
+        return cached[1]
+
+    df = carica_controparti()
+    indice = {}
+    for den, piva, cf in zip(df["Denominazione"], df["PIVA"], df["CF"]):
+        indice.setdefault(den, ((piva or "").strip(), (cf or "").strip()))
+    _cache["indice_controparti"] = (versione, indice)
+    return indice
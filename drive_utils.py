@@ -1,129 +1,534 @@
 import os
 import io
+import hashlib
 import json
+import logging
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 
+import numpy as np
 import pandas as pd
 import streamlit as st
+import google_auth_httplib2
+import httplib2
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload, MediaIoBaseDownload
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseUpload
+
+import db_utils
+from snapshot_utils import (
+    ESTENSIONE_PARQUET,
+    MIME_PARQUET,
+    MIME_XLSX,
+    df_da_parquet,
+    excel_bytes,
+    parquet_bytes,
+)
 
 SCOPES = ["https://www.googleapis.com/auth/drive.file"]
 
+# Cartella locale che sostituisce Drive (sviluppo e prove senza credenziali)
+DRIVE_LOCALE_DIR = os.getenv("GDRIVE_LOCALE_DIR")
+
+# File caricati all'avvio della sessione: chiave di session_state -> nome su
+# Drive senza estensione (si cerca lo snapshot .parquet, poi il vecchio .xlsx)
+FILE_INIZIALI = {
+    "ricevute_emesse": "ricevute_asd_ssd",
+    "prima_nota": "prima_nota_asd_ssd",
+    "soci": "soci_asd_ssd",
+}
+
+# Validità (secondi) della mappa nome file -> id: oltre si rifà la ricerca
+TTL_FILE_ID = int(os.getenv("APPFATT_DRIVE_TTL", "300"))
+
+# Sincronizzazione incrementale: un file Parquet per mese "<base>__AAAA-MM.parquet"
+# (senza indice: stesso contenuto -> stessi byte -> stesso md5)
+SEPARATORE_PARTIZIONE = "__"
+ESTENSIONE_PARTIZIONE = ESTENSIONE_PARQUET
+PARTIZIONE_SENZA_DATA = "senza-data"
+
+# Per base: partizione -> (impronta del contenuto, md5) dell'ultimo salvataggio
+_partizioni_salvate = {}
+# Per file id: (modifiedTime, md5, DataFrame) dell'ultimo download
+_partizioni_scaricate = {}
+
+# Credenziali condivise dal processo; il client Drive (httplib2 non è
+# thread-safe) è uno per thread
+_lock = threading.Lock()
+_credenziali = None
+_per_thread = threading.local()
+
+# (folder_id, nome file) -> (file id, scadenza)
+_file_ids = {}
+
+_log = logging.getLogger(__name__)
+
+
+# ==========================
+# SERVIZIO DRIVE
+# ==========================
+def _credenziali_service_account(service_json: str):
+    """Credenziali lette una volta per processo; il token viene rinnovato quando scade."""
+    global _credenziali
+    with _lock:
+        if _credenziali is None or _credenziali[0] != service_json:
+            creds = service_account.Credentials.from_service_account_info(
+                json.loads(service_json),
+                scopes=SCOPES,
+            )
+            _credenziali = (service_json, creds)
+        creds = _credenziali[1]
+        if not creds.valid:
+            creds.refresh(google_auth_httplib2.Request(httplib2.Http()))
+    return creds
+
 
 def _get_drive_service():
-    """Restituisce (service, folder_id, error). Se error != None, Drive non è utilizzabile."""
-    service_json = os.getenv("GDRIVE_SERVICE_ACCOUNT_JSON")
+    """
+    Restituisce (service, folder_id, error). Se error != None, Drive non è utilizzabile.
+    Il client viene costruito una volta per thread (documento di discovery
+    incluso nella libreria, niente cache su disco) e riusato; con
+    GDRIVE_LOCALE_DIR si usa la cartella locale al posto di Drive.
+    """
     folder_id = os.getenv("GDRIVE_FOLDER_ID")
+    if DRIVE_LOCALE_DIR:
+        return DriveLocale(DRIVE_LOCALE_DIR), folder_id or "locale", None
 
+    service_json = os.getenv("GDRIVE_SERVICE_ACCOUNT_JSON")
     if not service_json or not folder_id:
         return None, None, "Google Drive non configurato nelle variabili ambiente."
 
     try:
-        info = json.loads(service_json)
-        creds = service_account.Credentials.from_service_account_info(
-            info,
-            scopes=SCOPES,
-        )
-        service = build("drive", "v3", credentials=creds)
-        return service, folder_id, None
+        creds = _credenziali_service_account(service_json)
+        cached = getattr(_per_thread, "servizio", None)
+        if cached is None or cached[0] is not creds:
+            service = build("drive", "v3", credentials=creds, cache_discovery=False)
+            cached = _per_thread.servizio = (creds, service)
+        return cached[1], folder_id, None
     except Exception as e:
         return None, None, f"Errore configurazione Google Drive: {e}"
 
 
-def salva_df_su_drive(df: pd.DataFrame, filename: str):
-    """Salva (o aggiorna) un file Excel su Drive con nome filename."""
-    service, folder_id, err = _get_drive_service()
-    if err:
-        # Non blocchiamo l'app se Drive non è configurato
-        return False, err
+def _non_trovato(e: Exception) -> bool:
+    return isinstance(e, HttpError) and e.resp.status == 404
 
-    buffer = io.BytesIO()
-    with pd.ExcelWriter(buffer, engine="xlsxwriter") as writer:
-        df.to_excel(writer, index=False, sheet_name="Dati")
-    buffer.seek(0)
 
-    media = MediaIoBaseUpload(
-        buffer,
-        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        resumable=False,
-    )
+def _file_id(service, folder_id: str, filename: str):
+    """Id del file nella cartella (None se non esiste), dalla mappa finché non scade il TTL."""
+    cached = _file_ids.get((folder_id, filename))
+    if cached is not None and cached[1] > time.monotonic():
+        return cached[0]
 
-    # Cerco se esiste già un file con quel nome nella cartella
     res = service.files().list(
         q=f"name='{filename}' and '{folder_id}' in parents and trashed=false",
         fields="files(id,name)",
         pageSize=1,
     ).execute()
     items = res.get("files", [])
+    file_id = items[0]["id"] if items else None
+    _ricorda_file_id(folder_id, filename, file_id)
+    return file_id
 
-    if items:
-        file_id = items[0]["id"]
-        service.files().update(fileId=file_id, media_body=media).execute()
+
+def _ricorda_file_id(folder_id: str, filename: str, file_id) -> None:
+    if file_id is None:
+        _file_ids.pop((folder_id, filename), None)
     else:
+        _file_ids[(folder_id, filename)] = (file_id, time.monotonic() + TTL_FILE_ID)
+
+
+def _carica_file(service, folder_id: str, filename: str, dati: bytes, mimetype: str, file_id) -> None:
+    """
+    Aggiorna il file con id file_id, o lo crea se file_id è None. Se l'id non
+    esiste più (file rimosso da Drive) la voce in mappa viene invalidata e il
+    file ricreato.
+    """
+    media = MediaIoBaseUpload(io.BytesIO(dati), mimetype=mimetype, resumable=False)
+    if file_id is None:
         metadata = {"name": filename, "parents": [folder_id]}
-        service.files().create(body=metadata, media_body=media).execute()
+        creato = service.files().create(body=metadata, media_body=media, fields="id").execute()
+        _ricorda_file_id(folder_id, filename, creato["id"])
+        return
+    try:
+        service.files().update(fileId=file_id, media_body=media).execute()
+    except HttpError as e:
+        if not _non_trovato(e):
+            raise
+        _ricorda_file_id(folder_id, filename, None)
+        _carica_file(service, folder_id, filename, dati, mimetype, None)
 
+
+def _scarica(service, file_id: str) -> io.BytesIO:
+    return io.BytesIO(service.files().get_media(fileId=file_id).execute())
+
+
+# ==========================
+# SALVATAGGIO / CARICAMENTO FILE
+# ==========================
+def _parquet(filename: str) -> bool:
+    return filename.lower().endswith(ESTENSIONE_PARQUET)
+
+
+def salva_df_su_drive(df: pd.DataFrame, filename: str):
+    """
+    Salva (o aggiorna) un file su Drive con nome filename: snapshot Parquet
+    (colonne tipizzate) se il nome finisce per .parquet, altrimenti Excel.
+    """
+    service, folder_id, err = _get_drive_service()
+    if err:
+        # Non blocchiamo l'app se Drive non è configurato
+        return False, err
+
+    if _parquet(filename):
+        dati, mimetype = parquet_bytes(df), MIME_PARQUET
+    else:
+        dati, mimetype = excel_bytes(df), MIME_XLSX
+
+    file_id = _file_id(service, folder_id, filename)
+    _carica_file(service, folder_id, filename, dati, mimetype, file_id)
     return True, "File salvato su Drive."
 
 
 def carica_df_da_drive(filename: str):
-    """Scarica un Excel da Drive e lo restituisce come DataFrame."""
+    """Scarica un file Parquet o Excel da Drive e lo restituisce come DataFrame."""
     service, folder_id, err = _get_drive_service()
     if err:
         return None, err
 
-    res = service.files().list(
-        q=f"name='{filename}' and '{folder_id}' in parents and trashed=false",
-        fields="files(id,name)",
-        pageSize=1,
-    ).execute()
-    items = res.get("files", [])
-
-    if not items:
+    file_id = _file_id(service, folder_id, filename)
+    if file_id is None:
         return None, "File non trovato su Drive."
 
-    file_id = items[0]["id"]
+    try:
+        fh = _scarica(service, file_id)
+    except HttpError as e:
+        if not _non_trovato(e):
+            raise
+        # id scaduto (file rimosso o ricreato): nuova ricerca
+        _ricorda_file_id(folder_id, filename, None)
+        file_id = _file_id(service, folder_id, filename)
+        if file_id is None:
+            return None, "File non trovato su Drive."
+        fh = _scarica(service, file_id)
 
-    fh = io.BytesIO()
-    request = service.files().get_media(fileId=file_id)
-    downloader = MediaIoBaseDownload(fh, request)
-    done = False
-    while not done:
-        status, done = downloader.next_chunk()
-    fh.seek(0)
+    if _parquet(filename):
+        return df_da_parquet(fh.getvalue()), None
+    return pd.read_excel(fh), None
 
-    df = pd.read_excel(fh)
-    return df, None
+
+def _carica_cronometrato(nome: str) -> tuple:
+    """(df, errore, secondi, file letto): snapshot Parquet se presente, altrimenti l'Excel."""
+    inizio = time.perf_counter()
+    filename = nome + ESTENSIONE_PARQUET
+    try:
+        df, err = carica_df_da_drive(filename)
+        if df is None:
+            filename = nome + ".xlsx"
+            df, err = carica_df_da_drive(filename)
+    except Exception as e:
+        # file illeggibile o errore di Drive: gli altri file si caricano comunque
+        df, err = None, f"{type(e).__name__}: {e}"
+    return df, err, time.perf_counter() - inizio, filename
 
 
 def carica_dati_iniziali_da_drive():
     """
-    Se esistono i file Excel su Drive, carica:
-    - ricevute_asd_ssd.xlsx  -> st.session_state.ricevute_emesse
-    - prima_nota_asd_ssd.xlsx -> st.session_state.prima_nota
-    - soci_asd_ssd.xlsx      -> st.session_state.soci
+    Se esistono i file su Drive (.parquet, altrimenti .xlsx), carica
+    (solo se mancanti o vuoti in sessione):
+    - ricevute_asd_ssd  -> st.session_state.ricevute_emesse
+    - prima_nota_asd_ssd -> st.session_state.prima_nota
+    - soci_asd_ssd      -> st.session_state.soci
+    Download e lettura dei file avvengono in parallelo (un thread per file,
+    ciascuno con il proprio client Drive): l'avvio dura quanto il file più
+    lento, non la somma. La sessione viene aggiornata in un solo passaggio
+    dal thread principale; i tempi di ogni file vanno nel log.
     Non dà errore se i file non esistono o Drive non è configurato.
     """
-    # Ricevute
-    if "ricevute_emesse" not in st.session_state or st.session_state.ricevute_emesse.empty:
-        df, err = carica_df_da_drive("ricevute_asd_ssd.xlsx")
-        if df is not None:
-            # aggiungo colonna PDF vuota (i PDF non sono salvati su Drive)
-            if "PDF" not in df.columns:
-                df["PDF"] = None
-            st.session_state.ricevute_emesse = df
+    da_caricare = {
+        chiave: filename
+        for chiave, filename in FILE_INIZIALI.items()
+        if chiave not in st.session_state or st.session_state[chiave].empty
+    }
+    if not da_caricare:
+        return
+    _, _, err = _get_drive_service()
+    if err:
+        return
+
+    inizio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(da_caricare)) as pool:
+        futuri = {
+            chiave: pool.submit(_carica_cronometrato, filename)
+            for chiave, filename in da_caricare.items()
+        }
+        esiti = {chiave: futuro.result() for chiave, futuro in futuri.items()}
 
-    # Prima nota
-    if "prima_nota" not in st.session_state or st.session_state.prima_nota.empty:
-        df, err = carica_df_da_drive("prima_nota_asd_ssd.xlsx")
-        if df is not None:
-            st.session_state.prima_nota = df
+    caricati = {}
+    for chiave, (df, err, secondi, filename) in esiti.items():
+        _log.info("Drive: %s in %.2fs%s", filename, secondi, f" ({err})" if err else "")
+        if df is None:
+            continue
+        # aggiungo colonna PDF vuota alle ricevute (i PDF non sono salvati su Drive)
+        if chiave == "ricevute_emesse" and "PDF" not in df.columns:
+            df["PDF"] = None
+        caricati[chiave] = df
+    st.session_state.update(caricati)
+    _log.info("Drive: dati iniziali caricati in %.2fs", time.perf_counter() - inizio)
 
-    # Soci
-    if "soci" not in st.session_state or st.session_state.soci.empty:
-        df, err = carica_df_da_drive("soci_asd_ssd.xlsx")
-        if df is not None:
-            st.session_state.soci = df
 
+# ==========================
+# SINCRONIZZAZIONE INCREMENTALE
+# ==========================
+def _nome_partizione(base: str, periodo: str) -> str:
+    return f"{base}{SEPARATORE_PARTIZIONE}{periodo}{ESTENSIONE_PARTIZIONE}"
+
+
+def _date(serie: pd.Series) -> pd.Series:
+    """Date ISO (o già datetime); in alternativa GG/MM/AAAA. Le non valide diventano NaT."""
+    if pd.api.types.is_datetime64_any_dtype(serie):
+        return serie
+    try:
+        return pd.to_datetime(serie, format="ISO8601")
+    except (ValueError, TypeError):
+        return pd.to_datetime(serie, dayfirst=True, errors="coerce")
+
+
+def _partizioni(df: pd.DataFrame, colonna_data: str) -> dict:
+    """
+    Periodo ("AAAA-MM" o PARTIZIONE_SENZA_DATA) -> (righe del df di quel mese,
+    impronta). L'impronta deriva da un unico hash vettoriale di tutte le righe,
+    così le partizioni invariate si riconoscono senza serializzarle.
+    """
+    if df.empty:
+        return {}
+    hash_righe = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    colonne = "|".join(map(str, df.columns)).encode()
+    if colonna_data in df.columns:
+        date = _date(df[colonna_data])
+        # AAAAMM intero (0 = senza data): evita di formattare una stringa per riga
+        mesi = (date.dt.year * 100 + date.dt.month).fillna(0).astype("int64").to_numpy()
+    else:
+        mesi = np.zeros(len(df), dtype="int64")
+
+    partizioni = {}
+    for m, posizioni in sorted(df.groupby(mesi).indices.items()):
+        periodo = f"{m // 100:04d}-{m % 100:02d}" if m else PARTIZIONE_SENZA_DATA
+        impronta = hashlib.md5(hash_righe[posizioni].tobytes() + colonne).hexdigest()
+        partizioni[periodo] = (df.iloc[posizioni], impronta)
+    return partizioni
+
+
+def _elenca_partizioni(service, folder_id: str, base: str) -> dict:
+    """Nome file -> metadati (id, md5Checksum, modifiedTime) delle partizioni remote."""
+    prefisso = base + SEPARATORE_PARTIZIONE
+    remoti, pagina = {}, None
+    while True:
+        res = service.files().list(
+            q=f"name contains '{prefisso}' and '{folder_id}' in parents and trashed=false",
+            fields="nextPageToken, files(id,name,md5Checksum,modifiedTime)",
+            pageSize=1000,
+            pageToken=pagina,
+        ).execute()
+        for f in res.get("files", []):
+            if f["name"].startswith(prefisso) and f["name"].endswith(ESTENSIONE_PARTIZIONE):
+                remoti[f["name"]] = f
+                _ricorda_file_id(folder_id, f["name"], f["id"])
+        pagina = res.get("nextPageToken")
+        if not pagina:
+            return remoti
+
+
+def salva_df_su_drive_incrementale(df: pd.DataFrame, base: str, colonna_data: str = "Data"):
+    """
+    Salva il DataFrame su Drive come partizioni mensili (<base>__AAAA-MM.parquet)
+    e carica solo quelle cambiate: le partizioni con la stessa impronta
+    dell'ultimo salvataggio non vengono nemmeno serializzate, quelle con lo
+    stesso md5 della copia remota non vengono caricate. Le partizioni remote
+    dei mesi non più presenti vengono eliminate.
+    Restituisce (ok, messaggio) come salva_df_su_drive.
+    """
+    service, folder_id, err = _get_drive_service()
+    if err:
+        return False, err
+
+    remoti = _elenca_partizioni(service, folder_id, base)
+    salvate = _partizioni_salvate.setdefault(base, {})
+    caricate = 0
+    for periodo, (parte, impronta) in _partizioni(df, colonna_data).items():
+        nome = _nome_partizione(base, periodo)
+        remoto = remoti.pop(nome, None)
+        precedente = salvate.get(nome)
+        if remoto and precedente and precedente[0] == impronta and precedente[1] == remoto.get("md5Checksum"):
+            continue
+
+        dati = parquet_bytes(parte, indice=False)
+        md5 = hashlib.md5(dati).hexdigest()
+        if not remoto or remoto.get("md5Checksum") != md5:
+            _carica_file(service, folder_id, nome, dati, MIME_PARQUET, remoto["id"] if remoto else None)
+            caricate += 1
+        salvate[nome] = (impronta, md5)
+
+    # mesi rimasti senza righe
+    for nome, remoto in remoti.items():
+        service.files().delete(fileId=remoto["id"]).execute()
+        _ricorda_file_id(folder_id, nome, None)
+        salvate.pop(nome, None)
+
+    return True, f"{caricate} partizioni aggiornate su Drive, {len(remoti)} eliminate."
+
+
+def carica_df_da_drive_incrementale(base: str):
+    """
+    Ricompone il DataFrame dalle partizioni mensili su Drive. Scarica solo
+    le partizioni il cui modifiedTime/md5 è cambiato dall'ultimo download
+    in questo processo; le altre vengono riusate dalla memoria.
+    Restituisce (df, errore) come carica_df_da_drive.
+    """
+    service, folder_id, err = _get_drive_service()
+    if err:
+        return None, err
+
+    remoti = _elenca_partizioni(service, folder_id, base)
+    if not remoti:
+        return None, "File non trovato su Drive."
+
+    parti = []
+    for nome in sorted(remoti):
+        f = remoti[nome]
+        versione = (f.get("modifiedTime"), f.get("md5Checksum"))
+        cached = _partizioni_scaricate.get(f["id"])
+        if cached is None or cached[:2] != versione:
+            df = df_da_parquet(_scarica(service, f["id"]).getvalue())
+            cached = (*versione, df)
+            _partizioni_scaricate[f["id"]] = cached
+        parti.append(cached[2])
+
+    if set(db_utils.COLONNE_DOC) <= set(parti[0].columns):
+        # documenti: categorie unite e schema conservato anche dopo la concatenazione
+        return db_utils.concatena_documenti(parti, ignore_index=True), None
+    return pd.concat(parti, ignore_index=True), None
+
+
+# ==========================
+# DRIVE LOCALE (SVILUPPO)
+# ==========================
+_RE_NOME = re.compile(r"name\s*(=|contains)\s*'([^']*)'")
+_RE_CARTELLA = re.compile(r"'([^']*)' in parents")
+
+
+class _RichiestaLocale:
+    def __init__(self, esegui):
+        self._esegui = esegui
+
+    def execute(self, num_retries: int = 0):
+        return self._esegui()
+
+
+class _FileLocali:
+    """Sottoinsieme di files() di Drive v3 usato da questo modulo, su una cartella locale."""
+
+    def __init__(self, cartella: str):
+        self._cartella = cartella
+        self._indice_path = os.path.join(cartella, "indice.json")
+
+    def _indice(self) -> dict:
+        try:
+            with open(self._indice_path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _salva_indice(self, indice: dict) -> None:
+        tmp = self._indice_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(indice, f)
+        os.replace(tmp, self._indice_path)
+
+    def _scrivi(self, file_id: str, media_body) -> dict:
+        dati = media_body.getbytes(0, media_body.size())
+        with open(os.path.join(self._cartella, file_id), "wb") as f:
+            f.write(dati)
+        return {
+            "md5Checksum": hashlib.md5(dati).hexdigest(),
+            "modifiedTime": datetime.now(timezone.utc).isoformat(timespec="microseconds"),
+        }
+
+    @staticmethod
+    def _assente(file_id: str) -> HttpError:
+        return HttpError(httplib2.Response({"status": 404}), f"File not found: {file_id}".encode())
+
+    def list(self, q: str = "", fields: str = None, pageSize: int = 100, pageToken: str = None):
+        def esegui():
+            nome, cartella = _RE_NOME.search(q), _RE_CARTELLA.search(q)
+            files = []
+            for file_id, meta in sorted(self._indice().items()):
+                if cartella and cartella.group(1) not in meta["parents"]:
+                    continue
+                if nome and not (
+                    meta["name"] == nome.group(2) if nome.group(1) == "=" else nome.group(2) in meta["name"]
+                ):
+                    continue
+                files.append({"id": file_id, **meta})
+            inizio = int(pageToken or 0)
+            pagina = {"files": files[inizio:inizio + pageSize]}
+            if inizio + pageSize < len(files):
+                pagina["nextPageToken"] = str(inizio + pageSize)
+            return pagina
+        return _RichiestaLocale(esegui)
+
+    def create(self, body: dict, media_body=None, fields: str = None):
+        def esegui():
+            file_id = uuid.uuid4().hex
+            indice = self._indice()
+            indice[file_id] = {"name": body["name"], "parents": list(body.get("parents", [])), **self._scrivi(file_id, media_body)}
+            self._salva_indice(indice)
+            return {"id": file_id}
+        return _RichiestaLocale(esegui)
+
+    def update(self, fileId: str, media_body=None, body: dict = None, fields: str = None):
+        def esegui():
+            indice = self._indice()
+            if fileId not in indice:
+                raise self._assente(fileId)
+            indice[fileId].update(self._scrivi(fileId, media_body))
+            self._salva_indice(indice)
+            return {"id": fileId}
+        return _RichiestaLocale(esegui)
+
+    def get_media(self, fileId: str):
+        def esegui():
+            if fileId not in self._indice():
+                raise self._assente(fileId)
+            with open(os.path.join(self._cartella, fileId), "rb") as f:
+                return f.read()
+        return _RichiestaLocale(esegui)
+
+    def delete(self, fileId: str):
+        def esegui():
+            indice = self._indice()
+            if indice.pop(fileId, None) is None:
+                raise self._assente(fileId)
+            self._salva_indice(indice)
+            os.remove(os.path.join(self._cartella, fileId))
+            return ""
+        return _RichiestaLocale(esegui)
+
+
+class DriveLocale:
+    """
+    Sostituto di Drive v3 su una cartella locale (GDRIVE_LOCALE_DIR): stessi
+    metodi, md5Checksum/modifiedTime e errori 404 del servizio reale, per
+    provare sincronizzazione e caricamenti senza rete né credenziali.
+    """
+
+    def __init__(self, cartella: str):
+        os.makedirs(cartella, exist_ok=True)
+        self._files = _FileLocali(cartella)
 
+    def files(self) -> _FileLocali:
+        return self._files
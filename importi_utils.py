@@ -0,0 +1,187 @@
+import math
+
+import numpy as np
+import pandas as pd
+
+# Scale intere dei dati di riga: quantità a 4 decimali, prezzi a 6 (l'editor
+# ne usa 2). Il prodotto quantità x prezzo resta in int64 fino a circa
+# 900 milioni di euro per riga.
+DECIMALI_QUANTITA = 4
+DECIMALI_PREZZO = 6
+
+# Aliquote in centesimi di punto (22% -> 2200), come AliquotaIVA a 2 decimali
+DECIMALI_ALIQUOTA = 2
+
+# Colonne attese da riepilogo_aliquote: una riga per linea di dettaglio
+# ("natura" facoltativa, considerata solo per le righe ad aliquota 0)
+COLONNE_RIGHE = ["documento", "qta", "prezzo", "iva", "natura"]
+
+# Codici Natura FatturaPA 1.2.2 per le operazioni senza IVA
+NATURE_IVA = {
+    "N1": "Escluse ex art. 15",
+    "N2.1": "Non soggette - artt. 7-7 septies",
+    "N2.2": "Non soggette - altri casi",
+    "N3.1": "Non imponibili - esportazioni",
+    "N3.2": "Non imponibili - cessioni intracomunitarie",
+    "N3.3": "Non imponibili - verso San Marino",
+    "N3.4": "Non imponibili - assimilate alle esportazioni",
+    "N3.5": "Non imponibili - dichiarazioni d'intento",
+    "N3.6": "Non imponibili - altre operazioni",
+    "N4": "Esenti",
+    "N5": "Regime del margine / IVA non esposta",
+    "N6.1": "Reverse charge - rottami",
+    "N6.2": "Reverse charge - oro e argento",
+    "N6.3": "Reverse charge - subappalto edilizia",
+    "N6.4": "Reverse charge - cessione di fabbricati",
+    "N6.5": "Reverse charge - telefoni cellulari",
+    "N6.6": "Reverse charge - prodotti elettronici",
+    "N6.7": "Reverse charge - comparto edile",
+    "N6.8": "Reverse charge - settore energetico",
+    "N6.9": "Reverse charge - altri casi",
+    "N7": "IVA assolta in altro stato UE",
+}
+
+_MAX_INT64 = float(np.iinfo(np.int64).max)
+
+
+# ==========================
+# ARROTONDAMENTO
+# ==========================
+def _interi(valori, decimali: int) -> np.ndarray:
+    """Valori decimali (float o numeri in testo) come interi alla scala 10**decimali."""
+    scalati = pd.to_numeric(pd.Series(valori), errors="coerce").fillna(0).to_numpy(dtype=float)
+    return np.rint(scalati * 10 ** decimali).astype(np.int64)
+
+
+def dividi_arrotondando(valori: np.ndarray, divisore: int) -> np.ndarray:
+    """
+    Divisione intera con arrotondamento commerciale (la metà si allontana
+    da zero), come Decimal.quantize con ROUND_HALF_UP.
+    """
+    valori = np.asarray(valori, dtype=np.int64)
+    return np.sign(valori) * ((np.abs(valori) + divisore // 2) // divisore)
+
+
+def _intero(valore, decimali: int) -> int:
+    """Come _interi per un solo valore, senza passare da pandas."""
+    try:
+        numero = float(valore)
+    except (TypeError, ValueError):
+        return 0
+    return 0 if math.isnan(numero) else round(numero * 10 ** decimali)
+
+
+def _dividi(valore: int, divisore: int) -> int:
+    """Come dividi_arrotondando per un solo intero."""
+    return (1 if valore >= 0 else -1) * ((abs(valore) + divisore // 2) // divisore)
+
+
+# ==========================
+# TOTALI DI RIGA E RIEPILOGO
+# ==========================
+def totali_riga(qta, prezzo) -> np.ndarray:
+    """PrezzoTotale di ogni riga in centesimi: quantità x prezzo arrotondato al centesimo."""
+    qta = _interi(qta, DECIMALI_QUANTITA)
+    prezzo = _interi(prezzo, DECIMALI_PREZZO)
+    if len(qta) and np.max(np.abs(qta.astype(float)) * np.abs(prezzo.astype(float))) >= _MAX_INT64:
+        raise OverflowError("Importo di riga fuori scala per il calcolo in centesimi.")
+    return dividi_arrotondando(qta * prezzo, 10 ** (DECIMALI_QUANTITA + DECIMALI_PREZZO - 2))
+
+
+def totale_riga(qta, prezzo) -> int:
+    """PrezzoTotale di una riga in centesimi (stesso arrotondamento di totali_riga)."""
+    return _dividi(
+        _intero(qta, DECIMALI_QUANTITA) * _intero(prezzo, DECIMALI_PREZZO),
+        10 ** (DECIMALI_QUANTITA + DECIMALI_PREZZO - 2),
+    )
+
+
+def riepilogo_aliquote(righe: pd.DataFrame) -> pd.DataFrame:
+    """
+    Riepilogo per (documento, aliquota, natura) delle righe di uno o più
+    documenti, in un solo passaggio vettoriale. Regole FatturaPA: Imponibile =
+    somma dei PrezzoTotale delle righe, IVA = Imponibile x aliquota arrotondata
+    al centesimo una sola volta per voce (non riga per riga). La natura
+    distingue solo le righe ad aliquota 0.
+    Colonne: documento, Aliquota (in %), Natura, Imponibile, IVA (centesimi int64).
+    """
+    aliquote = _interi(righe["iva"], DECIMALI_ALIQUOTA)
+    if "natura" in righe:
+        nature = righe["natura"].fillna("").astype(str).str.strip().to_numpy()
+        nature = np.where(aliquote == 0, nature, "")
+    else:
+        nature = np.full(len(aliquote), "")
+    gruppi = (
+        pd.DataFrame({
+            "documento": righe["documento"].to_numpy(),
+            "aliquota": aliquote,
+            "Natura": nature,
+            "Imponibile": totali_riga(righe["qta"], righe["prezzo"]),
+        })
+        .groupby(["documento", "aliquota", "Natura"], sort=True)["Imponibile"]
+        .sum()
+        .reset_index()
+    )
+    gruppi["IVA"] = dividi_arrotondando(
+        gruppi["Imponibile"].to_numpy() * gruppi["aliquota"].to_numpy(),
+        10 ** (2 + DECIMALI_ALIQUOTA),
+    )
+    gruppi.insert(1, "Aliquota", gruppi.pop("aliquota") / 10 ** DECIMALI_ALIQUOTA)
+    return gruppi
+
+
+def riepilogo_fattura(righe: list) -> list:
+    """
+    Riepilogo per aliquota/natura di una sola fattura dalle righe dell'editor,
+    in interi Python senza passare da pandas: stesse regole e stesso ordine
+    di riepilogo_aliquote. Voci {Aliquota, Natura, Imponibile, IVA}.
+    """
+    imponibili = {}
+    for r in righe:
+        aliquota = _intero(r.get("iva", 0), DECIMALI_ALIQUOTA)
+        natura = str(r.get("natura") or "").strip() if aliquota == 0 else ""
+        voce = (aliquota, natura)
+        imponibili[voce] = imponibili.get(voce, 0) + totale_riga(r.get("qta", 0), r.get("prezzo", 0))
+    return [
+        {
+            "Aliquota": aliquota / 10 ** DECIMALI_ALIQUOTA,
+            "Natura": natura,
+            "Imponibile": imponibile,
+            "IVA": _dividi(imponibile * aliquota, 10 ** (2 + DECIMALI_ALIQUOTA)),
+        }
+        for (aliquota, natura), imponibile in sorted(imponibili.items())
+    ]
+
+
+def aliquota_media(imponibile: int, imposta: int) -> float:
+    """Aliquota (in %, 2 decimali) che lega imponibile e imposta: per documenti senza righe."""
+    return round(imposta * 100 / imponibile, DECIMALI_ALIQUOTA) if imponibile else 0.0
+
+
+def totali_fattura(righe: list) -> dict:
+    """
+    Totali di una sola fattura dalle righe dell'editor ({qta, prezzo, iva}):
+    Imponibile, IVA e Importo in centesimi.
+    """
+    voci = riepilogo_fattura(righe)
+    imponibile = sum(v["Imponibile"] for v in voci)
+    iva = sum(v["IVA"] for v in voci)
+    return {"Imponibile": imponibile, "IVA": iva, "Importo": imponibile + iva}
+
+
+def righe_frame(righe_per_documento: dict) -> pd.DataFrame:
+    """
+    DataFrame COLONNE_RIGHE dalle righe nel formato dell'editor
+    ({desc, qta, prezzo, iva, natura}) di più documenti: id -> lista righe.
+    """
+    documenti, qta, prezzi, aliquote, nature = [], [], [], [], []
+    for doc_id, righe in righe_per_documento.items():
+        for r in righe:
+            documenti.append(doc_id)
+            qta.append(r.get("qta", 0))
+            prezzi.append(r.get("prezzo", 0))
+            aliquote.append(r.get("iva", 0))
+            nature.append(r.get("natura", "") or "")
+    return pd.DataFrame(
+        {"documento": documenti, "qta": qta, "prezzo": prezzi, "iva": aliquote, "natura": nature}
+    )
@@ -1,59 +1,21 @@
 import streamlit as st
-import pandas as pd
 from datetime import date
 import os
-import re
 import base64
+from functools import partial
+
+import db_utils
+import pdf_utils
+from report_utils import crea_riepilogo_fatture_emesse
 
 PRIMARY_BLUE = "#1f77b4"
 
 # ==========================
 # COSTANTI E STATO
 # ==========================
-COLONNE_DOC = [
-    "Tipo",
-    "Numero",
-    "Data",
-    "Controparte",
-    "Imponibile",
-    "IVA",
-    "Importo",
-    "TipoXML",
-    "Stato",
-    "UUID",
-    "PDF",
-]
-
-CLIENTI_COLONNE = [
-    "Denominazione",
-    "PIVA",
-    "CF",
-    "Indirizzo",
-    "CAP",
-    "Comune",
-    "Provincia",
-    "CodiceDestinatario",
-    "PEC",
-    "Tipo",
-]
-
-# Inizializzazione documenti
-if "documenti_emessi" not in st.session_state:
-    st.session_state.documenti_emessi = pd.DataFrame(columns=COLONNE_DOC)
-else:
-    for col in COLONNE_DOC:
-        if col not in st.session_state.documenti_emessi.columns:
-            st.session_state.documenti_emessi[col] = (
-                0.0 if col in ["Imponibile", "IVA", "Importo"] else ""
-            )
-
-# Inizializzazione rubrica clienti
-if "clienti" not in st.session_state:
-    st.session_state.clienti = pd.DataFrame(columns=CLIENTI_COLONNE)
-else:
-    for col in CLIENTI_COLONNE:
-        if col not in st.session_state.clienti.columns:
-            st.session_state.clienti[col] = ""
+# Documenti e rubrica letti dall'archivio condiviso (db_utils)
+st.session_state.documenti_emessi = db_utils.carica_documenti()
+st.session_state.clienti = db_utils.carica_controparti()
 
 # ==========================
 # FUNZIONI UTILI
@@ -73,124 +35,6 @@ def mostra_anteprima_pdf(pdf_bytes: bytes, altezza: int = 600) -> None:
     st.markdown(pdf_display, unsafe_allow_html=True)
 
 
-def get_next_invoice_number() -> str:
-    """Genera il prossimo numero fattura stile FT."""
-    year = date.today().year
-    prefix = f"FT{year}"
-    df = st.session_state.documenti_emessi
-    seq = 1
-    if not df.empty:
-        mask = df["Numero"].astype(str).str.startswith(prefix)
-        if mask.any():
-            existing = df.loc[mask, "Numero"].astype(str)
-            max_seq = 0
-            for num in existing:
-                m = re.search(rf"{prefix}(\d+)$", num)
-                if m:
-                    s = int(m.group(1))
-                    if s > max_seq:
-                        max_seq = s
-            seq = max_seq + 1
-    return f"{prefix}{seq:03d}"
-
-
-def crea_riepilogo_fatture_emesse(df: pd.DataFrame) -> None:
-    if df.empty:
-        st.info("Nessuna fattura emessa per creare il riepilogo.")
-        return
-
-    df = df.copy()
-    df["Data"] = pd.to_datetime(df["Data"], errors="coerce")
-    anni = sorted(df["Data"].dt.year.dropna().unique())
-
-    if not anni:
-        st.info("Nessuna data valida sulle fatture emesse.")
-        return
-
-    anno_default = date.today().year
-    if anno_default not in anni:
-        anno_default = anni[-1]
-    idx_default = list(anni).index(anno_default)
-
-    anno_sel = st.selectbox(
-        "Anno",
-        anni,
-        index=idx_default,
-        key="anno_riepilogo_emesse",
-    )
-
-    df_anno = df[df["Data"].dt.year == anno_sel]
-    mesi_label = [
-        "Gennaio",
-        "Febbraio",
-        "Marzo",
-        "Aprile",
-        "Maggio",
-        "Giugno",
-        "Luglio",
-        "Agosto",
-        "Settembre",
-        "Ottobre",
-        "Novembre",
-        "Dicembre",
-    ]
-
-    rows = []
-
-    # Mensili
-    for m in range(1, 13):
-        df_m = df_anno[df_anno["Data"].dt.month == m]
-        imp_tot = df_m["Importo"].sum()
-        imp_imp = df_m["Imponibile"].sum()
-        iva_tot = df_m["IVA"].sum()
-        rows.append(
-            {
-                "Periodo": mesi_label[m - 1],
-                "Importo a pagare": _format_val_eur(imp_tot),
-                "Imponibile": _format_val_eur(imp_imp),
-                "IVA": _format_val_eur(iva_tot),
-            }
-        )
-
-    # Trimestri
-    trimestri = {
-        "1° Trimestre": [1, 2, 3],
-        "2° Trimestre": [4, 5, 6],
-        "3° Trimestre": [7, 8, 9],
-        "4° Trimestre": [10, 11, 12],
-    }
-
-    for nome, months in trimestri.items():
-        df_q = df_anno[df_anno["Data"].dt.month.isin(months)]
-        imp_tot = df_q["Importo"].sum()
-        imp_imp = df_q["Imponibile"].sum()
-        iva_tot = df_q["IVA"].sum()
-        rows.append(
-            {
-                "Periodo": nome,
-                "Importo a pagare": _format_val_eur(imp_tot),
-                "Imponibile": _format_val_eur(imp_imp),
-                "IVA": _format_val_eur(iva_tot),
-            }
-        )
-
-    # Annuale
-    imp_tot = df_anno["Importo"].sum()
-    imp_imp = df_anno["Imponibile"].sum()
-    iva_tot = df_anno["IVA"].sum()
-    rows.append(
-        {
-            "Periodo": "Annuale",
-            "Importo a pagare": _format_val_eur(imp_tot),
-            "Imponibile": _format_val_eur(imp_imp),
-            "IVA": _format_val_eur(iva_tot),
-        }
-    )
-
-    df_riep = pd.DataFrame(rows)
-    st.markdown("### Prospetto riepilogativo fatture emesse")
-    st.dataframe(df_riep, use_container_width=True, hide_index=True)
-
 # ==========================
 # HEADER
 # ==========================
@@ -223,12 +67,7 @@ with col_nuova:
 # ==========================
 # CONTATORI PER MESE
 # ==========================
-docs_per_month = {m: 0 for m in range(1, 13)}
-df_tmp = st.session_state.documenti_emessi.copy()
-if not df_tmp.empty:
-    df_tmp["Data"] = pd.to_datetime(df_tmp["Data"], errors="coerce")
-    for m in range(1, 13):
-        docs_per_month[m] = (df_tmp["Data"].dt.month == m).sum()
+docs_per_month = st.session_state.documenti_emessi["Mese"].value_counts().to_dict()
 
 # ==========================
 # BARRA SUPERIORE
@@ -253,7 +92,8 @@ with col_emesse:
 
 with col_ricevute:
     if st.button("RICEVUTE"):
-        st.info("Sezione RICEVUTE non ancora implementata.")
+        st.session_state.pagina_corrente = "📥 Fatture ricevute"
+        st.switch_page("app.py")
 
 with col_agg:
     st.button("AGGIORNA")
@@ -288,12 +128,9 @@ idx_mese = date.today().month
 # LISTA EMESSE
 # ==========================
 df_e_all = st.session_state.documenti_emessi.copy()
+indice_cli = db_utils.indice_controparti()
 
-if not df_e_all.empty:
-    df_e_all["Data"] = pd.to_datetime(df_e_all["Data"], errors="coerce")
-    anni = sorted(df_e_all["Data"].dt.year.dropna().unique())
-else:
-    anni = []
+anni = sorted(int(a) for a in df_e_all["Anno"].unique())
 
 if anni:
     anno_default = date.today().year
@@ -301,7 +138,7 @@ if anni:
         anno_default = anni[-1]
     idx_anno_default = list(anni).index(anno_default)
 
-    col_anno, _ = st.columns([1, 5])
+    col_anno, col_rigenera, _ = st.columns([1, 1, 4])
     with col_anno:
         anno_sel = st.selectbox(
             "Anno",
@@ -310,7 +147,31 @@ if anni:
             key="anno_lista",
         )
 
-    df_e_all = df_e_all[df_e_all["Data"].dt.year == anno_sel]
+    # Rigenerazione PDF del periodo (es. dopo un cambio di layout o di emittente)
+    with col_rigenera:
+        with st.popover("🔁 Rigenera PDF", use_container_width=True):
+            mese_rig = st.selectbox(
+                "Periodo",
+                [None] + list(range(1, 13)),
+                format_func=lambda m: f"Tutto il {anno_sel}" if m is None else nomi_mesi[m - 1],
+                key="mese_rigenera",
+            )
+            if st.button("Avvia rigenerazione", key="avvia_rigenera"):
+                barra = st.progress(0.0)
+                esito = pdf_utils.rigenera_pdf(
+                    anno_sel,
+                    mese_rig,
+                    emittente=st.session_state.get("emittente"),
+                    avanzamento=lambda fatti, totale: barra.progress(fatti / totale),
+                )
+                st.success(
+                    f"{esito['documenti']} PDF in {esito['secondi']:.1f}s "
+                    f"({esito['pdf_al_secondo']:.1f} PDF/s, {esito['processi']} processi)"
+                )
+                for doc_id, errore in esito["errori"].items():
+                    st.error(f"Documento {doc_id}: {errore}")
+
+    df_e_all = df_e_all[df_e_all["Anno"] == anno_sel]
 
     if df_e_all.empty:
         st.info("Nessun documento emesso per l'anno selezionato.")
@@ -322,7 +183,7 @@ if anni:
         # Tab mese corrente
         with tabs[idx_mese]:
             df_e = df_e_all.copy()
-            df_e = df_e[df_e["Data"].dt.month == idx_mese]
+            df_e = df_e[df_e["Mese"] == idx_mese]
 
             if barra_ricerca:
                 mask = (
@@ -343,28 +204,18 @@ if anni:
 
                 for _, row in df_e.iterrows():
                     row_index = row.name
-                    data_doc = pd.to_datetime(row["Data"])
+                    data_doc = row["Data"]
                     tipo_xml = (row.get("TipoXML", "") or "TD01").upper()
                     tipo_label = f"{tipo_xml} - FATTURA"
 
-                    importo = float(row.get("Importo", 0.0) or 0.0)
+                    importo = row.get("Importo", 0) / 100
                     controparte = row.get("Controparte", "")
                     stato_corrente = row.get("Stato", "Creazione") or "Creazione"
                     pdf_path = row.get("PDF", "")
 
                     # Recupero P.IVA / CF da rubrica
-                    piva_cf = ""
-                    cli_df = st.session_state.clienti[
-                        st.session_state.clienti["Denominazione"] == controparte
-                    ]
-                    if not cli_df.empty:
-                        cli_row = cli_df.iloc(0)[0]
-                        piva_val = (cli_row.get("PIVA") or "").strip()
-                        cf_val = (cli_row.get("CF") or "").strip()
-                        if piva_val:
-                            piva_cf = piva_val
-                        elif cf_val:
-                            piva_cf = cf_val
+                    piva_val, cf_val = indice_cli.get(controparte, ("", ""))
+                    piva_cf = piva_val or cf_val
 
                     with st.container():
                         st.markdown("---")
@@ -415,9 +266,10 @@ if anni:
                                 key=f"stato_{row_index}",
                                 label_visibility="collapsed",
                             )
-                            st.session_state.documenti_emessi.loc[
-                                row_index, "Stato"
-                            ] = new_stato
+                            if new_stato != stato_corrente:
+                                db_utils.aggiorna_documento(
+                                    row_index, {"Stato": new_stato}
+                                )
 
                         # MENU AZIONI
                         with col_menu:
@@ -426,23 +278,21 @@ if anni:
                                 st.markdown("**Seleziona azione**")
 
                                 if st.button("👁 Visualizza", key=f"vis_{row_index}"):
-                                    if pdf_path and os.path.exists(pdf_path):
-                                        with open(pdf_path, "rb") as f:
-                                            pdf_bytes = f.read()
+                                    if pdf_utils.pdf_disponibile(pdf_path):
                                         st.markdown("Anteprima PDF:")
-                                        mostra_anteprima_pdf(pdf_bytes, altezza=400)
+                                        mostra_anteprima_pdf(
+                                            pdf_utils.leggi_pdf(pdf_path), altezza=400
+                                        )
                                     else:
                                         st.warning("PDF non disponibile su disco.")
 
                                 if st.button(
                                     "📄 Scarica PDF fattura", key=f"fatt_{row_index}"
                                 ):
-                                    if pdf_path and os.path.exists(pdf_path):
-                                        with open(pdf_path, "rb") as f:
-                                            pdf_bytes = f.read()
+                                    if pdf_utils.pdf_disponibile(pdf_path):
                                         st.download_button(
                                             "📥 Download PDF",
-                                            data=pdf_bytes,
+                                            data=partial(pdf_utils.leggi_pdf, pdf_path),
                                             file_name=os.path.basename(pdf_path),
                                             mime="application/pdf",
                                             key=f"dl_{row_index}",
@@ -453,28 +303,18 @@ if anni:
                                 if st.button(
                                     "🧬 Duplica", key=f"dup_{row_index}"
                                 ):
-                                    nuovo_num = get_next_invoice_number()
-                                    nuova_riga = row.copy()
-                                    nuova_riga["Numero"] = nuovo_num
-                                    nuova_riga["Data"] = str(date.today())
-                                    st.session_state.documenti_emessi = pd.concat(
-                                        [
-                                            st.session_state.documenti_emessi,
-                                            pd.DataFrame([nuova_riga]),
-                                        ],
-                                        ignore_index=True,
-                                    )
-                                    st.success(
-                                        f"Fattura duplicata come {nuovo_num}."
-                                    )
-                                    st.rerun()
+                                    try:
+                                        _, nuovo_num = db_utils.duplica_documento(row_index)
+                                    except db_utils.DocumentoDuplicato as e:
+                                        st.error(str(e))
+                                    else:
+                                        st.success(
+                                            f"Fattura duplicata come {nuovo_num}."
+                                        )
+                                        st.rerun()
 
                                 if st.button("🗑 Elimina", key=f"del_{row_index}"):
-                                    st.session_state.documenti_emessi = (
-                                        st.session_state.documenti_emessi.drop(
-                                            row_index
-                                        ).reset_index(drop=True)
-                                    )
+                                    db_utils.elimina_documento(row_index)
                                     st.warning("Fattura eliminata.")
                                     st.rerun()
 
@@ -496,9 +336,8 @@ else:
         if scelta_num:
             riga = df_e_pdf[df_e_pdf["Numero"] == scelta_num].iloc[0]
             pdf_path = riga["PDF"]
-            if os.path.exists(pdf_path):
-                with open(pdf_path, "rb") as f:
-                    pdf_bytes = f.read()
+            if pdf_utils.pdf_disponibile(pdf_path):
+                pdf_bytes = pdf_utils.leggi_pdf(pdf_path)
                 st.download_button(
                     label=f"📥 Scarica PDF fattura {scelta_num}",
                     data=pdf_bytes,
@@ -1,14 +1,15 @@
 import streamlit as st
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import A4
-from reportlab.lib import colors
 from io import BytesIO
 from datetime import date, datetime, timedelta
 import os
 import uuid
 import base64
-import pandas as pd
-import re
+
+import db_utils
+import importi_utils
+import pdf_utils
+import xml_utils
+import xsd_utils
 
 st.set_page_config(page_title="Nuova Fattura", page_icon="💰", layout="wide")
 PRIMARY_BLUE = "#1f77b4"
@@ -44,47 +45,11 @@ def get_dati_azienda_da_sessione():
 
 AZIENDA = get_dati_azienda_da_sessione()
 
-COLONNE_DOC = [
-    "Tipo",
-    "Numero",
-    "Data",
-    "Controparte",
-    "Imponibile",
-    "IVA",
-    "Importo",
-    "TipoXML",
-    "Stato",
-    "UUID",
-    "PDF",
-]
-
 # ==========================
 # STATO INIZIALE
 # ==========================
-if "documenti_emessi" not in st.session_state:
-    st.session_state.documenti_emessi = pd.DataFrame(columns=COLONNE_DOC)
-else:
-    for col in COLONNE_DOC:
-        if col not in st.session_state.documenti_emessi.columns:
-            st.session_state.documenti_emessi[col] = (
-                0.0 if col in ["Imponibile", "IVA", "Importo"] else ""
-            )
-
-if "clienti" not in st.session_state:
-    st.session_state.clienti = pd.DataFrame(
-        columns=[
-            "Denominazione",
-            "PIVA",
-            "CF",
-            "Indirizzo",
-            "CAP",
-            "Comune",
-            "Provincia",
-            "CodiceDestinatario",
-            "PEC",
-            "Tipo",
-        ]
-    )
+st.session_state.documenti_emessi = db_utils.carica_documenti()
+st.session_state.clienti = db_utils.carica_controparti()
 
 if "anagrafica" not in st.session_state:
     st.session_state.anagrafica = {
@@ -102,215 +67,125 @@ if "anagrafica" not in st.session_state:
 # ==========================
 # FUNZIONI DI SUPPORTO
 # ==========================
-def get_next_invoice_number() -> str:
-    year = date.today().year
-    prefix = f"FT{year}"
-    df = st.session_state.documenti_emessi
-    seq = 1
-    if not df.empty:
-        mask = df["Numero"].astype(str).str.startswith(prefix)
-        if mask.any():
-            existing = df.loc[mask, "Numero"].astype(str)
-            max_seq = 0
-            for num in existing:
-                m = re.search(rf"{prefix}(\d+)$", num)
-                if m:
-                    s = int(m.group(1))
-                    if s > max_seq:
-                        max_seq = s
-            seq = max_seq + 1
-    return f"{prefix}{seq:03d}"
-
-
 def format_eur(val: float) -> str:
     return f"{val:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
 
 
 def genera_pdf_fattura(dati: dict) -> BytesIO:
-    buffer = BytesIO()
-    c = canvas.Canvas(buffer, pagesize=A4)
-    PAGE_W, PAGE_H = A4
-    x_left = 30
-    x_right = PAGE_W - 30
-    blu = colors.HexColor("#0070c0")
-
-    # INTESTAZIONE
-    y = PAGE_H - 60
-    c.setFont("Helvetica-Bold", 12)
-    c.drawString(x_left, y, dati["azienda_nome"])
-    c.setFont("Helvetica", 10)
-    c.drawString(x_left, y - 14, dati["azienda_indirizzo"])
-    c.drawString(
-        x_left,
-        y - 28,
-        f"{dati['azienda_cap']} {dati['azienda_citta']} ({dati['azienda_prov']}) IT",
-    )
-    c.drawString(x_left, y - 42, f"CODICE FISCALE {dati['azienda_cf']}")
-    c.drawString(x_left, y - 56, f"PARTITA IVA {dati['azienda_piva']}")
-
-    c.setFont("Helvetica-Bold", 10)
-    c.drawRightString(x_right, y, "Spett.le")
-    c.setFont("Helvetica-Bold", 12)
-    c.drawRightString(x_right, y - 14, dati["cliente_nome"])
-    c.setFont("Helvetica", 10)
-    c.drawRightString(x_right, y - 28, dati["cliente_indirizzo"])
-    c.drawRightString(
-        x_right,
-        y - 42,
-        f"{dati['cliente_cap']} {dati['cliente_citta']} ({dati['cliente_prov']}) IT",
-    )
-    if dati["cliente_piva"]:
-        c.drawRightString(x_right, y - 56, f"PARTITA IVA {dati['cliente_piva']}")
-    else:
-        c.drawRightString(x_right, y - 56, f"CODICE FISCALE {dati['cliente_cf']}")
-
-    # DATI DOCUMENTO / TRASMISSIONE
-    y = PAGE_H - 140
-    mid_x = x_left + (x_right - x_left) / 2
-    c.setFillColor(blu)
-    c.rect(x_left, y, (mid_x - x_left), 18, fill=1, stroke=0)
-    c.rect(mid_x, y, (x_right - mid_x), 18, fill=1, stroke=0)
-    c.setFillColor(colors.white)
-    c.setFont("Helvetica-Bold", 10)
-    c.drawString(x_left + 4, y + 4, "DATI DOCUMENTO")
-    c.drawString(mid_x + 4, y + 4, "DATI TRASMISSIONE")
-    c.setFillColor(colors.black)
-    c.setFont("Helvetica", 9)
-    y -= 18
-    row_h = 14
-
-    c.drawString(x_left + 4, y, "TIPO")
-    c.drawString(x_left + 80, y, dati["tipo_documento"])
-    c.drawString(x_left + 4, y - row_h, "NUMERO")
-    c.drawString(x_left + 80, y - row_h, str(dati["numero"]))
-    c.drawString(x_left + 4, y - 2 * row_h, "DATA")
-    c.drawString(x_left + 80, y - 2 * row_h, dati["data"])
-    c.drawString(x_left + 4, y - 3 * row_h, "CAUSALE")
-    c.drawString(x_left + 80, y - 3 * row_h, dati["causale"])
-
-    x_rt = mid_x + 4
-    c.drawString(x_rt, y, "CODICE DESTINATARIO")
-    c.drawString(x_rt + 120, y, dati["codice_destinatario"])
-    c.drawString(x_rt, y - row_h, "PEC DESTINATARIO")
-    c.drawString(x_rt + 120, y - row_h, dati["pec_destinatario"])
-
-    # DETTAGLIO
-    y = y - 3 * row_h - 30
-    c.setFillColor(blu)
-    c.rect(x_left, y, (x_right - x_left), 18, fill=1, stroke=0)
-    c.setFillColor(colors.white)
-    c.setFont("Helvetica-Bold", 10)
-    c.drawString(x_left + 4, y + 4, "DETTAGLIO DOCUMENTO")
-    y -= 18
-    c.setFillColor(colors.black)
-    c.setFont("Helvetica-Bold", 9)
-    col_x = {
-        "#": x_left + 4,
-        "DESCRIZIONE": x_left + 24,
-        "U.M.": x_left + 230,
-        "PREZZO": x_left + 270,
-        "QTA": x_left + 340,
-        "TOTALE": x_left + 390,
-        "IVA %": x_left + 450,
+    """Adatta i dati del form al motore PDF comune (pdf_utils)."""
+    emittente = {
+        "Denominazione": dati["azienda_nome"],
+        "Indirizzo": dati["azienda_indirizzo"],
+        "CAP": dati["azienda_cap"],
+        "Comune": dati["azienda_citta"],
+        "Provincia": dati["azienda_prov"],
+        "CF": dati["azienda_cf"],
+        "PIVA": dati["azienda_piva"],
     }
-    for label, xpos in col_x.items():
-        c.drawString(xpos, y, label)
-
-    y -= 14
-    c.setFont("Helvetica", 9)
-    c.drawString(col_x["#"], y, "1")
-    c.drawString(col_x["DESCRIZIONE"], y, dati["descrizione"])
-    c.drawRightString(col_x["PREZZO"] + 60, y, dati["prezzo_unitario"])
-    c.drawRightString(col_x["QTA"] + 30, y, "1,00")
-    c.drawRightString(col_x["TOTALE"] + 60, y, dati["imponibile"])
-    c.drawRightString(col_x["IVA %"] + 40, y, dati["iva_percentuale"])
-
-    # IMPORTI
-    y -= 40
-    c.setFont("Helvetica-Bold", 9)
-    c.drawString(x_left + 4, y, f"IMPORTO = {dati['imponibile']}")
-    y -= 14
-    c.drawString(x_left + 4, y, f"TOTALE IMPONIBILE = {dati['imponibile']}")
-    y -= 14
-    c.drawString(
-        x_left + 4,
-        y,
-        f"IVA (SU € {dati['imponibile']}) + {dati['iva_valore']}",
-    )
-    y -= 14
-    c.drawString(x_left + 4, y, f"IMPORTO TOTALE = {dati['totale']}")
-    y -= 18
-    c.setFont("Helvetica-Bold", 11)
-    c.setFillColor(blu)
-    c.drawString(x_left + 4, y, f"NETTO A PAGARE = {dati['totale']}")
-    c.setFillColor(colors.black)
-
-    # PAGAMENTO
-    y -= 40
-    c.setFillColor(blu)
-    c.rect(x_left, y, (x_right - x_left), 18, fill=1, stroke=0)
-    c.setFillColor(colors.white)
-    c.setFont("Helvetica-Bold", 9)
-    c.drawString(
-        x_left + 4,
-        y + 4,
-        f"MODALITÀ DI PAGAMENTO ACCETTATE: {dati['pagamento_descrizione']}",
+    cliente = {
+        "Denominazione": dati["cliente_nome"],
+        "Indirizzo": dati["cliente_indirizzo"],
+        "CAP": dati["cliente_cap"],
+        "Comune": dati["cliente_citta"],
+        "Provincia": dati["cliente_prov"],
+        "PIVA": dati["cliente_piva"],
+        "CF": dati["cliente_cf"],
+        "CodiceDestinatario": dati["codice_destinatario"],
+        "PEC": dati["pec_destinatario"],
+    }
+    righe = [{
+        "desc": dati["descrizione"],
+        "qta": 1.0,
+        "prezzo": dati["imponibile_num"],
+        "iva": dati["iva_percent_num"],
+    }]
+    pdf_bytes = pdf_utils.genera_pdf_fattura(
+        dati["numero"],
+        datetime.strptime(dati["data"], "%d/%m/%Y").date(),
+        cliente,
+        righe,
+        dati["imponibile_num"],
+        dati["iva_val_num"],
+        dati["totale_num"],
+        emittente=emittente,
+        note=dati["causale"],
+        tipo_label=dati["tipo_documento"],
+        pagamento={
+            "descrizione": dati["pagamento_descrizione"],
+            "modalita": dati["modalita_pagamento"],
+            "dettagli": dati["dettagli_pagamento"],
+            "data_rif": dati["data_rif_term"],
+            "giorni": dati["giorni_termine"],
+            "scadenza": dati["data_scadenza"],
+        },
     )
-    y -= 18
-    c.setFillColor(colors.black)
-    c.setFont("Helvetica", 8)
-    c.drawString(x_left + 4, y, dati["modalita_pagamento"])
-    c.drawString(x_left + 120, y, dati["dettagli_pagamento"])
-    c.drawString(x_left + 300, y, dati["data_rif_term"])
-    c.drawRightString(x_left + 460, y, str(dati["giorni_termine"]))
-    c.drawString(x_left + 510, y, dati["data_scadenza"])
-
-    y -= 20
-    c.setFont("Helvetica-Bold", 10)
-    c.drawRightString(x_right, y, f"TOTALE A PAGARE EUR {dati['totale']}")
-
-    # NOTE FINALI
-    c.setFont("Helvetica", 7)
-    c.drawCentredString(
-        PAGE_W / 2,
-        40,
-        "Copia di cortesia priva di valore ai fini fiscali e giuridici.",
+    return BytesIO(pdf_bytes)
+
+
+def genera_xml_fattura(dati: dict) -> bytes:
+    """XML FatturaPA completo (xml_utils) a partire dai dati del form."""
+    return xml_utils.genera_xml_fattura(
+        dati["numero"],
+        datetime.strptime(dati["data"], "%d/%m/%Y").date(),
+        {
+            "Denominazione": dati["cliente_nome"],
+            "Indirizzo": dati["cliente_indirizzo"],
+            "CAP": dati["cliente_cap"],
+            "Comune": dati["cliente_citta"],
+            "Provincia": dati["cliente_prov"],
+            "PIVA": dati["cliente_piva"],
+            "CF": dati["cliente_cf"],
+            "CodiceDestinatario": dati["codice_destinatario"],
+            "PEC": dati["pec_destinatario"],
+        },
+        [{
+            "desc": dati["descrizione"],
+            "qta": 1.0,
+            "prezzo": dati["imponibile_num"],
+            "iva": dati["iva_percent_num"],
+        }],
+        {
+            "Denominazione": dati["azienda_nome"],
+            "Indirizzo": dati["azienda_indirizzo"],
+            "CAP": dati["azienda_cap"],
+            "Comune": dati["azienda_citta"],
+            "Provincia": dati["azienda_prov"],
+            "CF": dati["azienda_cf"],
+            "PIVA": dati["azienda_piva"],
+        },
+        causale=dati["causale"],
+        importo_totale=dati["totale_num"],
+        pagamento={
+            "modalita": dati["modalita_pagamento_codice"],
+            "giorni": dati["giorni_termine"],
+            "scadenza": dati["data_scadenza"],
+            "iban": dati["dettagli_pagamento"],
+        },
     )
 
-    c.save()
-    buffer.seek(0)
-    return buffer
 
-
-def genera_xml_fattura(dati: dict) -> str:
-    xml = f"""<FatturaElettronica>
-  <DatiGenerali>
-    <TipoDocumento>TD01</TipoDocumento>
-    <Divisa>EUR</Divisa>
-    <Data>{datetime.strptime(dati['data'], '%d/%m/%Y').date().isoformat()}</Data>
-    <Numero>{dati['numero']}</Numero>
-    <Causale>{dati['causale']}</Causale>
-  </DatiGenerali>
-</FatturaElettronica>
-"""
-    return xml
-
-
-def salva_su_file(pdf_buffer: BytesIO, xml_string: str, numero: str):
+def percorsi_file(numero: str):
     # Salva in C:\Users\Public\Documents\Fatture
     base_dir = r"C:\Users\Public\Documents\Fatture"
-    os.makedirs(base_dir, exist_ok=True)
-    pdf_path = os.path.join(base_dir, f"{numero}.pdf")
-    xml_path = os.path.join(base_dir, f"{numero}.xml")
+    return os.path.join(base_dir, f"{numero}.pdf"), os.path.join(base_dir, f"{numero}.xml")
+
+
+def salva_su_file(pdf_buffer: BytesIO, xml_bytes: bytes, numero: str):
+    pdf_path, xml_path = percorsi_file(numero)
+    os.makedirs(os.path.dirname(pdf_path), exist_ok=True)
     with open(pdf_path, "wb") as f:
         f.write(pdf_buffer.getvalue())
-    with open(xml_path, "w", encoding="utf-8") as f:
-        f.write(xml_string)
+    with open(xml_path, "wb") as f:
+        f.write(xml_bytes)
     return pdf_path, xml_path
 
 
-def registra_in_documenti(dati: dict, pdf_path: str):
-    nuova_riga = {
+def registra_in_documenti(dati: dict, assegna_numero: bool = False) -> str:
+    """
+    Registra la fattura e restituisce il numero definitivo. Con assegna_numero
+    il numero successivo della serie è riservato insieme all'inserimento.
+    """
+    documento = {
         "Tipo": "Fattura",
         "Numero": dati["numero"],
         "Data": dati["data"],
@@ -321,12 +196,21 @@ def registra_in_documenti(dati: dict, pdf_path: str):
         "TipoXML": "TD01",
         "Stato": "Creazione",
         "UUID": str(uuid.uuid4()),
-        "PDF": pdf_path,
+        "PDF": percorsi_file(dati["numero"])[0],
     }
-    st.session_state.documenti_emessi = pd.concat(
-        [st.session_state.documenti_emessi, pd.DataFrame([nuova_riga])],
-        ignore_index=True,
-    )
+    righe = [{
+        "desc": dati["descrizione"],
+        "qta": 1.0,
+        "prezzo": dati["imponibile_num"],
+        "iva": dati["iva_percent_num"],
+    }]
+    if assegna_numero:
+        _, numero = db_utils.inserisci_con_numero(
+            documento, righe, db_utils.serie_per_tipo("TD01"), pdf=lambda n: percorsi_file(n)[0],
+        )
+        return numero
+    db_utils.inserisci_documento(documento, righe)
+    return dati["numero"]
 
 
 def mostra_pdf(buffer: BytesIO, altezza: int = 600):
@@ -354,7 +238,7 @@ st.markdown("---")
 st.subheader("Nuova fattura")
 st.caption("Creazione fattura PDF di cortesia + XML SdI bozza.")
 
-numero_default = get_next_invoice_number()
+numero_default = db_utils.prossimo_numero(db_utils.serie_per_tipo("TD01"))
 data_default = date.today()
 
 # ==========================
@@ -444,8 +328,11 @@ with st.form("form_fattura"):
             "Aliquota IVA %", min_value=0.0, value=22.0, step=1.0
         )
 
-    iva_val_num = round(imponibile_num * iva_percent_num / 100, 2)
-    totale_num = round(imponibile_num + iva_val_num, 2)
+    totali = importi_utils.totali_fattura(
+        [{"qta": 1, "prezzo": imponibile_num, "iva": iva_percent_num}]
+    )
+    iva_val_num = float(db_utils.euro(totali["IVA"]))
+    totale_num = float(db_utils.euro(totali["Importo"]))
 
     st.markdown("---")
     colm1, colm2, colm3 = st.columns(3)
@@ -479,6 +366,11 @@ with st.form("form_fattura"):
     submitted = st.form_submit_button("Salva fattura e genera PDF + XML")
 
 if submitted:
+    # numero proposto: viene riservato al salvataggio, insieme all'inserimento
+    numero_da_assegnare = numero == numero_default
+    if not numero_da_assegnare and db_utils.trova_documento(numero, data_doc) is not None:
+        st.error(f"Esiste già un documento {numero} del {data_doc.strftime('%d/%m/%Y')}.")
+        st.stop()
     data_str = data_doc.strftime("%d/%m/%Y")
     data_rif_term_str = data_rif_term.strftime("%d/%m/%Y")
     data_scadenza = data_rif_term + timedelta(days=giorni_termine)
@@ -535,10 +427,8 @@ if submitted:
     }
 
     # aggiorno rubrica se richiesto
-    if salva_in_rubrica:
-        df_cli = st.session_state.clienti.copy()
-        mask = df_cli["Denominazione"] == cliente_nome
-        nuova_riga = {
+    if salva_in_rubrica and cliente_nome:
+        db_utils.salva_controparte({
             "Denominazione": cliente_nome,
             "PIVA": cliente_piva,
             "CF": cliente_cf,
@@ -549,21 +439,25 @@ if submitted:
             "CodiceDestinatario": codice_destinatario,
             "PEC": pec_destinatario,
             "Tipo": "B2B" if cliente_piva else "B2C",
-        }
-        if not df_cli.empty and mask.any():
-            df_cli.loc[mask, :] = nuova_riga
-        else:
-            df_cli = pd.concat(
-                [df_cli, pd.DataFrame([nuova_riga])], ignore_index=True
-            )
-        st.session_state.clienti = df_cli
-
+        })
+
+    # prima la registrazione (che può trovare un duplicato e fissa il numero), poi i file
+    try:
+        numero = dati["numero"] = registra_in_documenti(dati, numero_da_assegnare)
+    except db_utils.DocumentoDuplicato as e:
+        st.error(f"{e}.")
+        st.stop()
     pdf_buffer = genera_pdf_fattura(dati)
-    xml_string = genera_xml_fattura(dati)
-    pdf_path, xml_path = salva_su_file(pdf_buffer, xml_string, numero)
-    registra_in_documenti(dati, pdf_path)
+    xml_bytes = genera_xml_fattura(dati)
+    errori_xsd = xsd_utils.valida_xml(xml_bytes)
+    pdf_path, xml_path = salva_su_file(pdf_buffer, xml_bytes, numero)
 
     st.success(f"Fattura numero {numero} creata. PDF: {pdf_path} – XML: {xml_path}")
+    if errori_xsd:
+        st.warning(
+            "L'XML non è conforme allo schema FatturaPA e verrebbe scartato dallo SdI:\n\n"
+            + "\n".join(f"- {e}" for e in errori_xsd)
+        )
     st.markdown("### Anteprima PDF")
     mostra_pdf(pdf_buffer, altezza=600)
     st.download_button(
@@ -574,7 +468,7 @@ if submitted:
     )
     st.download_button(
         "Scarica XML",
-        data=xml_string.encode("utf-8"),
+        data=xml_bytes,
         file_name=f"{numero}.xml",
         mime="application/xml",
     )
@@ -0,0 +1,756 @@
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from functools import lru_cache
+
+from fpdf import FPDF
+
+import db_utils
+import importi_utils
+
+# Cartella dei PDF generati
+PDF_DIR = os.getenv("APPFATT_PDF_DIR", "fatture_pdf")
+
+# Dimensione massima (in byte) della cache dei PDF letti da disco
+PDF_CACHE_MAX_BYTES = int(os.getenv("APPFATT_PDF_CACHE_MB", "32")) * 1024 * 1024
+
+# Documenti per blocco inviato a ciascun processo nella rigenerazione in blocco
+BLOCCO_RIGENERAZIONE = 50
+
+EMITTENTE_DEFAULT = {
+    "Denominazione": "FISCO CHIARO CONSULTING",
+    "Indirizzo": "Via/Piazza ... n. ...",
+    "CAP": "00000",
+    "Comune": "CITTÀ",
+    "Provincia": "XX",
+    "CF": "XXXXXXXXXXXX",
+    "PIVA": "XXXXXXXXXXXX",
+}
+
+_lock = threading.Lock()
+_cache_pdf = OrderedDict()
+_cache_bytes = 0
+
+
+# ==========================
+# LETTURA PDF DA DISCO
+# ==========================
+def pdf_disponibile(pdf_path: str) -> bool:
+    """Controllo economico (solo stat) senza leggere il file."""
+    return bool(pdf_path) and os.path.isfile(pdf_path)
+
+
+def leggi_pdf(pdf_path: str) -> bytes:
+    """
+    Legge il PDF passando da una cache LRU limitata in byte.
+    La chiave include mtime e dimensione: un PDF rigenerato viene riletto.
+    """
+    global _cache_bytes
+    st_file = os.stat(pdf_path)
+    chiave = (os.path.abspath(pdf_path), st_file.st_mtime_ns, st_file.st_size)
+
+    with _lock:
+        if chiave in _cache_pdf:
+            _cache_pdf.move_to_end(chiave)
+            return _cache_pdf[chiave]
+
+    with open(pdf_path, "rb") as f:
+        pdf_bytes = f.read()
+
+    if len(pdf_bytes) > PDF_CACHE_MAX_BYTES:
+        return pdf_bytes
+
+    with _lock:
+        if chiave not in _cache_pdf:
+            _cache_pdf[chiave] = pdf_bytes
+            _cache_bytes += len(pdf_bytes)
+        while _cache_bytes > PDF_CACHE_MAX_BYTES:
+            _, vecchio = _cache_pdf.popitem(last=False)
+            _cache_bytes -= len(vecchio)
+    return pdf_bytes
+
+
+# ==========================
+# MOTORE DI RENDERING FATTURA
+# ==========================
+# Le parti statiche del layout (testata emittente, barre di sezione,
+# intestazioni di colonna, etichette e caselle, piede) vengono disegnate una
+# sola volta e conservate come frammenti di content stream PDF; ogni fattura
+# copia i frammenti alla quota giusta e scrive solo i campi variabili.
+ROW_HEIGHT = 6
+BLU_SEZIONE = (31, 119, 180)
+FONT_STILI = ("", "B", "I")
+
+# Dettaglio su più pagine: interlinea delle descrizioni lunghe, righe massime
+# per descrizione, spazio riservato al piede e altezza di totali + riepiloghi
+# (con una sola aliquota; ROW_HEIGHT in più per ogni altra) + pagamento (in mm)
+ALTEZZA_RIGA_TESTO = 4
+MAX_RIGHE_DESCRIZIONE = 8
+MARGINE_PIEDE = 27
+ALTEZZA_CHIUSURA = 77
+
+TIPO_MAP = {
+    "TD01": "TD01 FATTURA - B2B",
+    "TD02": "TD02 ACCONTO/ANTICIPO SU FATTURA",
+    "TD04": "TD04 NOTA DI CREDITO",
+    "TD05": "TD05 NOTA DI DEBITO",
+}
+
+DETTAGLIO_HEADERS = ["#", "DESCRIZIONE", "U.M.", "PREZZO", "QTA", "TOTALE", "IVA %", "RIT.", "NAT."]
+DETTAGLIO_W = [8, 78, 10, 28, 12, 28, 12, 10, 14]
+
+RIEPILOGO_HEADERS = ["IVA %", "NAT.", "RIFERIMENTO NORMATIVO", "IMPONIBILE", "IMPOSTA", "ESIG. IVA", "ARROT.", "SPESE ACC.", "TOTALE"]
+RIEPILOGO_W = [14, 14, 40, 24, 20, 20, 14, 24, 24]
+
+PAGAMENTO_HEADERS = ["MODALITA'", "DETTAGLI", "DATA RIF. TERMINI", "GIORNI TERMINI", "DATA SCADENZA"]
+PAGAMENTO_W = [30, 60, 30, 30, 40]
+
+NOTA_PIEDE = (
+    "Copia di cortesia priva di valore ai fini fiscali e giuridici ai sensi dell'articolo 21 del D.P.R. 633/72. "
+    "L'originale del documento è consultabile presso l'indirizzo PEC o il codice SDI registrato "
+    "o nell'area riservata Fatture e Corrispettivi."
+)
+
+
+def _format_val_eur(val: float) -> str:
+    return (
+        f"{val:,.2f}"
+        .replace(",", "X")
+        .replace(".", ",")
+        .replace("X", ".")
+    )
+
+
+class _PdfFattura(FPDF):
+    """
+    FPDF senza salto pagina automatico, con il piede ripetuto su ogni pagina.
+    I font sono registrati sempre nello stesso ordine, così i riferimenti /F1..
+    dei blocchi compilati valgono in ogni documento.
+    """
+
+    def __init__(self, piede: "_Blocco" = None):
+        super().__init__()
+        self.piede = piede
+        self.alias_nb_pages()
+        self.set_auto_page_break(auto=False)
+        for stile in FONT_STILI:
+            self.set_font("Helvetica", stile, 8)
+        self.font_family = ""
+
+    def footer(self):
+        self.set_y(-25)
+        _incolla(self, self.piede)
+        self.set_font("Helvetica", "", 7)
+        self.cell(0, 4, f"Pagina {self.page_no()} di {{nb}}", align="R")
+
+
+class _Blocco:
+    """
+    Parte statica del layout già tradotta in content stream PDF, con la
+    quota a cui è stata disegnata, l'avanzamento (altezza, x finale), lo
+    stato grafico finale e le caselle variabili (campi) da riempire.
+    """
+
+    __slots__ = ("flusso", "y", "altezza", "x_fine", "stato", "campi")
+
+
+def _compila(disegna, y: float = None) -> _Blocco:
+    """Disegna il blocco una volta su una pagina di prova e ne conserva il content stream."""
+    pdf = _PdfFattura()
+    pdf.add_page()
+    if y is not None:
+        pdf.set_y(y)
+    blocco = _Blocco()
+    blocco.y = pdf.get_y()
+    blocco.campi = []
+    inizio = len(pdf.pages[pdf.page])
+    disegna(pdf, blocco.campi)
+    blocco.flusso = pdf.pages[pdf.page][inizio:]
+    blocco.altezza = pdf.get_y() - blocco.y
+    blocco.x_fine = pdf.get_x()
+    blocco.stato = (pdf.font_family, pdf.font_style, pdf.font_size_pt, pdf.fill_color, pdf.text_color)
+    return blocco
+
+
+def _campo(pdf, campi: list, nome: str, w: float, h: float, ln: int = 0, align: str = "", border=1, fill=0) -> None:
+    """Casella variabile: in compilazione si disegnano solo bordo e sfondo."""
+    campi.append((nome, pdf.get_x(), pdf.get_y(), w, h, align, pdf.font_style, pdf.font_size_pt, pdf.text_color))
+    pdf.cell(w, h, "", border=border, ln=ln, fill=fill)
+
+
+def _incolla(pdf, blocco: _Blocco, valori: dict = None) -> None:
+    """
+    Copia il content stream del blocco alla quota corrente (traslazione cm
+    dentro q/Q), scrive i soli campi variabili e riallinea lo stato di FPDF.
+    """
+    y = pdf.get_y()
+    pdf._out(f"q 1 0 0 1 0 {(blocco.y - y) * pdf.k:.2f} cm\n{blocco.flusso}Q")
+    famiglia, stile, dimensione, sfondo, testo = blocco.stato
+    # dopo Q il PDF ha di nuovo font e colori precedenti: si riscrivono quelli finali
+    pdf.font_family = ""
+    pdf.fill_color = sfondo
+    pdf._out(sfondo)
+    for nome, x, y_campo, w, h, align, stile_campo, dim_campo, colore in blocco.campi:
+        pdf.set_font("Helvetica", stile_campo, dim_campo)
+        pdf.text_color = colore
+        pdf.color_flag = sfondo != colore
+        pdf.set_xy(x, y + y_campo - blocco.y)
+        pdf.cell(w, h, valori[nome], align=align)
+    pdf.set_font(famiglia, stile, dimensione)
+    pdf.text_color = testo
+    pdf.color_flag = sfondo != testo
+    pdf.set_xy(blocco.x_fine, y + blocco.altezza)
+
+
+def _barra_sezione(pdf, testo) -> None:
+    pdf.set_fill_color(*BLU_SEZIONE)
+    pdf.set_text_color(255, 255, 255)
+    pdf.set_font("Helvetica", "B", 9)
+    pdf.set_x(10)
+    pdf.cell(190 - 20, ROW_HEIGHT, testo, border=1, ln=1, fill=True)
+
+
+def _intestazioni(pdf, headers: list, widths: list) -> None:
+    pdf.set_text_color(0, 0, 0)
+    pdf.set_font("Helvetica", "B", 8)
+    pdf.set_x(10)
+    for h, w in zip(headers, widths):
+        pdf.cell(w, ROW_HEIGHT, h, border=1, align="C")
+    pdf.ln(ROW_HEIGHT)
+
+
+@lru_cache(maxsize=16)
+def _layout_testata(emittente: tuple) -> _Blocco:
+    """Blocco emittente in testa alla prima pagina, compilato una volta per ogni anagrafica."""
+    em = dict(emittente)
+
+    def disegna(pdf, campi):
+        pdf.set_text_color(0, 0, 0)
+        pdf.set_font("Helvetica", "B", 14)
+        pdf.cell(0, 8, em["Denominazione"], ln=1)
+        pdf.set_font("Helvetica", "", 9)
+        pdf.cell(0, 5, em["Indirizzo"], ln=1)
+        pdf.cell(0, 5, f'{em["CAP"]} {em["Comune"]} ({em["Provincia"]}) IT', ln=1)
+        pdf.cell(0, 5, f'CODICE FISCALE {em["CF"]}', ln=1)
+        pdf.cell(0, 5, f'PARTITA IVA {em["PIVA"]}', ln=1)
+
+        pdf.set_x(120)
+        pdf.set_font("Helvetica", "B", 9)
+        pdf.cell(0, 5, "Spett.le", ln=1)
+
+    return _compila(disegna)
+
+
+def _dati_documento(pdf, campi) -> None:
+    left_x, right_x, col_width = 10, 110, 90
+    pdf.set_fill_color(*BLU_SEZIONE)
+    pdf.set_text_color(255, 255, 255)
+    pdf.set_font("Helvetica", "B", 9)
+    pdf.set_x(left_x)
+    pdf.cell(col_width, ROW_HEIGHT, "DATI DOCUMENTO", border=1, ln=0, fill=True)
+    pdf.set_x(right_x)
+    pdf.cell(col_width, ROW_HEIGHT, "DATI TRASMISSIONE", border=1, ln=1, fill=True)
+    pdf.set_text_color(0, 0, 0)
+    pdf.set_font("Helvetica", "", 8)
+    righe_dati = [
+        ("TIPO", "tipo", "CODICE DESTINATARIO", "codice_destinatario"),
+        ("NUMERO", "numero", "PEC DESTINATARIO", "pec"),
+        ("DATA", "data", "DATA INVIO", "data_invio"),
+        ("CAUSALE", "causale", "IDENTIFICATIVO SDI", "sdi"),
+    ]
+    for label_sx, campo_sx, label_dx, campo_dx in righe_dati:
+        pdf.set_x(left_x)
+        pdf.cell(col_width * 0.25, ROW_HEIGHT, label_sx, border=1)
+        _campo(pdf, campi, campo_sx, col_width * 0.75, ROW_HEIGHT)
+        pdf.set_x(right_x)
+        pdf.cell(col_width * 0.35, ROW_HEIGHT, label_dx, border=1)
+        _campo(pdf, campi, campo_dx, col_width * 0.65, ROW_HEIGHT, ln=1)
+    pdf.ln(2)
+
+
+def _dettaglio_testata(pdf, campi) -> None:
+    _barra_sezione(pdf, "DETTAGLIO DOCUMENTO")
+    _intestazioni(pdf, DETTAGLIO_HEADERS, DETTAGLIO_W)
+    pdf.set_font("Helvetica", "", 8)
+
+
+def _totali(pdf, campi) -> None:
+    pdf.ln(2)
+    pdf.set_text_color(0, 0, 0)
+    pdf.set_font("Helvetica", "", 8)
+    for label, campo in [
+        ("IMPORTO", "imponibile"),
+        ("TOTALE IMPONIBILE", "imponibile"),
+        ("IVA (SU IMPONIBILE)", "iva"),
+        ("IMPORTO TOTALE", "totale"),
+    ]:
+        pdf.set_x(10)
+        pdf.cell(40, ROW_HEIGHT, label, border=1)
+        _campo(pdf, campi, campo, 50, ROW_HEIGHT, ln=1, align="R")
+    pdf.set_x(10)
+    pdf.set_font("Helvetica", "B", 9)
+    pdf.cell(40, ROW_HEIGHT, "NETTO A PAGARE", border=1)
+    _campo(pdf, campi, "totale", 50, ROW_HEIGHT, ln=1, align="R")
+    pdf.ln(3)
+
+
+def _riepiloghi_testata(pdf, campi) -> None:
+    _barra_sezione(pdf, "RIEPILOGHI")
+    _intestazioni(pdf, RIEPILOGO_HEADERS, RIEPILOGO_W)
+    pdf.set_font("Helvetica", "", 8)
+
+
+def _pagamento(pdf, campi) -> None:
+    pdf.ln(4)
+    pdf.set_fill_color(*BLU_SEZIONE)
+    pdf.set_text_color(255, 255, 255)
+    pdf.set_font("Helvetica", "B", 9)
+    pdf.set_x(10)
+    _campo(pdf, campi, "pagamento_titolo", 190 - 20, ROW_HEIGHT, ln=1, fill=True)
+    _intestazioni(pdf, PAGAMENTO_HEADERS, PAGAMENTO_W)
+    pdf.set_font("Helvetica", "", 8)
+    pdf.set_x(10)
+    _campo(pdf, campi, "pag_modalita", PAGAMENTO_W[0], ROW_HEIGHT)
+    _campo(pdf, campi, "pag_dettagli", PAGAMENTO_W[1], ROW_HEIGHT)
+    _campo(pdf, campi, "pag_data_rif", PAGAMENTO_W[2], ROW_HEIGHT)
+    _campo(pdf, campi, "pag_giorni", PAGAMENTO_W[3], ROW_HEIGHT, align="C")
+    _campo(pdf, campi, "pag_scadenza", PAGAMENTO_W[4], ROW_HEIGHT, align="C")
+    pdf.ln(ROW_HEIGHT + 2)
+    pdf.set_font("Helvetica", "B", 9)
+    pdf.set_x(10)
+    _campo(pdf, campi, "totale_a_pagare", 190 - 20, ROW_HEIGHT, ln=1, border=0)
+
+
+def _piede(pdf, campi) -> None:
+    pdf.set_text_color(0, 0, 0)
+    pdf.set_font("Helvetica", "I", 7)
+    pdf.multi_cell(0, 4, NOTA_PIEDE, align="C")
+
+
+@lru_cache(maxsize=1)
+def _layout_fattura() -> dict:
+    """Blocchi statici della fattura, compilati una volta per processo."""
+    blocchi = {
+        nome: _compila(disegna)
+        for nome, disegna in [
+            ("dati_documento", _dati_documento),
+            ("dettaglio_testata", _dettaglio_testata),
+            ("totali", _totali),
+            ("riepiloghi_testata", _riepiloghi_testata),
+            ("pagamento", _pagamento),
+        ]
+    }
+    blocchi["piede"] = _compila(_piede, y=-25)
+    return blocchi
+
+
+def _spezza_testo(pdf, testo: str, larghezza: float) -> list:
+    """
+    Divide la descrizione in righe che stanno nella colonna (max MAX_RIGHE_DESCRIZIONE).
+    Le larghezze si sommano dalla tabella dei glifi del font corrente, una
+    parola alla volta, invece di rimisurare la riga a ogni aggiunta.
+    """
+    cw = pdf.current_font["cw"]
+    scala = pdf.font_size / 1000
+    if sum(cw.get(ch, 0) for ch in testo) * scala <= larghezza:
+        return [testo]
+
+    limite = larghezza / scala
+    spazio = cw.get(" ", 0)
+    righe, corrente, occupato = [], "", 0
+    for parola in testo.split():
+        lung = sum(cw.get(ch, 0) for ch in parola)
+        if corrente and occupato + spazio + lung <= limite:
+            corrente += " " + parola
+            occupato += spazio + lung
+            continue
+        if corrente:
+            righe.append(corrente)
+        corrente, occupato = "", 0
+        if lung <= limite:
+            corrente, occupato = parola, lung
+            continue
+        # parola più larga della colonna: spezzata a caratteri
+        for ch in parola:
+            if corrente and occupato + cw.get(ch, 0) > limite:
+                righe.append(corrente)
+                corrente, occupato = "", 0
+            corrente += ch
+            occupato += cw.get(ch, 0)
+        if len(righe) > MAX_RIGHE_DESCRIZIONE:
+            break
+    if corrente:
+        righe.append(corrente)
+    if len(righe) > MAX_RIGHE_DESCRIZIONE:
+        righe = righe[:MAX_RIGHE_DESCRIZIONE]
+        righe[-1] = righe[-1][:-3] + "..."
+    return righe
+
+
+def _riga_dettaglio(
+    pdf, idx: int, testo: list, altezza: float, qta: float, prezzo: float, totale: int, iva_r: float,
+    natura: str = "",
+) -> None:
+    """Una riga di dettaglio; `totale` è il PrezzoTotale in centesimi."""
+    w = DETTAGLIO_W
+    y = pdf.get_y()
+    pdf.set_x(10)
+    pdf.cell(w[0], altezza, str(idx), border=1, align="C")
+    pdf.cell(w[1], altezza, testo[0] if len(testo) == 1 else "", border=1)
+    pdf.cell(w[2], altezza, "", border=1, align="C")
+    pdf.cell(w[3], altezza, _format_val_eur(prezzo), border=1, align="R")
+    pdf.cell(w[4], altezza, f"{qta:.2f}", border=1, align="R")
+    pdf.cell(w[5], altezza, _format_val_eur(totale / 100), border=1, align="R")
+    pdf.cell(w[6], altezza, f"{iva_r:.2f}", border=1, align="R")
+    pdf.cell(w[7], altezza, "", border=1, align="C")
+    pdf.cell(w[8], altezza, natura, border=1, align="C")
+    if len(testo) > 1:
+        for i, riga in enumerate(testo):
+            pdf.set_xy(10 + w[0], y + 1 + i * ALTEZZA_RIGA_TESTO)
+            pdf.cell(w[1], ALTEZZA_RIGA_TESTO, riga)
+    pdf.set_y(y + altezza)
+
+
+def _riga_riporto(pdf, etichetta: str, importo: float) -> None:
+    w = DETTAGLIO_W
+    pdf.set_font("Helvetica", "B", 8)
+    pdf.set_x(10)
+    pdf.cell(sum(w[:5]), ROW_HEIGHT, etichetta, border=1, align="R")
+    pdf.cell(w[5], ROW_HEIGHT, _format_val_eur(importo), border=1, align="R")
+    pdf.cell(sum(w[6:]), ROW_HEIGHT, "", border=1)
+    pdf.ln(ROW_HEIGHT)
+    pdf.set_font("Helvetica", "", 8)
+
+
+def _pagina_seguente(pdf, valori: dict) -> None:
+    """Nuova pagina con il richiamo del documento in testa."""
+    pdf.add_page()
+    pdf.set_text_color(0, 0, 0)
+    pdf.set_font("Helvetica", "B", 9)
+    pdf.cell(0, ROW_HEIGHT, f"{valori['tipo']} N. {valori['numero']} DEL {valori['data']} - SEGUE", ln=1)
+    pdf.ln(2)
+    pdf.set_font("Helvetica", "", 8)
+
+
+def _riepilogo_iva(righe: list, imponibile, iva) -> list:
+    """
+    Una voce per aliquota/natura calcolata dalle righe; senza righe una sola
+    voce con i totali del documento e l'aliquota che ne deriva.
+    """
+    if righe:
+        return importi_utils.riepilogo_fattura(righe)
+    imponibile, iva = db_utils.centesimi(imponibile), db_utils.centesimi(iva)
+    return [{
+        "Aliquota": importi_utils.aliquota_media(imponibile, iva),
+        "Natura": "",
+        "Imponibile": imponibile,
+        "IVA": iva,
+    }]
+
+
+def genera_pdf_fattura(
+    numero: str,
+    data_f: date,
+    cliente: dict,
+    righe: list,
+    imponibile: float,
+    iva: float,
+    totale: float,
+    emittente: dict,
+    tipo_xml_codice: str = "TD01",
+    modalita_pagamento: str = "",
+    note: str = "",
+    tipo_label: str = None,
+    pagamento: dict = None,
+    riepilogo: list = None,
+) -> bytes:
+    """
+    PDF di cortesia con layout tipo Effatta.
+    `pagamento` (facoltativo) può indicare descrizione, modalita, dettagli,
+    data_rif, giorni e scadenza; altrimenti si usa il pagamento completo in
+    contanti con `modalita_pagamento` come dettaglio.
+    `riepilogo` (facoltativo): voci IVA già salvate ({Aliquota, Natura,
+    Imponibile, IVA} in centesimi); altrimenti si calcolano dalle righe.
+    """
+    layout = _layout_fattura()
+    pag = {
+        "descrizione": "PAGAMENTO COMPLETO",
+        "modalita": "CONTANTI",
+        "dettagli": modalita_pagamento[:40],
+        "data_rif": "",
+        "giorni": "0",
+        "scadenza": "",
+        **(pagamento or {}),
+    }
+    valori = {
+        "tipo": tipo_label or TIPO_MAP.get(tipo_xml_codice, tipo_xml_codice),
+        "codice_destinatario": cliente.get("CodiceDestinatario", "0000000"),
+        "numero": str(numero),
+        "pec": cliente.get("PEC", ""),
+        "data": data_f.strftime("%d/%m/%Y"),
+        "data_invio": "",
+        "causale": note.strip() if note else "SERVIZIO",
+        "sdi": "",
+        "imponibile": _format_val_eur(imponibile),
+        "iva": _format_val_eur(iva),
+        "totale": _format_val_eur(totale),
+        "pagamento_titolo": f"MODALITA' DI PAGAMENTO ACCETTATE: {pag['descrizione']}",
+        "pag_modalita": pag["modalita"],
+        "pag_dettagli": str(pag["dettagli"])[:40],
+        "pag_data_rif": pag["data_rif"],
+        "pag_giorni": str(pag["giorni"]),
+        "pag_scadenza": pag["scadenza"],
+        "totale_a_pagare": f"TOTALE A PAGARE EUR {_format_val_eur(totale)}",
+    }
+
+    pdf = _PdfFattura(layout["piede"])
+    pdf.add_page()
+
+    _incolla(pdf, _layout_testata(tuple(sorted(emittente.items()))))
+
+    # CLIENTE (numero di righe variabile)
+    pdf.set_x(120)
+    pdf.set_font("Helvetica", "B", 10)
+    pdf.cell(0, 5, cliente.get("Denominazione", ""), ln=1)
+    pdf.set_font("Helvetica", "", 9)
+    if cliente.get("Indirizzo", ""):
+        pdf.set_x(120)
+        pdf.cell(0, 5, cliente["Indirizzo"], ln=1)
+    pdf.set_x(120)
+    pdf.cell(0, 5, f"{cliente.get('CAP','')} {cliente.get('Comune','')} ({cliente.get('Provincia','')}) IT", ln=1)
+    if cliente.get("PIVA"):
+        pdf.set_x(120)
+        pdf.cell(0, 5, f"P.IVA {cliente.get('PIVA','')}", ln=1)
+    elif cliente.get("CF"):
+        pdf.set_x(120)
+        pdf.cell(0, 5, f"CF {cliente.get('CF','')}", ln=1)
+    pdf.ln(6)
+
+    _incolla(pdf, layout["dati_documento"], valori)
+    _incolla(pdf, layout["dettaglio_testata"])
+
+    # DETTAGLIO: interruzioni di pagina esplicite con riporto del parziale
+    limite = pdf.h - MARGINE_PIEDE
+    riepilogo = riepilogo or _riepilogo_iva(righe, imponibile, iva)
+    righe = righe or [{"desc": "", "qta": 0, "prezzo": 0.0, "iva": 22}]
+    # totali di riga e parziali di riporto in centesimi esatti, come l'imponibile
+    subtotale = 0
+    for idx, r in enumerate(righe, start=1):
+        desc = (r.get("desc") or "").replace("\n", " ").strip()
+        testo = _spezza_testo(pdf, desc, DETTAGLIO_W[1] - 2)
+        qta = float(r.get("qta", 0) or 0)
+        prezzo = float(r.get("prezzo", 0.0) or 0.0)
+        iva_r = float(r.get("iva", 22) or 0.0)
+        natura = (r.get("natura", "") or "") if not iva_r else ""
+
+        altezza = max(ROW_HEIGHT, len(testo) * ALTEZZA_RIGA_TESTO + 2)
+        if pdf.get_y() + altezza + ROW_HEIGHT > limite:
+            _riga_riporto(pdf, "A RIPORTARE", subtotale / 100)
+            _pagina_seguente(pdf, valori)
+            _incolla(pdf, layout["dettaglio_testata"])
+            _riga_riporto(pdf, "RIPORTO", subtotale / 100)
+
+        totale_riga = importi_utils.totale_riga(qta, prezzo)
+        _riga_dettaglio(pdf, idx, testo, altezza, qta, prezzo, totale_riga, iva_r, natura)
+        subtotale += totale_riga
+
+    if pdf.get_y() + ALTEZZA_CHIUSURA + (len(riepilogo) - 1) * ROW_HEIGHT > limite:
+        _pagina_seguente(pdf, valori)
+
+    _incolla(pdf, layout["totali"], valori)
+    _incolla(pdf, layout["riepiloghi_testata"])
+
+    w = RIEPILOGO_W
+    for i, voce in enumerate(riepilogo, start=1):
+        aliquota, natura = voce["Aliquota"], voce["Natura"]
+        imponibile_voce, iva_voce = voce["Imponibile"], voce["IVA"]
+        pdf.set_x(10)
+        pdf.cell(w[0], ROW_HEIGHT, _format_val_eur(aliquota), border=1, align="R")
+        pdf.cell(w[1], ROW_HEIGHT, natura, border=1, align="C")
+        pdf.cell(w[2], ROW_HEIGHT, "", border=1)
+        pdf.cell(w[3], ROW_HEIGHT, _format_val_eur(imponibile_voce / 100), border=1, align="R")
+        pdf.cell(w[4], ROW_HEIGHT, _format_val_eur(iva_voce / 100), border=1, align="R")
+        pdf.cell(w[5], ROW_HEIGHT, "" if natura else "IMMEDIATA", border=1, align="C")
+        pdf.cell(w[6], ROW_HEIGHT, "0,00", border=1, align="R")
+        pdf.cell(w[7], ROW_HEIGHT, "0,00", border=1, align="R")
+        # l'ultima riga resta aperta come prima: il blocco pagamento parte da qui
+        pdf.cell(w[8], ROW_HEIGHT, _format_val_eur((imponibile_voce + iva_voce) / 100),
+                 border=1, align="R", ln=0 if i == len(riepilogo) else 1)
+
+    _incolla(pdf, layout["pagamento"], valori)
+
+    out = pdf.output(dest="S")
+    if isinstance(out, (bytes, bytearray)):
+        return bytes(out)
+    return out.encode("latin1")
+
+
+# ==========================
+# SCRITTURA PDF
+# ==========================
+def nome_file_pdf(numero: str, data_doc, tipo_xml: str = "TD01") -> str:
+    """
+    Nome del PDF dalla chiave naturale del documento emesso (numero, tipo, data):
+    lo stesso numero in anni o tipi diversi non sovrascrive un altro PDF.
+    """
+    return f"{str(numero).replace('/', '-')}_{tipo_xml or 'TD01'}_{data_doc.strftime('%Y%m%d')}.pdf"
+
+
+def scrivi_pdf(pdf_path: str, pdf_bytes: bytes) -> None:
+    """Scrittura atomica: file temporaneo nella stessa cartella + os.replace."""
+    cartella = os.path.dirname(os.path.abspath(pdf_path))
+    os.makedirs(cartella, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cartella, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(pdf_bytes)
+        os.replace(tmp_path, pdf_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+# ==========================
+# RIGENERAZIONE IN BLOCCO
+# ==========================
+def _rigenera_blocco(emittente: dict, lavori: list) -> list:
+    """
+    Eseguito nei processi del pool: genera e scrive un blocco di PDF.
+    Restituisce (id, percorso, errore) per ogni documento.
+    """
+    esiti = []
+    for doc_id, pdf_path, args in lavori:
+        try:
+            pdf_bytes = genera_pdf_fattura(**args, emittente=emittente)
+            scrivi_pdf(pdf_path, pdf_bytes)
+            esiti.append((doc_id, pdf_path, None))
+        except Exception as e:
+            esiti.append((doc_id, pdf_path, f"{type(e).__name__}: {e}"))
+    return esiti
+
+
+def _prepara_lavori(df, pdf_dir: str) -> list:
+    """Raccoglie dall'archivio tutto ciò che serve ai processi (che non aprono il DB)."""
+    righe = db_utils.carica_righe_documenti(df.index)
+    riepiloghi = db_utils.carica_riepiloghi_documenti(df.index)
+    clienti = {
+        c["Denominazione"]: c
+        for c in db_utils.carica_controparti().fillna("").to_dict("records")
+    }
+    lavori = []
+    for doc_id, numero, data_doc, controparte, imponibile, iva, importo, tipo_xml in zip(
+        df.index, df["Numero"], df["Data"], df["Controparte"],
+        df["Imponibile"], df["IVA"], df["Importo"], df["TipoXML"],
+    ):
+        lavori.append((
+            int(doc_id),
+            os.path.join(pdf_dir, nome_file_pdf(numero, data_doc, tipo_xml)),
+            {
+                "numero": numero,
+                "data_f": data_doc.date(),
+                "cliente": clienti.get(controparte, {"Denominazione": controparte}),
+                "righe": righe[int(doc_id)],
+                "riepilogo": riepiloghi[int(doc_id)],
+                "imponibile": imponibile / 100,
+                "iva": iva / 100,
+                "totale": importo / 100,
+                "tipo_xml_codice": tipo_xml or "TD01",
+            },
+        ))
+    return lavori
+
+
+def rigenera_pdf(
+    anno: int,
+    mese: int = None,
+    emittente: dict = None,
+    processi: int = None,
+    pdf_dir: str = PDF_DIR,
+    avanzamento=None,
+) -> dict:
+    """
+    Rigenera i PDF dei documenti del periodo (anno, eventualmente mese)
+    distribuendo il lavoro su un pool di processi (default: uno per core).
+    `avanzamento(fatti, totale)` viene chiamata a ogni blocco completato.
+    Restituisce documenti, secondi, pdf_al_secondo ed errori (id -> messaggio).
+    """
+    inizio = time.perf_counter()
+    df = db_utils.carica_documenti()
+    mask = df["Anno"] == anno
+    if mese is not None:
+        mask &= df["Mese"] == mese
+    lavori = _prepara_lavori(df[mask], pdf_dir)
+    emittente = emittente or EMITTENTE_DEFAULT
+    processi = max(1, min(processi or os.cpu_count() or 1, -(-len(lavori) // BLOCCO_RIGENERAZIONE)))
+
+    blocchi = [
+        lavori[i:i + BLOCCO_RIGENERAZIONE]
+        for i in range(0, len(lavori), BLOCCO_RIGENERAZIONE)
+    ]
+    esiti = []
+    if processi == 1:
+        for blocco in blocchi:
+            esiti += _rigenera_blocco(emittente, blocco)
+            if avanzamento:
+                avanzamento(len(esiti), len(lavori))
+    else:
+        # "spawn": i figli non ereditano la connessione SQLite né i thread del padre
+        contesto = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=processi, mp_context=contesto) as pool:
+            for esito in pool.map(_rigenera_blocco, [emittente] * len(blocchi), blocchi):
+                esiti += esito
+                if avanzamento:
+                    avanzamento(len(esiti), len(lavori))
+
+    percorsi = {
+        doc_id: pdf_path
+        for (doc_id, pdf_path, errore), precedente in zip(esiti, df.loc[mask, "PDF"])
+        if errore is None and pdf_path != precedente
+    }
+    db_utils.aggiorna_percorsi_pdf(percorsi)
+
+    secondi = time.perf_counter() - inizio
+    return {
+        "documenti": len(lavori),
+        "processi": processi,
+        "secondi": secondi,
+        "pdf_al_secondo": len(lavori) / secondi if secondi > 0 else 0.0,
+        "errori": {doc_id: errore for doc_id, _, errore in esiti if errore},
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Rigenera i PDF delle fatture di un periodo.")
+    parser.add_argument("anno", type=int)
+    parser.add_argument("--mese", type=int, choices=range(1, 13))
+    parser.add_argument("--processi", type=int, help="default: numero di core")
+    parser.add_argument("--emittente", help="file JSON con i dati dell'emittente")
+    parser.add_argument("--cartella", default=PDF_DIR, help="cartella di destinazione dei PDF")
+    args = parser.parse_args()
+
+    emittente = None
+    if args.emittente:
+        with open(args.emittente, encoding="utf-8") as f:
+            emittente = {**EMITTENTE_DEFAULT, **json.load(f)}
+
+    esito = rigenera_pdf(
+        args.anno, args.mese, emittente=emittente,
+        processi=args.processi, pdf_dir=args.cartella,
+    )
+    print(
+        f"{esito['documenti']} PDF in {esito['secondi']:.1f}s "
+        f"({esito['pdf_al_secondo']:.1f} PDF/s, {esito['processi']} processi)"
+    )
+    for doc_id, errore in esito["errori"].items():
+        print(f"  documento {doc_id}: {errore}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+import db_utils
+import importi_utils
+from db_utils import COLONNE_IMPORTI
+
+MESI_LABEL = [
+    "Gennaio", "Febbraio", "Marzo", "Aprile", "Maggio", "Giugno",
+    "Luglio", "Agosto", "Settembre", "Ottobre", "Novembre", "Dicembre",
+]
+
+TRIMESTRI_LABEL = ["1° Trimestre", "2° Trimestre", "3° Trimestre", "4° Trimestre"]
+
+# Riepiloghi già calcolati: (ciclo, anno) -> (versione dati, DataFrame)
+_cache_riepiloghi = {}
+
+# Liquidazione IVA: interessi (in %) sul dovuto dei trimestrali e soglia minima
+# di versamento in centesimi (sotto si rinvia al periodo successivo)
+INTERESSI_TRIMESTRALI = 1
+SOGLIA_VERSAMENTO = 2582
+
+COLONNE_LIQUIDAZIONE = [
+    "IVA a debito", "IVA a credito", "Credito precedente", "Debito rinviato",
+    "Interessi", "Da versare", "Credito da riportare",
+]
+
+
+def _format_val_eur(val: float) -> str:
+    return (
+        f"{val:,.2f}"
+        .replace(",", "X")
+        .replace(".", ",")
+        .replace("X", ".")
+    )
+
+
+# ==========================
+# AGGREGAZIONI
+# ==========================
+def totali_mensili(df: pd.DataFrame, anno: int) -> pd.DataFrame:
+    """
+    Numero di documenti e totali Importo/Imponibile/IVA (centesimi) dei 12 mesi
+    dell'anno in un solo passaggio vettoriale (np.bincount sul mese, nessun groupby).
+    Richiede le chiavi di periodo Anno/Mese del modello documenti.
+    Indice 1..12, colonne Documenti + COLONNE_IMPORTI.
+    """
+    mask = (df["Anno"] == anno).to_numpy()
+    mesi = df["Mese"].to_numpy()[mask].astype(np.intp)
+    totali = {"Documenti": np.bincount(mesi, minlength=13)[1:]}
+    for col in COLONNE_IMPORTI:
+        # somme di interi in float64: esatte fino a 2**53 centesimi
+        pesi = df[col].to_numpy(dtype=float)[mask]
+        totali[col] = np.bincount(mesi, weights=pesi, minlength=13)[1:].astype(np.int64)
+    return pd.DataFrame(totali, index=range(1, 13))
+
+
+def riepilogo_periodi(df: pd.DataFrame, anno: int) -> pd.DataFrame:
+    """
+    Totali numerici Importo/Imponibile/IVA per mese, trimestre e anno.
+    Un solo passaggio sui documenti: trimestri e anno derivano dai 12 mesi.
+    Colonne: Livello ("Mese"/"Trimestre"/"Anno"), Periodo, importi.
+    """
+    mensili = totali_mensili(df, anno)[COLONNE_IMPORTI]
+    trimestrali = mensili.groupby((mensili.index - 1) // 3).sum()
+    annuale = mensili.sum().to_frame().T
+
+    mensili.insert(0, "Periodo", MESI_LABEL)
+    mensili.insert(0, "Livello", "Mese")
+    trimestrali.insert(0, "Periodo", TRIMESTRI_LABEL)
+    trimestrali.insert(0, "Livello", "Trimestre")
+    annuale.insert(0, "Periodo", "Annuale")
+    annuale.insert(0, "Livello", "Anno")
+
+    return pd.concat([mensili, trimestrali, annuale], ignore_index=True)
+
+
+def _riepilogo(ciclo: str, carica, anno: int) -> pd.DataFrame:
+    versione = db_utils.versione_dati()
+    cached = _cache_riepiloghi.get((ciclo, anno))
+    if cached is not None and cached[0] == versione:
+        return cached[1]
+    df = riepilogo_periodi(carica(), anno)
+    _cache_riepiloghi[(ciclo, anno)] = (versione, df)
+    return df
+
+
+def riepilogo_emesse(anno: int) -> pd.DataFrame:
+    """Riepilogo delle fatture emesse per anno, memoizzato sulla versione dell'archivio."""
+    return _riepilogo("emesse", db_utils.carica_documenti, anno)
+
+
+def riepilogo_ricevute(anno: int) -> pd.DataFrame:
+    """Riepilogo delle fatture ricevute per anno, memoizzato sulla versione dell'archivio."""
+    return _riepilogo("ricevute", db_utils.carica_ricevute, anno)
+
+
+def riepilogo_aliquote_anno(anno: int, ricevute: bool = False) -> pd.DataFrame:
+    """
+    Imponibile e IVA dell'anno per aliquota e natura, dal registro IVA
+    (somme per documento già salvate): nessuna riga di dettaglio riletta.
+    """
+    registro = db_utils.registro_iva(anno, ricevute)
+    return (
+        registro.groupby(["Aliquota", "Natura"], sort=False)[["Imponibile", "IVA"]]
+        .sum()
+        .reset_index()
+        .sort_values(["Aliquota", "Natura"], ascending=[False, True], ignore_index=True)
+    )
+
+
+def liquidazione_iva(anno: int, trimestrale: bool = False) -> pd.DataFrame:
+    """
+    Liquidazione periodica dell'anno (12 mesi o 4 trimestri): IVA delle
+    vendite a debito, IVA degli acquisti a credito, riporto del credito e
+    dei versamenti sotto soglia al periodo successivo, interessi dei
+    trimestrali. Legge solo i totali per mese mantenuti dall'archivio.
+    Il credito dell'anno precedente (dichiarazione annuale) non è incluso.
+    Colonne: Periodo + COLONNE_LIQUIDAZIONE (centesimi int64).
+    """
+    periodi = db_utils.periodi_iva()
+    periodi = periodi[periodi["anno"] == anno]
+    mesi = periodi["mese"].to_numpy().astype(np.intp)
+    imposte = periodi["imposta"].to_numpy()
+    acquisti = periodi["ricevute"].to_numpy()
+    debito = np.bincount(mesi[~acquisti], weights=imposte[~acquisti], minlength=13)[1:]
+    credito = np.bincount(mesi[acquisti], weights=imposte[acquisti], minlength=13)[1:]
+    etichette = MESI_LABEL
+    if trimestrale:
+        debito, credito = debito.reshape(4, 3).sum(axis=1), credito.reshape(4, 3).sum(axis=1)
+        etichette = TRIMESTRI_LABEL
+
+    righe = []
+    riporto_credito = riporto_debito = 0
+    for deb, cred in zip(debito.astype(np.int64).tolist(), credito.astype(np.int64).tolist()):
+        # gli interessi dei trimestrali gravano solo sull'IVA del periodo,
+        # non sul versamento sotto soglia riportato dal periodo precedente
+        dovuto = deb - cred - riporto_credito
+        saldo = dovuto + riporto_debito
+        riga = [deb, cred, riporto_credito, riporto_debito]
+        riporto_credito = riporto_debito = 0
+        interessi = versare = 0
+        if saldo >= SOGLIA_VERSAMENTO:
+            if trimestrale and dovuto > 0:
+                interessi = int(importi_utils.dividi_arrotondando([dovuto * INTERESSI_TRIMESTRALI], 100)[0])
+            versare = saldo + interessi
+        elif saldo > 0:
+            riporto_debito = saldo
+        else:
+            riporto_credito = -saldo
+        righe.append(riga + [interessi, versare, riporto_credito])
+
+    df = pd.DataFrame(righe, columns=COLONNE_LIQUIDAZIONE, dtype="int64")
+    df.insert(0, "Periodo", etichette)
+    return df
+
+
+# ==========================
+# VISUALIZZAZIONE
+# ==========================
+def anno_predefinito(anni: list) -> int:
+    """Anno corrente se presente tra quelli con documenti, altrimenti il più recente."""
+    anno = date.today().year
+    return anno if anno in anni else anni[-1]
+
+
+def _prospetto(df_riep: pd.DataFrame, etichetta_importo: str) -> pd.DataFrame:
+    df_riep = df_riep[["Periodo", "Importo", "Imponibile", "IVA"]]
+    df_riep = df_riep.rename(columns={"Importo": etichetta_importo})
+    for col in [etichetta_importo, "Imponibile", "IVA"]:
+        df_riep[col] = (df_riep[col] / 100).map(_format_val_eur)
+    return df_riep
+
+
+def crea_riepilogo_aliquote(anno: int, ricevute: bool = False) -> None:
+    df = riepilogo_aliquote_anno(anno, ricevute)
+    st.markdown("### 🧾 Riepilogo per aliquota IVA")
+    if df.empty:
+        st.caption("Nessun documento nell'anno selezionato.")
+        return
+    df["Aliquota"] = df["Aliquota"].map(_format_val_eur)
+    for col in ["Imponibile", "IVA"]:
+        df[col] = (df[col] / 100).map(_format_val_eur)
+    st.dataframe(df, use_container_width=True, hide_index=True)
+
+
+def crea_liquidazione_iva() -> None:
+    anni = sorted(int(a) for a in db_utils.periodi_iva()["anno"].unique())
+    if not anni:
+        st.info("Nessun documento con IVA in archivio.")
+        return
+
+    col_anno, col_regime = st.columns([1, 2])
+    with col_anno:
+        anno = st.selectbox("Anno", anni, index=anni.index(anno_predefinito(anni)), key="anno_liquidazione")
+    with col_regime:
+        regime = st.radio("Regime", ["Mensile", "Trimestrale"], horizontal=True, key="regime_liquidazione")
+
+    df = liquidazione_iva(anno, trimestrale=regime == "Trimestrale")
+    col1, col2, col3 = st.columns(3)
+    col1.metric("IVA a debito", f"EUR {_format_val_eur(df['IVA a debito'].sum() / 100)}")
+    col2.metric("IVA a credito", f"EUR {_format_val_eur(df['IVA a credito'].sum() / 100)}")
+    col3.metric("Versamenti", f"EUR {_format_val_eur(df['Da versare'].sum() / 100)}")
+
+    for col in COLONNE_LIQUIDAZIONE:
+        df[col] = (df[col] / 100).map(_format_val_eur)
+    if regime == "Mensile":
+        df = df.drop(columns="Interessi")
+    st.dataframe(df, use_container_width=True, hide_index=True)
+    st.caption(
+        "IVA per data del documento; note di credito stornate. Versamenti sotto "
+        f"{_format_val_eur(SOGLIA_VERSAMENTO / 100)} EUR rinviati al periodo successivo."
+    )
+
+
+def crea_riepilogo_fatture_emesse(df: pd.DataFrame) -> None:
+    if df.empty:
+        st.info("Nessuna fattura emessa per creare il riepilogo.")
+        return
+
+    anni = sorted(int(a) for a in df["Anno"].unique())
+    anno_sel = st.selectbox(
+        "Anno", anni, index=anni.index(anno_predefinito(anni)), key="anno_riepilogo_emesse"
+    )
+
+    st.markdown("### 📊 Prospetto riepilogativo fatture emesse")
+    st.dataframe(
+        _prospetto(riepilogo_emesse(anno_sel), "Importo a pagare"),
+        use_container_width=True,
+        hide_index=True,
+    )
+    crea_riepilogo_aliquote(anno_sel)
+
+
+def crea_riepilogo_fatture_ricevute(anno: int, df: pd.DataFrame = None) -> None:
+    """Prospetto delle ricevute dell'anno; con `df` (es. un solo fornitore) si calcola su quello."""
+    df_riep = riepilogo_ricevute(anno) if df is None else riepilogo_periodi(df, anno)
+    st.markdown("### 📊 Prospetto riepilogativo fatture ricevute")
+    st.dataframe(
+        _prospetto(df_riep, "Importo da pagare"),
+        use_container_width=True,
+        hide_index=True,
+    )
+    if df is None:
+        crea_riepilogo_aliquote(anno, ricevute=True)
@@ -0,0 +1,119 @@
+import argparse
+import io
+import os
+import tempfile
+import time
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import db_utils
+
+# Cartella degli snapshot locali (un file .parquet per tabella)
+SNAPSHOT_DIR = os.getenv("APPFATT_SNAPSHOT_DIR", "snapshot")
+
+ESTENSIONE_PARQUET = ".parquet"
+MIME_PARQUET = "application/vnd.apache.parquet"
+MIME_XLSX = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+# Tabelle dell'archivio locale: nome dello snapshot -> DataFrame condiviso
+TABELLE_ARCHIVIO = {
+    "documenti_emessi": db_utils.carica_documenti,
+    "clienti": db_utils.carica_controparti,
+    "ricevute": db_utils.carica_ricevute,
+}
+
+
+# ==========================
+# PARQUET
+# ==========================
+def parquet_bytes(df: pd.DataFrame, indice: bool = True) -> bytes:
+    """
+    Serializza il DataFrame in Parquet (zstd) con i tipi delle colonne.
+    Con indice=False l'indice non viene salvato: stesso contenuto -> stessi byte.
+    """
+    buffer = io.BytesIO()
+    tabella = pa.Table.from_pandas(df, preserve_index=None if indice else False)
+    pq.write_table(tabella, buffer, compression="zstd")
+    return buffer.getvalue()
+
+
+def df_da_parquet(dati: bytes) -> pd.DataFrame:
+    """DataFrame da un Parquet in memoria (es. scaricato da Drive), senza copie intermedie."""
+    return pq.read_table(pa.BufferReader(dati)).to_pandas()
+
+
+def scrivi_parquet(df: pd.DataFrame, path: str) -> None:
+    """Scrittura atomica: file temporaneo nella stessa cartella, poi os.replace."""
+    cartella = os.path.dirname(os.path.abspath(path))
+    os.makedirs(cartella, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=cartella, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(parquet_bytes(df))
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def leggi_parquet(path: str) -> pd.DataFrame:
+    """Legge uno snapshot locale con memory map: nessuna lettura completa in un buffer."""
+    return pq.read_table(path, memory_map=True).to_pandas()
+
+
+# ==========================
+# SNAPSHOT
+# ==========================
+def percorso_snapshot(nome: str, cartella: str = SNAPSHOT_DIR) -> str:
+    return os.path.join(cartella, nome + ESTENSIONE_PARQUET)
+
+
+def salva_snapshot(tabelle: dict = None, cartella: str = SNAPSHOT_DIR) -> dict:
+    """
+    Scrive uno snapshot Parquet per tabella (nome -> DataFrame; default: le
+    tabelle dell'archivio, es. per prima nota e soci si passano i DataFrame
+    di sessione). Restituisce nome -> percorso.
+    """
+    if tabelle is None:
+        tabelle = {nome: carica() for nome, carica in TABELLE_ARCHIVIO.items()}
+    percorsi = {}
+    for nome, df in tabelle.items():
+        percorsi[nome] = percorso_snapshot(nome, cartella)
+        scrivi_parquet(df, percorsi[nome])
+    return percorsi
+
+
+def carica_snapshot(nome: str, cartella: str = SNAPSHOT_DIR):
+    """DataFrame dello snapshot, oppure None se non esiste."""
+    path = percorso_snapshot(nome, cartella)
+    if not os.path.exists(path):
+        return None
+    return leggi_parquet(path)
+
+
+# ==========================
+# EXCEL (ESPORTAZIONE SU RICHIESTA)
+# ==========================
+def excel_bytes(df: pd.DataFrame, foglio: str = "Dati") -> bytes:
+    """Foglio Excel del DataFrame, con gli importi in euro."""
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine="xlsxwriter") as writer:
+        db_utils.importi_in_euro(df).to_excel(writer, index=False, sheet_name=foglio)
+    return buffer.getvalue()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Snapshot Parquet delle tabelle dell'archivio.")
+    parser.add_argument("--cartella", default=SNAPSHOT_DIR)
+    args = parser.parse_args()
+
+    inizio = time.perf_counter()
+    for nome, path in salva_snapshot(cartella=args.cartella).items():
+        print(f"{nome}: {path} ({os.path.getsize(path) / 1024:.0f} KB)")
+    print(f"Snapshot scritti in {time.perf_counter() - inizio:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+from datetime import date
+
+import pytest
+
+import db_utils
+import report_utils
+
+
+@pytest.fixture
+def archivio(tmp_path, monkeypatch):
+    """Archivio SQLite vuoto in una cartella temporanea, con le cache azzerate."""
+    monkeypatch.setattr(db_utils, "DB_PATH", str(tmp_path / "appfatt.db"))
+    monkeypatch.setattr(db_utils, "_conn", None)
+    monkeypatch.setattr(db_utils, "_cache", {})
+    monkeypatch.setattr(report_utils, "_cache_riepiloghi", {})
+    yield db_utils
+    if db_utils._conn is not None:
+        db_utils._conn.close()
+
+
+def documento(numero: str = "FT2026001", data_doc=date(2026, 3, 1), **campi) -> dict:
+    """Documento emesso minimo per db_utils; i campi indicati sostituiscono i default."""
+    return {
+        "Tipo": "Emessa",
+        "Numero": numero,
+        "Data": data_doc,
+        "Controparte": "ACME SRL",
+        "Imponibile": 100.0,
+        "IVA": 22.0,
+        "Importo": 122.0,
+        "TipoXML": "TD01",
+        "Stato": "Creazione",
+        "UUID": "",
+        "PDF": "",
+        **campi,
+    }
+
+
+def riga(prezzo: float = 100.0, qta: float = 1, iva: float = 22, natura: str = "", desc: str = "Servizio") -> dict:
+    """Riga nel formato dell'editor."""
+    return {"desc": desc, "qta": qta, "prezzo": prezzo, "iva": iva, "natura": natura}
@@ -0,0 +1,167 @@
+import io
+import threading
+import zipfile
+from datetime import date
+
+import pytest
+
+import ade_utils
+import xml_utils
+from conftest import riga
+from test_xml import CLIENTE, EMITTENTE
+
+FORNITORE = {
+    "Denominazione": "FORNITORE SPA", "Indirizzo": "Corso Italia 3", "CAP": "10100",
+    "Comune": "Torino", "Provincia": "TO", "PIVA": "05555555555",
+}
+
+
+def _emessa(numero: str, prezzo: float = 100.0) -> bytes:
+    return xml_utils.genera_xml_fattura(numero, date(2026, 3, 1), CLIENTE, [riga(prezzo)], EMITTENTE)
+
+
+def _ricevuta(numero: str, righe=None) -> bytes:
+    return xml_utils.genera_xml_fattura(
+        numero, date(2026, 2, 10), EMITTENTE, righe or [riga(50), riga(10, iva=10)], FORNITORE,
+    )
+
+
+def _metadati(nome_file: str, id_sdi: str) -> bytes:
+    return (
+        f'<?xml version="1.0"?><FileMetadati xmlns="http://www.fatturapa.gov.it/sdi/messaggi/v1.0">'
+        f"<IdentificativoSdI>{id_sdi}</IdentificativoSdI><NomeFile>{nome_file}</NomeFile></FileMetadati>"
+    ).encode()
+
+
+def _zip(file: dict) -> io.BytesIO:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zf:
+        for nome, dati in file.items():
+            zf.writestr(nome, dati)
+    buffer.seek(0)
+    return buffer
+
+
+def _pacchetto() -> dict:
+    return {
+        "IT01234567890_00001.xml": _emessa("FT1"),
+        "IT01234567890_00002.xml": _emessa("FT2", 200),
+        "IT05555555555_00009.xml": _ricevuta("A/9"),
+        "IT05555555555_00009_metaDato.xml": _metadati("IT05555555555_00009.xml", "4242"),
+        "leggimi.txt": b"testo",
+    }
+
+
+def test_leggi_fattura_incrementale():
+    (fattura,) = ade_utils.leggi_fattura(io.BytesIO(_ricevuta("A/9")))
+    assert fattura["cedente"]["PIVA"] == "05555555555"
+    assert (fattura["Numero"], fattura["Data"], fattura["TipoXML"]) == ("A/9", "2026-02-10", "TD01")
+    assert [r["prezzo"] for r in fattura["righe"]] == [50.0, 10.0]
+    assert (fattura["imponibile"], round(fattura["imposta"], 2)) == (60.0, 12.0)
+    assert list(ade_utils.leggi_fattura(io.BytesIO(_metadati("x.xml", "1")))) == []
+
+
+def test_importa_emesse_e_ricevute(archivio):
+    esito = ade_utils.importa_pacchetto(_zip(_pacchetto()), EMITTENTE, processi=1)
+
+    assert {k: esito[k] for k in ("file", "documenti", "aggiornati", "emesse", "ricevute", "ignorati", "errori")} == {
+        "file": 5, "documenti": 3, "aggiornati": 0, "emesse": 2, "ricevute": 1, "ignorati": 2, "errori": {},
+    }
+    emesse = archivio.carica_documenti()
+    assert sorted(emesse["Numero"]) == ["FT1", "FT2"]
+    assert set(emesse["Controparte"]) == {"ACME SRL"}
+    assert set(emesse["Stato"]) == {"Inviato"}
+
+    ricevute = archivio.carica_ricevute()
+    assert ricevute[["Numero", "Controparte", "Emittente", "IdSdI", "Importo"]].values.tolist() == [
+        ["A/9", "FORNITORE SPA", "05555555555", "4242", 7200],
+    ]
+    rubrica = archivio.carica_controparti().set_index("Denominazione")["Tipo"]
+    assert rubrica.to_dict() == {"ACME SRL": "Cliente", "FORNITORE SPA": "Fornitore"}
+
+
+def test_reimportazione_idempotente(archivio):
+    ade_utils.importa_pacchetto(_zip(_pacchetto()), EMITTENTE, processi=1)
+    ids = archivio.carica_documenti().index.tolist()
+
+    file = _pacchetto()
+    file["IT01234567890_00002.xml"] = _emessa("FT2", 300)
+    esito = ade_utils.importa_pacchetto(_zip(file), EMITTENTE, processi=1)
+
+    assert (esito["documenti"], esito["aggiornati"]) == (0, 3)
+    emesse = archivio.carica_documenti()
+    assert emesse.index.tolist() == ids
+    assert emesse.set_index("Numero").loc["FT2", "Imponibile"] == 30000
+    assert len(archivio.carica_ricevute()) == 1
+
+
+def test_zip_annidati_ed_errori(archivio):
+    interno = _zip({"IT05555555555_00010.xml": _ricevuta("A/10")}).getvalue()
+    esito = ade_utils.importa_pacchetto(
+        _zip({"mese.zip": interno, "rotto.xml": b"<FatturaElettronica><", "IT01234567890_00001.xml": _emessa("FT1")}),
+        EMITTENTE, processi=1,
+    )
+    assert (esito["emesse"], esito["ricevute"]) == (1, 1)
+    assert list(esito["errori"]) == ["rotto.xml"]
+    assert esito["errori"]["rotto.xml"].startswith("XMLSyntaxError")
+    assert archivio.carica_ricevute()["Numero"].tolist() == ["A/10"]
+
+
+def test_avanzamento_per_file(archivio):
+    chiamate = []
+    ade_utils.importa_pacchetto(_zip(_pacchetto()), EMITTENTE, processi=1, avanzamento=lambda *a: chiamate.append(a))
+    assert [(fatti, totale) for fatti, totale, _ in chiamate] == [(i, 5) for i in range(1, 6)]
+
+
+@pytest.mark.parametrize("piva, attesa", [("IT01234567890", "01234567890"), (" abc ", "ABC"), ("IT123", "IT123")])
+def test_id_fiscale(piva, attesa):
+    assert ade_utils._id_fiscale(piva) == attesa
+
+
+def test_pool_di_processi_come_sequenziale(archivio, monkeypatch):
+    monkeypatch.setattr(ade_utils, "FILE_PER_COMPITO", 4)
+    file = {f"IT01234567890_{i:05d}.xml": _emessa(f"FT{i}") for i in range(1, 11)}
+    file.update({f"IT05555555555_{i:05d}.xml": _ricevuta(f"A/{i}") for i in range(1, 6)})
+    file["IT05555555555_00003_metaDato.xml"] = _metadati("IT05555555555_00003.xml", "77")
+
+    esito = ade_utils.importa_pacchetto(_zip(file), EMITTENTE, processi=2)
+
+    assert esito["processi"] == 2
+    assert (esito["file"], esito["documenti"], esito["emesse"], esito["ricevute"]) == (16, 15, 10, 5)
+    ricevute = archivio.carica_ricevute().set_index("Numero")["IdSdI"]
+    assert ricevute["A/3"] == "77" and ricevute["A/1"] == ""
+
+
+def test_compiti_non_separano_fattura_e_metadati(monkeypatch):
+    monkeypatch.setattr(ade_utils, "FILE_PER_COMPITO", 2)
+    file = {
+        "IT1_00001.xml": b"<a/>",
+        "IT1_00002.xml.p7m": b"",
+        "IT1_00002_metaDato.xml": b"<a/>",
+        "IT1_00003.xml": b"<a/>",
+    }
+    with zipfile.ZipFile(_zip(file)) as zf:
+        compiti = [[nome for nome, _ in compito] for compito in ade_utils._compiti(zf)]
+    assert compiti == [["IT1_00001.xml", "IT1_00002.xml.p7m", "IT1_00002_metaDato.xml"], ["IT1_00003.xml"]]
+
+
+@pytest.mark.parametrize("dimensione_blocco", [1, 500])
+def test_errore_dello_scrittore_non_blocca_l_importazione(archivio, monkeypatch, dimensione_blocco):
+    def inserisci_documenti(blocco):
+        raise RuntimeError("disco pieno")
+
+    monkeypatch.setattr(ade_utils, "BLOCCO_IMPORT", dimensione_blocco)
+    monkeypatch.setattr(ade_utils.db_utils, "inserisci_documenti", inserisci_documenti)
+    esito = {}
+
+    def importa():
+        try:
+            ade_utils.importa_pacchetto(_zip(_pacchetto()), EMITTENTE, processi=1)
+        except RuntimeError as e:
+            esito["errore"] = str(e)
+
+    lavoro = threading.Thread(target=importa, daemon=True)
+    lavoro.start()
+    lavoro.join(timeout=10)
+    assert not lavoro.is_alive()
+    assert esito == {"errore": "disco pieno"}
@@ -0,0 +1,112 @@
+from datetime import date
+
+import pandas as pd
+
+from conftest import documento, riga
+
+
+def test_documento_salvato_e_riletto(archivio):
+    doc_id = archivio.inserisci_documento(documento(Imponibile=100.1, IVA=22.02, Importo=122.12), [riga(100.1)])
+
+    df = archivio.carica_documenti()
+    assert list(df.index) == [doc_id]
+    salvato = df.loc[doc_id]
+    assert salvato["Numero"] == "FT2026001"
+    assert salvato["Data"] == pd.Timestamp(2026, 3, 1)
+    assert (salvato["Imponibile"], salvato["IVA"], salvato["Importo"]) == (10010, 2202, 12212)
+    assert archivio.carica_righe(doc_id) == [
+        {"desc": "Servizio", "qta": 1.0, "prezzo": 100.1, "iva": 22, "natura": ""}
+    ]
+
+
+def test_data_accettata_in_piu_formati(archivio):
+    for numero, data_doc in [("A", "05/04/2026"), ("B", "2026-04-05"), ("C", date(2026, 4, 5))]:
+        archivio.inserisci_documento(documento(numero, data_doc))
+    assert set(archivio.carica_documenti()["Data"]) == {pd.Timestamp(2026, 4, 5)}
+
+
+def test_data_tipizzata_con_anno_e_mese(archivio):
+    archivio.inserisci_documento(documento("A", "31/12/2025"))
+    archivio.inserisci_documento(documento("B", date(2026, 1, 2)))
+    salvate = [r[0] for r in archivio._get_conn().execute("SELECT Data FROM documenti ORDER BY id")]
+    assert salvate == ["2025-12-31", "2026-01-02"]
+
+    df = archivio.carica_documenti()
+    assert pd.api.types.is_datetime64_dtype(df["Data"].dtype)
+    assert (str(df["Anno"].dtype), str(df["Mese"].dtype)) == ("int16", "int8")
+    assert list(zip(df["Anno"], df["Mese"])) == [(2025, 12), (2026, 1)]
+    vuoti = archivio.documenti_vuoti()
+    assert list(vuoti.dtypes.astype(str)[["Data", "Anno", "Mese"]]) == ["datetime64[ns]", "int16", "int8"]
+
+
+def test_scrittura_invalida_la_cache(archivio):
+    prima = archivio.carica_documenti()
+    assert archivio.carica_documenti() is prima
+
+    doc_id = archivio.inserisci_documento(documento())
+    assert len(archivio.carica_documenti()) == 1
+
+    archivio.aggiorna_documento(doc_id, {"Stato": "Inviato"})
+    assert archivio.carica_documenti().loc[doc_id, "Stato"] == "Inviato"
+
+    archivio.elimina_documento(doc_id)
+    assert archivio.carica_documenti().empty
+    assert archivio.carica_righe_documenti([doc_id]) == {doc_id: []}
+
+
+def test_aggiorna_sostituisce_le_righe(archivio):
+    doc_id = archivio.inserisci_documento(documento(), [riga(10), riga(20)])
+    archivio.aggiorna_documento(doc_id, {"Imponibile": 30}, righe=[riga(30)])
+    assert [r["prezzo"] for r in archivio.carica_righe(doc_id)] == [30.0]
+
+
+def test_ricevute_escluse_dalle_emesse(archivio):
+    archivio.inserisci_documento(documento("FT1"))
+    archivio.inserisci_documento(documento("R1", Tipo=archivio.TIPO_RICEVUTA, Emittente="IT01234567890"))
+    assert list(archivio.carica_documenti()["Numero"]) == ["FT1"]
+    assert list(archivio.carica_ricevute()["Numero"]) == ["R1"]
+
+
+def test_rubrica_aggiorna_per_denominazione(archivio):
+    archivio.salva_controparte({"Denominazione": "ACME SRL", "PIVA": "01234567890"})
+    archivio.salva_controparte({"Denominazione": "ACME SRL", "Comune": "Roma"})
+    archivio.aggiungi_controparti([{"Denominazione": "ACME SRL", "PIVA": "99"}, {"Denominazione": "BETA"}])
+
+    rubrica = archivio.carica_controparti().set_index("Denominazione")
+    assert list(rubrica.index) == ["ACME SRL", "BETA"]
+    assert (rubrica.loc["ACME SRL", "PIVA"], rubrica.loc["ACME SRL", "Comune"]) == ("01234567890", "Roma")
+    assert archivio.indice_controparti()["ACME SRL"] == ("01234567890", "")
+
+
+def test_indice_controparti_ricostruito_solo_con_la_rubrica(archivio):
+    archivio.salva_controparte({"Denominazione": "ACME SRL", "PIVA": " 01234567890 "})
+    indice = archivio.indice_controparti()
+    assert indice == {"ACME SRL": ("01234567890", "")}
+    archivio.inserisci_documento(documento())
+    assert archivio.indice_controparti() is indice
+    archivio.salva_controparte({"Denominazione": "BETA", "CF": "RSSMRA80A01H501U"})
+    assert archivio.indice_controparti()["BETA"] == ("", "RSSMRA80A01H501U")
+
+
+def test_schema_importi_in_euro_portati_in_centesimi(archivio):
+    df = pd.DataFrame({"Importo": [122.5, 0.1 + 0.2, None], "IVA": [22, 0, 5]})
+    df = archivio.applica_schema(df)
+    assert df["Importo"].tolist() == [12250, 30, 0]
+    assert df["IVA"].tolist() == [22, 0, 5]
+    assert str(df["Importo"].dtype) == "int64"
+
+
+def test_schema_date_con_orario_o_giorno_mese_anno(archivio):
+    df = pd.DataFrame({"Data": ["2026-03-01 10:30:00", "15/04/2026", None]})
+    df = archivio.applica_schema(df)
+    assert df["Data"].tolist()[:2] == [pd.Timestamp("2026-03-01"), pd.Timestamp("2026-04-15")]
+    assert pd.isna(df["Data"].iloc[2])
+
+
+def test_concatenazione_conserva_i_centesimi(archivio):
+    parti = [
+        archivio.documenti_vuoti(["Numero", "Importo"]).assign(Numero=["A"], Importo=[12250]),
+        archivio.documenti_vuoti(["Numero"]).assign(Numero=["B"]),
+    ]
+    df = archivio.concatena_documenti(parti, ignore_index=True)
+    assert df["Importo"].tolist() == [12250, 0]
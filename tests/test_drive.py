@@ -0,0 +1,196 @@
+import logging
+from datetime import date
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+
+import drive_utils
+from conftest import documento
+
+
+@pytest.fixture
+def drive(tmp_path, monkeypatch):
+    """Drive locale in una cartella temporanea; conta caricamenti e download."""
+    monkeypatch.setattr(drive_utils, "DRIVE_LOCALE_DIR", str(tmp_path / "drive"))
+    monkeypatch.setattr(drive_utils, "_partizioni_salvate", {})
+    monkeypatch.setattr(drive_utils, "_partizioni_scaricate", {})
+    monkeypatch.setattr(drive_utils, "_file_ids", {})
+    chiamate = {"caricati": [], "scaricati": 0}
+    carica, scarica = drive_utils._carica_file, drive_utils._scarica
+
+    def _carica_file(service, folder_id, filename, *args):
+        chiamate["caricati"].append(filename)
+        return carica(service, folder_id, filename, *args)
+
+    def _scarica(service, file_id):
+        chiamate["scaricati"] += 1
+        return scarica(service, file_id)
+
+    monkeypatch.setattr(drive_utils, "_carica_file", _carica_file)
+    monkeypatch.setattr(drive_utils, "_scarica", _scarica)
+    return chiamate
+
+
+def _prima_nota() -> pd.DataFrame:
+    return pd.DataFrame({
+        "Data": ["2026-01-15", "2026-01-20", "2026-02-03", "2026-03-09", None],
+        "Descrizione": ["affitto", "luce", "quote", "gara", "saldo iniziale"],
+        "Importo": [-500.0, -80.5, 1200.0, 300.0, 1000.0],
+    })
+
+
+def _remoti() -> list:
+    service, folder_id, _ = drive_utils._get_drive_service()
+    return sorted(drive_utils._elenca_partizioni(service, folder_id, "prima_nota"))
+
+
+def test_una_partizione_per_mese(drive):
+    ok, messaggio = drive_utils.salva_df_su_drive_incrementale(_prima_nota(), "prima_nota")
+    assert ok and messaggio == "4 partizioni aggiornate su Drive, 0 eliminate."
+    assert _remoti() == [
+        "prima_nota__2026-01.parquet",
+        "prima_nota__2026-02.parquet",
+        "prima_nota__2026-03.parquet",
+        "prima_nota__senza-data.parquet",
+    ]
+
+
+def test_caricate_solo_le_partizioni_cambiate(drive):
+    df = _prima_nota()
+    drive_utils.salva_df_su_drive_incrementale(df, "prima_nota")
+    drive["caricati"].clear()
+
+    assert drive_utils.salva_df_su_drive_incrementale(df, "prima_nota")[1].startswith("0 partizioni")
+    df.loc[2, "Importo"] = 1250.0
+    assert drive_utils.salva_df_su_drive_incrementale(df, "prima_nota")[1].startswith("1 partizioni")
+    assert drive["caricati"] == ["prima_nota__2026-02.parquet"]
+
+
+def test_nuovo_processo_confronta_l_md5_remoto(drive, monkeypatch):
+    df = _prima_nota()
+    drive_utils.salva_df_su_drive_incrementale(df, "prima_nota")
+    drive["caricati"].clear()
+    # nessuna impronta in memoria: si serializza, ma l'md5 coincide e non si carica
+    monkeypatch.setattr(drive_utils, "_partizioni_salvate", {})
+    drive_utils.salva_df_su_drive_incrementale(df, "prima_nota")
+    assert drive["caricati"] == []
+
+
+def test_mesi_svuotati_eliminati(drive):
+    df = _prima_nota()
+    drive_utils.salva_df_su_drive_incrementale(df, "prima_nota")
+    ok, messaggio = drive_utils.salva_df_su_drive_incrementale(df[df["Data"] != "2026-03-09"], "prima_nota")
+    assert messaggio == "0 partizioni aggiornate su Drive, 1 eliminate."
+    assert "prima_nota__2026-03.parquet" not in _remoti()
+
+
+def test_caricamento_riusa_le_partizioni_invariate(drive):
+    df = _prima_nota()
+    drive_utils.salva_df_su_drive_incrementale(df, "prima_nota")
+
+    letto, err = drive_utils.carica_df_da_drive_incrementale("prima_nota")
+    assert err is None and drive["scaricati"] == 4
+    pd.testing.assert_frame_equal(letto, df)
+
+    df.loc[0, "Descrizione"] = "affitto gennaio"
+    drive_utils.salva_df_su_drive_incrementale(df, "prima_nota")
+    letto, _ = drive_utils.carica_df_da_drive_incrementale("prima_nota")
+    assert drive["scaricati"] == 5
+    assert letto.loc[0, "Descrizione"] == "affitto gennaio"
+
+
+def test_date_in_formato_italiano():
+    df = pd.DataFrame({"Data": ["15/01/2026", "03/02/2026"], "Importo": [1.0, 2.0]})
+    partizioni = drive_utils._partizioni(df, "Data")
+    assert list(partizioni) == ["2026-01", "2026-02"]
+
+
+def test_documenti_conservano_lo_schema(drive, archivio):
+    archivio.inserisci_documenti([
+        (documento("FT1", date(2026, 1, 10)), []),
+        (documento("FT2", date(2026, 2, 10)), []),
+    ])
+    df = archivio.carica_documenti().reset_index(drop=True)
+    drive_utils.salva_df_su_drive_incrementale(df, "documenti")
+    letto, _ = drive_utils.carica_df_da_drive_incrementale("documenti")
+    assert letto.dtypes.to_dict() == df.dtypes.to_dict()
+    assert letto["Numero"].tolist() == ["FT1", "FT2"]
+
+
+def test_senza_configurazione(monkeypatch):
+    monkeypatch.setattr(drive_utils, "DRIVE_LOCALE_DIR", None)
+    monkeypatch.delenv("GDRIVE_SERVICE_ACCOUNT_JSON", raising=False)
+    ok, messaggio = drive_utils.salva_df_su_drive_incrementale(_prima_nota(), "prima_nota")
+    assert not ok and "non configurato" in messaggio
+
+
+def test_file_id_ricordato_fino_alla_scadenza(drive, monkeypatch):
+    ricerche = []
+    lista = drive_utils._FileLocali.list
+
+    def list(self, q="", **kwargs):
+        ricerche.append(q)
+        return lista(self, q, **kwargs)
+
+    monkeypatch.setattr(drive_utils._FileLocali, "list", list)
+    drive_utils.salva_df_su_drive(_prima_nota(), "prima_nota.parquet")
+    drive_utils.salva_df_su_drive(_prima_nota(), "prima_nota.parquet")
+    assert drive_utils.carica_df_da_drive("prima_nota.parquet")[1] is None
+    assert len(ricerche) == 1
+
+    (chiave, (file_id, _)), = drive_utils._file_ids.items()
+    monkeypatch.setattr(drive_utils, "TTL_FILE_ID", 0)
+    drive_utils._ricorda_file_id(*chiave, file_id)
+    drive_utils.carica_df_da_drive("prima_nota.parquet")
+    assert len(ricerche) == 2
+
+
+def test_file_rimosso_da_drive(drive):
+    service, folder_id, _ = drive_utils._get_drive_service()
+    drive_utils.salva_df_su_drive(_prima_nota(), "prima_nota.parquet")
+    vecchio = drive_utils._file_id(service, folder_id, "prima_nota.parquet")
+    service.files().delete(fileId=vecchio).execute()
+
+    assert drive_utils.carica_df_da_drive("prima_nota.parquet") == (None, "File non trovato su Drive.")
+    # l'id in memoria non esiste più: il salvataggio ricrea il file
+    drive_utils.salva_df_su_drive(_prima_nota(), "prima_nota.parquet")
+    df, err = drive_utils.carica_df_da_drive("prima_nota.parquet")
+    assert err is None and len(df) == 5
+    assert drive_utils._file_id(service, folder_id, "prima_nota.parquet") != vecchio
+
+
+def test_ricerca_per_nome_esatto(drive):
+    drive_utils.salva_df_su_drive(_prima_nota(), "prima_nota.parquet")
+    drive_utils.salva_df_su_drive(pd.DataFrame({"Nome": ["Rossi"]}), "soci.parquet")
+    df, err = drive_utils.carica_df_da_drive("prima_nota.parquet")
+    assert err is None and len(df) == 5
+    assert drive_utils.carica_df_da_drive("soci.parquet")[0]["Nome"].tolist() == ["Rossi"]
+
+
+
+def test_avvio_con_un_file_illeggibile(drive, monkeypatch, caplog):
+    sessione = {}
+    monkeypatch.setattr(drive_utils, "st", SimpleNamespace(session_state=sessione))
+    drive_utils.salva_df_su_drive(_prima_nota(), "prima_nota_asd_ssd.parquet")
+    drive_utils.salva_df_su_drive(pd.DataFrame({"Nome": ["Rossi"]}), "ricevute_asd_ssd.parquet")
+    service, folder_id, _ = drive_utils._get_drive_service()
+    drive_utils._carica_file(
+        service, folder_id, "soci_asd_ssd.parquet", b"non parquet", drive_utils.MIME_PARQUET, None
+    )
+
+    with caplog.at_level(logging.INFO, logger=drive_utils._log.name):
+        drive_utils.carica_dati_iniziali_da_drive()
+
+    assert set(sessione) == {"prima_nota", "ricevute_emesse"}
+    assert len(sessione["prima_nota"]) == 5
+    assert sessione["ricevute_emesse"]["PDF"].isna().all()
+    errori = [r.getMessage() for r in caplog.records if "soci_asd_ssd" in r.getMessage()]
+    assert len(errori) == 1 and "ArrowInvalid" in errori[0]
+
+    # i file già in sessione non vengono riletti
+    scaricati = drive["scaricati"]
+    drive_utils.salva_df_su_drive(pd.DataFrame({"Nome": ["Bianchi"]}), "soci_asd_ssd.parquet")
+    drive_utils.carica_dati_iniziali_da_drive()
+    assert sessione["soci"]["Nome"].tolist() == ["Bianchi"]
+    assert drive["scaricati"] == scaricati + 1
@@ -0,0 +1,105 @@
+from datetime import date
+
+import pytest
+
+from conftest import documento, riga
+
+
+def _ricevuta(numero="A/1", **campi) -> dict:
+    campi = {"Tipo": "Ricevuta", "Emittente": "05555555555", "Controparte": "FORNITORE SPA", **campi}
+    return documento(numero, date(2026, 2, 10), **campi)
+
+
+def test_chiave_naturale_normalizzata(archivio):
+    chiave = archivio.chiave_documento("ft1 ", "01/03/2026", "td01", "")
+    assert chiave == archivio.chiave_documento("FT1", date(2026, 3, 1))
+    assert chiave != archivio.chiave_documento("FT1", date(2026, 3, 1), "TD04")
+    assert chiave != archivio.chiave_documento("FT1", date(2026, 3, 1), emittente="05555555555")
+
+
+def test_inserimento_duplicato_rifiutato(archivio):
+    archivio.inserisci_documento(documento("FT1"), [riga()])
+    with pytest.raises(archivio.DocumentoDuplicato, match="ft1 del 2026-03-01"):
+        archivio.inserisci_documento(documento("ft1"), [riga(50)])
+    assert len(archivio.carica_documenti()) == 1
+    assert archivio.trova_documento("FT1", "2026-03-01") is not None
+    assert archivio.trova_documento("FT1", "2026-03-02") is None
+
+
+def test_stesso_numero_da_fornitori_diversi(archivio):
+    archivio.inserisci_documento(_ricevuta())
+    archivio.inserisci_documento(_ricevuta(Emittente="06666666666"))
+    archivio.inserisci_documento(documento("A/1", date(2026, 2, 10)))
+    assert len(archivio.carica_ricevute()) == 2
+
+
+def test_upsert_conserva_i_campi_gia_valorizzati(archivio):
+    doc_id = archivio.inserisci_documento(_ricevuta(UUID="u-1", PDF="a1.pdf", IdSdI="99"), [riga()])
+
+    esito = archivio.inserisci_documenti([
+        (_ricevuta(Importo=150.0, Stato="Registrato"), [riga(), riga(20)]),
+        (_ricevuta("A/2"), []),
+    ])
+
+    assert esito == (1, 1, {})
+    ricevuta = archivio.carica_ricevute().loc[doc_id]
+    assert (ricevuta["UUID"], ricevuta["PDF"], ricevuta["IdSdI"]) == ("u-1", "a1.pdf", "99")
+    assert (ricevuta["Importo"], ricevuta["Stato"]) == (15000, "Registrato")
+    assert len(archivio.carica_righe(doc_id)) == 2
+
+
+def test_upsert_trovato_per_id_sdi(archivio):
+    doc_id = archivio.inserisci_documento(_ricevuta(IdSdI="4242"))
+    # il fornitore ha corretto la data: la chiave cambia, l'IdSdI no
+    esito = archivio.inserisci_documenti([(_ricevuta(IdSdI="4242", Data=date(2026, 2, 11)), [])])
+    assert esito == (0, 1, {})
+    ricevute = archivio.carica_ricevute()
+    assert ricevute.index.tolist() == [doc_id]
+    assert ricevute.loc[doc_id, "Data"].date() == date(2026, 2, 11)
+
+
+def test_id_sdi_univoco(archivio):
+    archivio.inserisci_documento(_ricevuta(IdSdI="4242"))
+    with pytest.raises(archivio.DocumentoDuplicato):
+        archivio.inserisci_documento(_ricevuta("A/2", IdSdI="4242"))
+    # IdSdI vuoto non è un identificativo
+    archivio.inserisci_documento(_ricevuta("A/3"))
+    archivio.inserisci_documento(_ricevuta("A/4"))
+
+
+def test_conflitto_riportato_senza_annullare_il_blocco(archivio):
+    archivio.inserisci_documento(_ricevuta("A/1", IdSdI="1"))
+    archivio.inserisci_documento(_ricevuta("A/2"))
+
+    # trovato per IdSdI, ma la nuova chiave (A/2) appartiene già a un altro documento
+    esito = archivio.inserisci_documenti([
+        (_ricevuta("A/3"), []),
+        (_ricevuta("A/2", IdSdI="1", Importo=999.0), []),
+        (_ricevuta("A/4"), []),
+    ])
+
+    inseriti, aggiornati, conflitti = esito
+    assert (inseriti, aggiornati) == (2, 0)
+    assert conflitti == {1: "Documento A/2 del 2026-02-10 già presente"}
+    ricevute = archivio.carica_ricevute().set_index("Numero")
+    assert sorted(ricevute.index) == ["A/1", "A/2", "A/3", "A/4"]
+    assert ricevute.loc["A/2", "Importo"] == 12200
+
+
+def test_aggiorna_sulla_chiave_di_un_altro_documento(archivio):
+    archivio.inserisci_documento(documento("FT1"))
+    doc_id = archivio.inserisci_documento(documento("FT2"))
+    with pytest.raises(archivio.DocumentoDuplicato):
+        archivio.aggiorna_documento(doc_id, {"Numero": "FT1"})
+    assert archivio.carica_documenti().loc[doc_id, "Numero"] == "FT2"
+
+
+def test_duplica_con_nuovo_numero(archivio):
+    doc_id = archivio.inserisci_documento(documento("FT1", Importo=122.0), [riga()])
+    copia, numero = archivio.duplica_documento(doc_id, "FT2", date(2026, 4, 1))
+    assert numero == "FT2"
+    doc = archivio.carica_documenti().loc[copia]
+    assert (doc["Numero"], doc["Importo"]) == ("FT2", 12200)
+    assert archivio.carica_righe(copia) == archivio.carica_righe(doc_id)
+    with pytest.raises(archivio.DocumentoDuplicato):
+        archivio.duplica_documento(doc_id, "FT2", date(2026, 4, 1))
@@ -0,0 +1,78 @@
+import random
+from decimal import Decimal, ROUND_HALF_UP
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import db_utils
+import importi_utils
+from conftest import documento, riga
+
+
+def _riferimento(qta, prezzo) -> int:
+    """PrezzoTotale in centesimi calcolato con Decimal."""
+    totale = Decimal(str(qta)) * Decimal(str(prezzo))
+    return int(totale.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP) * 100)
+
+
+def test_arrotondamento_commerciale():
+    valori = [5, 49, 50, 149, 150, 151, -49, -50, -150, -151]
+    attesi = [0, 0, 1, 1, 2, 2, 0, -1, -2, -2]
+    assert importi_utils.dividi_arrotondando(valori, 100).tolist() == attesi
+    assert [importi_utils._dividi(v, 100) for v in valori] == attesi
+
+
+@pytest.mark.parametrize("qta, prezzo, atteso", [
+    (1, 1.005, 101),
+    (1, 2.675, 268),
+    (3, 0.1, 30),
+    (0.333, 3, 100),
+    (2.5, 0.01, 3),
+    (-1, 1.005, -101),
+    ("1.5", "10", 1500),
+    (None, 10, 0),
+    (float("nan"), 10, 0),
+    ("n/d", 10, 0),
+])
+def test_totale_di_riga_al_centesimo(qta, prezzo, atteso):
+    assert importi_utils.totali_riga([qta], [prezzo]).tolist() == [atteso]
+    assert importi_utils.totale_riga(qta, prezzo) == atteso
+
+
+def test_totali_riga_come_decimal():
+    generatore = random.Random(23)
+    qta = [round(generatore.uniform(0, 1000), generatore.randint(0, 4)) for _ in range(5000)]
+    prezzi = [round(generatore.uniform(-500, 5000), generatore.randint(0, 6)) for _ in range(5000)]
+    calcolati = importi_utils.totali_riga(qta, prezzi).tolist()
+    assert calcolati == [_riferimento(q, p) for q, p in zip(qta, prezzi)]
+    assert calcolati == [importi_utils.totale_riga(q, p) for q, p in zip(qta, prezzi)]
+
+
+def test_importo_fuori_scala():
+    with pytest.raises(OverflowError):
+        importi_utils.totali_riga([1_000_000], [1_000_000])
+
+
+def test_iva_arrotondata_una_volta_per_aliquota():
+    # 3 x 0,10 al 22%: riga per riga 0,02 x 3 = 0,06; sulla voce 0,30 x 22% = 0,066 -> 0,07
+    totali = importi_utils.totali_fattura([riga(0.1), riga(0.1), riga(0.1)])
+    assert totali == {"Imponibile": 30, "IVA": 7, "Importo": 37}
+
+
+@pytest.mark.parametrize("valore, attesi", [
+    (1.005, 101), ("2.675", 268), (Decimal("-0.005"), -1), (None, 0), ("", 0), (1e10, 1_000_000_000_000),
+])
+def test_centesimi_e_ritorno(valore, attesi):
+    assert db_utils.centesimi(valore) == attesi
+    assert db_utils.euro(attesi) == Decimal(attesi).scaleb(-2)
+
+
+def test_importi_in_archivio_esatti(archivio):
+    for i in range(10):
+        archivio.inserisci_documento(documento(f"FT{i}", Imponibile=0.1, IVA=0.02, Importo=0.12))
+    df = archivio.carica_documenti()
+    assert df["Importo"].dtype == np.int64
+    assert int(df["Importo"].sum()) == 120
+    assert db_utils.euro(df["Importo"].sum()) == Decimal("1.20")
+    assert pd.api.types.is_float_dtype(db_utils.importi_in_euro(df)["Importo"])
@@ -0,0 +1,123 @@
+from datetime import date
+
+import pytest
+
+import report_utils
+from conftest import documento, riga
+
+COLONNE = report_utils.COLONNE_LIQUIDAZIONE
+
+
+def _emessa(numero, data_doc, prezzo, iva=22, tipo_xml="TD01") -> tuple:
+    return documento(numero, data_doc, TipoXML=tipo_xml), [riga(prezzo, iva=iva)]
+
+
+def _ricevuta(numero, data_doc, prezzo, iva=22, tipo_xml="TD01") -> tuple:
+    doc = documento(numero, data_doc, TipoXML=tipo_xml, Tipo="Ricevuta", Emittente="05555555555")
+    return doc, [riga(prezzo, iva=iva)]
+
+
+def _periodi(archivio) -> list:
+    return archivio._get_conn().execute(
+        "SELECT anno, mese, ricevute, imponibile, imposta FROM iva_periodi "
+        "WHERE imponibile <> 0 OR imposta <> 0 ORDER BY 1, 2, 3"
+    ).fetchall()
+
+
+@pytest.fixture
+def anno(archivio):
+    archivio.inserisci_documenti([
+        _emessa("FT1", date(2026, 1, 10), 100),
+        _emessa("NC1", date(2026, 1, 20), 50, tipo_xml="TD04"),
+        _emessa("FT2", date(2026, 2, 10), 100, iva=10),
+        _emessa("FT3", date(2026, 3, 10), 100),
+        _ricevuta("A/1", date(2026, 4, 10), 200),
+        _emessa("FT4", date(2026, 5, 10), 1000),
+        _emessa("FT5", date(2025, 12, 10), 5000),
+    ])
+    return archivio
+
+
+def test_note_di_credito_stornano_l_iva(anno):
+    periodi = anno.periodi_iva()
+    gennaio = periodi[(periodi["anno"] == 2026) & (periodi["mese"] == 1)]
+    assert gennaio[["imponibile", "imposta"]].values.tolist() == [[5000, 1100]]
+
+
+def test_liquidazione_mensile(anno):
+    df = report_utils.liquidazione_iva(2026)
+    assert df["Periodo"].tolist() == report_utils.MESI_LABEL
+    assert df[COLONNE].values.tolist()[:6] == [
+        [1100, 0, 0, 0, 0, 0, 0],           # sotto soglia: rinviato
+        [1000, 0, 0, 1100, 0, 0, 0],        # ancora sotto soglia con il rinvio
+        [2200, 0, 0, 2100, 0, 4300, 0],     # si versa anche il rinviato
+        [0, 4400, 0, 0, 0, 0, 4400],        # credito riportato
+        [22000, 0, 4400, 0, 0, 17600, 0],   # compensato con il credito
+        [0] * 7,
+    ]
+    assert df[COLONNE].values[6:].sum() == 0
+    assert df.dtypes[COLONNE].eq("int64").all()
+
+
+def test_liquidazione_trimestrale(anno):
+    df = report_utils.liquidazione_iva(2026, trimestrale=True)
+    assert df["Periodo"].tolist() == report_utils.TRIMESTRI_LABEL
+    assert df[COLONNE].values.tolist() == [
+        [4300, 0, 0, 0, 43, 4343, 0],
+        [22000, 4400, 0, 0, 176, 17776, 0],
+        [0] * 7,
+        [0] * 7,
+    ]
+
+
+def test_interessi_solo_sull_iva_del_trimestre(archivio):
+    archivio.inserisci_documenti([
+        _emessa("FT1", date(2026, 2, 10), 100, iva=10),
+        _emessa("FT2", date(2026, 5, 10), 1000, iva=10),
+    ])
+    df = report_utils.liquidazione_iva(2026, trimestrale=True)
+    assert df[COLONNE].values.tolist()[:2] == [
+        [1000, 0, 0, 0, 0, 0, 0],
+        [10000, 0, 0, 1000, 100, 11100, 0],
+    ]
+
+
+def test_soglia_esatta(archivio):
+    # 25,82 euro si versano, un centesimo in meno no
+    archivio.inserisci_documenti([
+        _emessa("FT1", date(2026, 1, 10), 258.2, iva=10),
+        _emessa("FT2", date(2026, 2, 10), 258.1, iva=10),
+    ])
+    df = report_utils.liquidazione_iva(2026)
+    assert df.loc[0, "Da versare"] == report_utils.SOGLIA_VERSAMENTO
+    assert (df.loc[1, "Da versare"], df.loc[1, "Credito da riportare"]) == (0, 0)
+    assert df.loc[2, "Debito rinviato"] == 2581
+
+
+def test_note_di_credito_ricevute(archivio):
+    archivio.inserisci_documenti([
+        _emessa("FT1", date(2026, 1, 10), 1000),
+        _ricevuta("A/1", date(2026, 1, 11), 500),
+        _ricevuta("NC/1", date(2026, 1, 12), 100, tipo_xml="TD04"),
+    ])
+    df = report_utils.liquidazione_iva(2026)
+    assert df.loc[0, ["IVA a debito", "IVA a credito", "Da versare"]].tolist() == [22000, 8800, 13200]
+
+
+def test_trigger_allineati_al_ricalcolo(anno):
+    documenti = anno.carica_documenti()
+    per_numero = dict(zip(documenti["Numero"], documenti.index))
+
+    anno.aggiorna_documento(per_numero["FT1"], {"Data": date(2026, 2, 1)})
+    anno.aggiorna_documento(per_numero["FT2"], {"TipoXML": "TD04"})
+    anno.aggiorna_documento(per_numero["FT3"], {}, [riga(300), riga(10, iva=0, natura="N4")])
+    anno.elimina_documento(per_numero["NC1"])
+    ricevuta = anno.carica_ricevute().index[0]
+    anno.aggiorna_documento(ricevuta, {"Tipo": "Emessa", "Emittente": ""})
+    anno.inserisci_documento(*_emessa("FT9", date(2026, 12, 31), 10))
+
+    da_trigger = _periodi(anno)
+    anno.ricalcola_periodi_iva()
+    assert _periodi(anno) == da_trigger
+    # febbraio: FT1 spostata (+100 / +22) e FT2 diventata nota di credito (-100 / -10)
+    assert (2026, 2, 0, 0, 1200) in da_trigger
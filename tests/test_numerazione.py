@@ -0,0 +1,78 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+import pytest
+
+from conftest import documento
+
+
+def test_numeri_consecutivi_per_serie_e_anno(archivio):
+    assert [archivio.assegna_numero("FT", 2026) for _ in range(3)] == ["FT2026001", "FT2026002", "FT2026003"]
+    assert archivio.assegna_numero("FT", 2025) == "FT2025001"
+    assert archivio.assegna_numero(archivio.serie_per_tipo("TD04"), 2026) == "NC2026001"
+    assert archivio.serie_per_tipo("td01") == "FT"
+
+
+def test_la_sequenza_parte_dal_massimo_in_archivio(archivio):
+    archivio.inserisci_documento(documento("FT2026007"))
+    archivio.inserisci_documento(documento("FT2025099", date(2025, 1, 1)))
+    assert archivio.prossimo_numero("FT", 2026) == "FT2026008"
+    assert archivio.assegna_numero("FT", 2026) == "FT2026008"
+
+
+def test_numero_inserito_a_mano_porta_avanti_il_contatore(archivio):
+    assert archivio.assegna_numero("FT", 2026) == "FT2026001"
+    archivio.inserisci_documento(documento("FT2026010"))
+    assert archivio.assegna_numero("FT", 2026) == "FT2026011"
+
+
+def test_le_ricevute_non_toccano_la_numerazione(archivio):
+    archivio.inserisci_documenti([(documento("FT2026050", Tipo=archivio.TIPO_RICEVUTA, Emittente="IT1"), [])])
+    assert archivio.prossimo_numero("FT", 2026) == "FT2026001"
+
+
+def test_ricevute_singole_e_modificate_non_numerano(archivio):
+    doc_id = archivio.inserisci_documento(documento("FT2026050", Tipo=archivio.TIPO_RICEVUTA, Emittente="IT1"))
+    archivio.aggiorna_documento(doc_id, {"Numero": "FT2026080"})
+    assert archivio.prossimo_numero("FT", 2026) == "FT2026001"
+    emessa = archivio.inserisci_documento(documento("FT2026003"))
+    archivio.aggiorna_documento(emessa, {"Numero": "FT2026005"})
+    assert archivio.prossimo_numero("FT", 2026) == "FT2026006"
+
+
+def test_anteprima_in_sola_lettura(archivio):
+    conn = archivio._get_conn()
+    modifiche = conn.total_changes
+    assert archivio.prossimo_numero("FT", 2026) == archivio.prossimo_numero("FT", 2026) == "FT2026001"
+    assert conn.total_changes == modifiche
+    assert conn.execute("SELECT COUNT(*) FROM sequenze").fetchone()[0] == 0
+    assert not conn.in_transaction
+
+
+def test_sessioni_concorrenti_ricevono_numeri_diversi(archivio):
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        numeri = list(pool.map(lambda _: archivio.assegna_numero("FT", 2026), range(200)))
+    assert sorted(numeri) == [f"FT2026{i:03d}" for i in range(1, 201)]
+
+
+def test_numero_riservato_con_l_inserimento(archivio):
+    doc_id, numero = archivio.inserisci_con_numero(
+        documento(None, date(2025, 6, 1)), serie="FT", pdf=lambda n: f"pdf/{n}.pdf",
+    )
+    assert numero == "FT2025001"
+    doc = archivio.carica_documenti().loc[doc_id]
+    assert (doc["Numero"], doc["PDF"]) == ("FT2025001", "pdf/FT2025001.pdf")
+
+
+def test_inserimento_fallito_non_consuma_il_numero(archivio):
+    archivio.inserisci_documento(documento("X1", IdSdI="42"))
+    with pytest.raises(archivio.DocumentoDuplicato):
+        archivio.inserisci_con_numero(documento(None, IdSdI="42"), serie="FT")
+    assert archivio.prossimo_numero("FT", 2026) == "FT2026001"
+    assert archivio.inserisci_con_numero(documento(None), serie="FT")[1] == "FT2026001"
+
+
+def test_duplica_con_il_numero_successivo_della_serie(archivio):
+    origine = archivio.inserisci_documento(documento("NC2026004", TipoXML="TD04"))
+    assert archivio.duplica_documento(origine, data_doc=date(2026, 5, 1))[1] == "NC2026005"
+    assert archivio.prossimo_numero("NC", 2026) == "NC2026006"
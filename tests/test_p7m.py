@@ -0,0 +1,93 @@
+import base64
+import io
+import zipfile
+from datetime import date
+
+import pytest
+
+import ade_utils
+import xml_utils
+from conftest import riga
+from test_xml import CLIENTE, EMITTENTE
+
+OID_SIGNED_DATA = bytes.fromhex("06092a864886f70d010702")
+OID_DATA = bytes.fromhex("06092a864886f70d010701")
+
+XML = xml_utils.genera_xml_fattura("FT1", date(2026, 3, 1), CLIENTE, [riga(100)], EMITTENTE)
+
+
+def _der(tag: int, *contenuto: bytes) -> bytes:
+    dati = b"".join(contenuto)
+    if len(dati) < 0x80:
+        return bytes([tag, len(dati)]) + dati
+    lunghezza = len(dati).to_bytes((len(dati).bit_length() + 7) // 8, "big")
+    return bytes([tag, 0x80 | len(lunghezza)]) + lunghezza + dati
+
+
+def _ber(tag: int, *contenuto: bytes) -> bytes:
+    """Costruito a lunghezza indefinita, chiuso da end-of-contents."""
+    return bytes([tag, 0x80]) + b"".join(contenuto) + b"\x00\x00"
+
+
+def _busta(contenuto: bytes = XML, codifica=_der, segmenti: int = None, detached: bool = False) -> bytes:
+    """ContentInfo SignedData minimo (senza certificati né firme) intorno a `contenuto`."""
+    if segmenti:
+        passo = -(-len(contenuto) // segmenti)
+        ottetti = _ber(0x24, *(_der(0x04, contenuto[i:i + passo]) for i in range(0, len(contenuto), passo)))
+    else:
+        ottetti = _der(0x04, contenuto)
+    incapsulato = codifica(0x30, OID_DATA) if detached else codifica(0x30, OID_DATA, codifica(0xA0, ottetti))
+    firmato = codifica(
+        0x30,
+        _der(0x02, b"\x01"),
+        _der(0x31, _der(0x30, bytes.fromhex("0609608648016503040201"))),
+        incapsulato,
+        _der(0x31),
+    )
+    return codifica(0x30, OID_SIGNED_DATA, codifica(0xA0, firmato))
+
+
+@pytest.mark.parametrize("busta", [
+    _busta(),
+    _busta(codifica=_ber),
+    _busta(codifica=_ber, segmenti=7),
+    _busta(segmenti=3),
+    base64.b64encode(_busta()),
+    base64.encodebytes(_busta()),
+    b"-----BEGIN PKCS7-----\n" + base64.encodebytes(_busta(codifica=_ber)) + b"-----END PKCS7-----\n",
+    _busta(_busta()),
+    _busta(_busta(codifica=_ber, segmenti=2)),
+], ids=["der", "ber", "ber-segmentato", "der-segmentato", "base64", "base64-righe", "pem", "annidata", "annidata-ber"])
+def test_estrai_varianti(busta):
+    assert ade_utils.estrai_p7m(busta) == XML
+
+
+def test_contenuto_con_bom():
+    contenuto = b"\xef\xbb\xbf" + XML
+    assert ade_utils.estrai_p7m(_busta(contenuto)) == contenuto
+
+
+@pytest.mark.parametrize("busta, messaggio", [
+    (_busta(detached=True), "detached"),
+    (_busta()[:-40], "troncata"),
+    (_busta(codifica=_ber)[:200], "troncata"),
+    (_der(0x30, OID_DATA, _der(0xA0, _der(0x04, XML))), "SignedData"),
+    (b"non una busta", "non riconosciuta"),
+])
+def test_buste_non_valide(busta, messaggio):
+    with pytest.raises(ValueError, match=messaggio):
+        ade_utils.estrai_p7m(busta)
+
+
+def test_p7m_nel_pacchetto(archivio):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zf:
+        zf.writestr("IT01234567890_00001.xml.p7m", _busta(codifica=_ber, segmenti=4))
+        zf.writestr("IT01234567890_00002.xml.p7m", _busta(detached=True))
+    buffer.seek(0)
+
+    esito = ade_utils.importa_pacchetto(buffer, EMITTENTE, processi=1)
+
+    assert esito["documenti"] == 1
+    assert list(esito["errori"]) == ["IT01234567890_00002.xml.p7m"]
+    assert archivio.carica_documenti()["Numero"].tolist() == ["FT1"]
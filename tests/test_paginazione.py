@@ -0,0 +1,66 @@
+from datetime import date
+
+import pytest
+
+from conftest import documento
+
+
+@pytest.fixture
+def due_anni(archivio):
+    """60 emesse tra marzo 2025 e dicembre 2026 (più numeri nello stesso giorno) e una ricevuta."""
+    docs = [
+        (documento(f"FT{anno}{i:03d}", date(anno, mese, 1 + i % 3)), [])
+        for anno, mese in [(2025, 3), (2025, 12), (2026, 3), (2026, 12)]
+        for i in range(15)
+    ]
+    docs.append((documento("R1", date(2026, 3, 2), Tipo=archivio.TIPO_RICEVUTA, Emittente="IT1"), []))
+    archivio.inserisci_documenti(docs)
+    return archivio
+
+
+def _tutte_le_pagine(archivio, limite, mese=None):
+    pagine, dopo = [], None
+    while True:
+        df, dopo = archivio.pagina_documenti(limite, dopo=dopo, mese=mese)
+        pagine.append(list(df["Numero"]))
+        if dopo is None:
+            return pagine
+
+
+def test_pagine_in_ordine_senza_buchi_ne_ripetizioni(due_anni):
+    pagine = _tutte_le_pagine(due_anni, 7)
+    numeri = [n for p in pagine for n in p]
+
+    attesi = due_anni.carica_documenti().sort_values(["Data", "Numero"], ascending=False)["Numero"]
+    assert numeri == list(attesi)
+    assert [len(p) for p in pagine] == [7] * 8 + [4]
+
+
+def test_ultima_pagina_piena_non_ha_successiva(due_anni):
+    pagine = _tutte_le_pagine(due_anni, 15, mese=3)
+    assert [len(p) for p in pagine] == [15, 15]
+
+
+@pytest.mark.parametrize("mese, attesi", [(3, 30), (12, 30), (6, 0)])
+def test_mese_su_tutti_gli_anni(due_anni, mese, attesi):
+    assert due_anni.conta_documenti(mese) == attesi
+    numeri = [n for p in _tutte_le_pagine(due_anni, 10, mese=mese) for n in p]
+    assert len(numeri) == attesi
+    assert "R1" not in numeri
+
+
+def test_filtro_mese_usa_l_indice_su_data(due_anni):
+    conn = due_anni._get_conn()
+    where, params = due_anni._filtro_documenti(conn, 12)
+    piano = conn.execute(
+        "EXPLAIN QUERY PLAN SELECT COUNT(*) FROM documenti WHERE " + " AND ".join(where), params
+    ).fetchall()
+    dettagli = " ".join(r[-1] for r in piano)
+    assert "SCAN documenti" not in dettagli
+    assert "idx_documenti_data" in dettagli
+
+
+def test_archivio_vuoto(archivio):
+    assert archivio.conta_documenti(1) == 0
+    df, dopo = archivio.pagina_documenti(25, mese=1)
+    assert df.empty and dopo is None
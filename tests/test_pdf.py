@@ -0,0 +1,166 @@
+import os
+import re
+import zlib
+from collections import OrderedDict
+from datetime import date
+
+import pytest
+
+import pdf_utils
+from conftest import documento, riga
+
+CLIENTE = {"Denominazione": "ACME SRL", "Indirizzo": "Via Roma 1", "CAP": "00100", "Comune": "Roma", "Provincia": "RM", "PIVA": "01234567890"}
+
+
+def _genera(righe, imponibile=100.0, iva=22.0, totale=122.0, **opzioni):
+    return pdf_utils.genera_pdf_fattura(
+        "FT2026001", date(2026, 3, 1), CLIENTE, righe, imponibile, iva, totale,
+        emittente=pdf_utils.EMITTENTE_DEFAULT, **opzioni,
+    )
+
+
+def _pagine(pdf_bytes: bytes) -> list:
+    """Content stream (decompresso) di ogni pagina."""
+    return [
+        zlib.decompress(flusso).decode("latin1")
+        for flusso in re.findall(rb"/Filter /FlateDecode /Length \d+>>\nstream\n(.*?)\nendstream", pdf_bytes, re.S)
+    ]
+
+
+def _testi(pagina: str) -> list:
+    return re.findall(r"\((.*?)\) Tj", pagina)
+
+
+def test_fattura_di_una_pagina():
+    pdf_bytes = _genera([riga(100)])
+    assert pdf_bytes.startswith(b"%PDF")
+    (pagina,) = _pagine(pdf_bytes)
+    testi = _testi(pagina)
+    for atteso in ["FISCO CHIARO CONSULTING", "ACME SRL", "FT2026001", "01/03/2026", "DETTAGLIO DOCUMENTO", "Pagina 1 di 1"]:
+        assert atteso in " ".join(testi)
+    assert "TOTALE A PAGARE EUR 122,00" in testi
+
+
+def test_blocchi_statici_compilati_una_volta_e_copiati():
+    pdf_utils._layout_fattura.cache_clear()
+    _genera([riga(100)])
+    _genera([riga(200)], 200, 44, 244)
+    assert pdf_utils._layout_fattura.cache_info().misses == 1
+
+    testata = pdf_utils._layout_fattura()["dettaglio_testata"]
+    (pagina,) = _pagine(_genera([riga(100)]))
+    # il frammento compilato compare nel content stream così com'è, traslato con cm
+    assert testata.flusso in pagina
+    assert re.search(r"q 1 0 0 1 0 -?\d+\.\d\d cm\n" + re.escape(testata.flusso) + "Q", pagina)
+
+
+def test_campi_variabili_nelle_caselle_del_modello():
+    testi = _testi(_pagine(_genera([riga(100)], note="Consulenza marzo"))[0])
+    assert "Consulenza marzo" in testi
+    assert "CAUSALE" in testi
+
+
+def test_dettaglio_su_piu_pagine_con_riporto():
+    righe = [riga(10, desc=f"Voce {i} " + "testo lungo " * (i % 12)) for i in range(60)]
+    pagine = _pagine(_genera(righe, 600, 132, 732))
+    assert len(pagine) > 1
+    for i, pagina in enumerate(pagine, start=1):
+        testi = _testi(pagina)
+        assert f"Pagina {i} di {len(pagine)}" in testi
+        assert "DETTAGLIO DOCUMENTO" in testi or i == len(pagine)
+    assert "A RIPORTARE" in _testi(pagine[0])
+    assert "RIPORTO" in _testi(pagine[1])
+    assert "SEGUE" in " ".join(_testi(pagine[1]))
+
+
+def test_rigenera_pdf_del_periodo(archivio, tmp_path):
+    archivio.inserisci_documenti(
+        [(documento(f"FT2026{i:03d}", date(2026, 3, 1)), [riga(100)]) for i in range(60)]
+        + [(documento("FT2025001", date(2025, 3, 1)), [riga(100)])]
+    )
+    esito = pdf_utils.rigenera_pdf(2026, mese=3, processi=2, pdf_dir=str(tmp_path))
+
+    assert (esito["documenti"], esito["processi"], esito["errori"]) == (60, 2, {})
+    assert len(list(tmp_path.glob("*.pdf"))) == 60
+    percorsi = archivio.carica_documenti().set_index("Numero")["PDF"]
+    assert percorsi["FT2026001"] == str(tmp_path / "FT2026001_TD01_20260301.pdf")
+    assert percorsi["FT2025001"] == ""
+
+
+@pytest.mark.parametrize("numero, tipo_xml, nome", [
+    ("FT2026001", "TD01", "FT2026001_TD01_20260301.pdf"),
+    ("2026/7", "TD04", "2026-7_TD04_20260301.pdf"),
+    ("7", "", "7_TD01_20260301.pdf"),
+])
+def test_nome_file_pdf(numero, tipo_xml, nome):
+    assert pdf_utils.nome_file_pdf(numero, date(2026, 3, 1), tipo_xml) == nome
+
+
+def test_stesso_numero_pdf_distinti(archivio, tmp_path):
+    # numeri importati ripetuti tra anni e tipi documento
+    archivio.inserisci_documenti([
+        (documento("1", date(2025, 3, 1)), [riga(100)]),
+        (documento("1", date(2026, 3, 1)), [riga(200)]),
+        (documento("1", date(2026, 3, 1), TipoXML="TD04"), [riga(50)]),
+    ])
+    esito = pdf_utils.rigenera_pdf(2026, processi=1, pdf_dir=str(tmp_path))
+    esito_2025 = pdf_utils.rigenera_pdf(2025, processi=1, pdf_dir=str(tmp_path))
+
+    assert (esito["errori"], esito_2025["errori"]) == ({}, {})
+    percorsi = archivio.carica_documenti()["PDF"]
+    assert percorsi.nunique() == 3
+    assert len(list(tmp_path.glob("*.pdf"))) == 3
+
+
+def test_totale_di_riga_dal_centesimo_esatto():
+    # 1,005 in float vale 1,00499...: il totale va calcolato in centesimi
+    testi = _testi(_pagine(_genera([riga(1.005)], 1.01, 0.22, 1.23))[0])
+    inizio = testi.index("Servizio")
+    assert testi[inizio:inizio + 5] == ["Servizio", "1,00", "1.00", "1,01", "22.00"]
+
+
+@pytest.fixture
+def cache_pdf(monkeypatch):
+    """Cache dei PDF vuota, limitata a 10 byte; conta le aperture dei file."""
+    monkeypatch.setattr(pdf_utils, "_cache_pdf", OrderedDict())
+    monkeypatch.setattr(pdf_utils, "_cache_bytes", 0)
+    monkeypatch.setattr(pdf_utils, "PDF_CACHE_MAX_BYTES", 10)
+    aperture = []
+    apri = open
+
+    def _open(path, *args, **kwargs):
+        aperture.append(os.path.basename(path))
+        return apri(path, *args, **kwargs)
+
+    monkeypatch.setattr("builtins.open", _open)
+    return aperture
+
+
+def test_pdf_disponibile_senza_leggere(tmp_path, cache_pdf):
+    path = tmp_path / "a.pdf"
+    path.write_bytes(b"1234")
+    assert pdf_utils.pdf_disponibile(str(path))
+    assert not pdf_utils.pdf_disponibile(str(tmp_path / "manca.pdf"))
+    assert not pdf_utils.pdf_disponibile("")
+    assert cache_pdf == []
+
+
+def test_pdf_letti_una_volta_e_riletti_se_cambiano(tmp_path, cache_pdf):
+    path = tmp_path / "a.pdf"
+    path.write_bytes(b"1234")
+    assert pdf_utils.leggi_pdf(str(path)) == pdf_utils.leggi_pdf(str(path)) == b"1234"
+    assert cache_pdf == ["a.pdf"]
+    path.write_bytes(b"123456")
+    assert pdf_utils.leggi_pdf(str(path)) == b"123456"
+    assert cache_pdf == ["a.pdf", "a.pdf"]
+
+
+def test_cache_pdf_limitata_in_byte(tmp_path, cache_pdf):
+    for nome, dati in [("a.pdf", b"1234"), ("b.pdf", b"5678"), ("c.pdf", b"90"), ("grande.pdf", b"x" * 11)]:
+        (tmp_path / nome).write_bytes(dati)
+    for nome in ["a.pdf", "b.pdf", "a.pdf", "c.pdf", "grande.pdf"]:
+        pdf_utils.leggi_pdf(str(tmp_path / nome))
+    assert [os.path.basename(k[0]) for k in pdf_utils._cache_pdf] == ["b.pdf", "a.pdf", "c.pdf"]
+    assert pdf_utils._cache_bytes == 10
+    pdf_utils.leggi_pdf(str(tmp_path / "b.pdf"))
+    assert cache_pdf == ["a.pdf", "b.pdf", "c.pdf", "grande.pdf"]
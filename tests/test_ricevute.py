@@ -0,0 +1,72 @@
+from datetime import date
+
+import pandas as pd
+import pytest
+
+from conftest import documento
+
+
+def ricevuta(numero: str, emittente: str = "IT01234567890", data_doc=date(2026, 3, 1), **campi) -> dict:
+    return documento(
+        numero, data_doc, Tipo="Ricevuta", Emittente=emittente, Controparte="FORNITORE SRL", **campi
+    )
+
+
+def test_ricevute_separate_e_in_ordine_di_data(archivio):
+    archivio.inserisci_documento(documento("FT2026001"))
+    archivio.inserisci_documento(ricevuta("B7", data_doc=date(2026, 5, 2)))
+    archivio.inserisci_documento(ricevuta("A1", data_doc=date(2026, 1, 10)))
+    df = archivio.carica_ricevute()
+    assert df["Numero"].tolist() == ["A1", "B7"]
+    assert set(df["Tipo"]) == {"Ricevuta"}
+    assert df["Emittente"].tolist() == ["IT01234567890"] * 2
+    assert df["Mese"].tolist() == [1, 5]
+    assert archivio.carica_documenti()["Numero"].tolist() == ["FT2026001"]
+
+
+def test_indice_fornitori(archivio):
+    archivio.inserisci_documento(ricevuta("1", Importo=100.0, data_doc=date(2026, 2, 1)))
+    archivio.inserisci_documento(ricevuta("2", Importo=50.5, data_doc=date(2026, 4, 1)))
+    archivio.inserisci_documento(ricevuta("1", emittente="IT09876543210", Importo=500.0))
+    archivio.inserisci_documento(documento("FT2026001", Importo=9999.0))
+    fornitori = archivio.indice_fornitori()
+    assert fornitori["Emittente"].tolist() == ["IT09876543210", "IT01234567890"]
+    assert fornitori["Documenti"].tolist() == [1, 2]
+    assert fornitori["Importo"].tolist() == [50000, 15050]
+    assert fornitori["Ultimo"].iloc[1] == pd.Timestamp("2026-04-01")
+
+
+def test_indice_fornitori_segue_le_modifiche(archivio):
+    doc_id = archivio.inserisci_documento(ricevuta("1"))
+    assert archivio.indice_fornitori()["Documenti"].tolist() == [1]
+    archivio.elimina_documento(doc_id)
+    assert archivio.indice_fornitori().empty
+
+
+@pytest.mark.parametrize("sql, indice", [
+    ("SELECT id FROM documenti WHERE Tipo = 'Ricevuta' ORDER BY Data, id", "idx_ricevute_data"),
+    ("SELECT Emittente, COUNT(*) FROM documenti WHERE Tipo = 'Ricevuta' GROUP BY Emittente", "idx_ricevute_fornitore"),
+])
+def test_letture_sugli_indici_parziali(archivio, sql, indice):
+    archivio.inserisci_documento(ricevuta("1"))
+    piano = " ".join(r[-1] for r in archivio._get_conn().execute(f"EXPLAIN QUERY PLAN {sql}"))
+    assert indice in piano
+
+
+def test_idsdi_univoco(archivio):
+    archivio.inserisci_documento(ricevuta("1", IdSdI="123456"))
+    with pytest.raises(archivio.DocumentoDuplicato):
+        archivio.inserisci_documento(ricevuta("2", IdSdI="123456"))
+    # l'indice è parziale: i documenti senza IdSdI non collidono
+    archivio.inserisci_documento(ricevuta("3"))
+    archivio.inserisci_documento(ricevuta("4"))
+    assert len(archivio.carica_ricevute()) == 3
+
+
+def test_reimportazione_per_idsdi_aggiorna(archivio):
+    archivio.inserisci_documenti([(ricevuta("1", IdSdI="123456", Importo=10.0), [])])
+    inseriti, aggiornati, conflitti = archivio.inserisci_documenti(
+        [(ricevuta("1", IdSdI="123456", Importo=12.0), [])]
+    )
+    assert (inseriti, aggiornati, conflitti) == (0, 1, {})
+    assert archivio.carica_ricevute()["Importo"].tolist() == [1200]
@@ -0,0 +1,151 @@
+import random
+from datetime import date
+
+import pandas as pd
+
+import db_utils
+import importi_utils
+import pdf_utils
+import report_utils
+from conftest import documento, riga
+from test_pdf import _genera, _pagine, _testi
+
+
+def test_una_voce_per_aliquota_e_natura():
+    righe = [riga(100), riga(50, iva=10), riga(30), riga(20, iva=0, natura="N4"), riga(5, iva=0, natura="N2.2")]
+    assert importi_utils.riepilogo_fattura(righe) == [
+        {"Aliquota": 0.0, "Natura": "N2.2", "Imponibile": 500, "IVA": 0},
+        {"Aliquota": 0.0, "Natura": "N4", "Imponibile": 2000, "IVA": 0},
+        {"Aliquota": 10.0, "Natura": "", "Imponibile": 5000, "IVA": 500},
+        {"Aliquota": 22.0, "Natura": "", "Imponibile": 13000, "IVA": 2860},
+    ]
+
+
+def test_natura_solo_ad_aliquota_zero():
+    voci = importi_utils.riepilogo_fattura([riga(100, natura="N4"), riga(100)])
+    assert voci == [{"Aliquota": 22.0, "Natura": "", "Imponibile": 20000, "IVA": 4400}]
+
+
+def test_documento_senza_righe():
+    assert pdf_utils._riepilogo_iva([], 100, 4) == [{"Aliquota": 4.0, "Natura": "", "Imponibile": 10000, "IVA": 400}]
+
+
+def test_riepilogo_fattura_come_riepilogo_aliquote():
+    generatore = random.Random(24)
+    righe = {
+        doc: [
+            riga(
+                round(generatore.uniform(0, 300), 2),
+                qta=generatore.choice([1, 2, 0.5, 3.333]),
+                iva=generatore.choice([22, 10, 4, 0]),
+                natura=generatore.choice(["", "N2.2", "N4"]),
+            )
+            for _ in range(generatore.randint(1, 8))
+        ]
+        for doc in range(300)
+    }
+    vettoriale = importi_utils.riepilogo_aliquote(importi_utils.righe_frame(righe))
+    for doc, voci in vettoriale.groupby("documento"):
+        attese = voci.drop(columns="documento").to_dict("records")
+        assert importi_utils.riepilogo_fattura(righe[doc]) == attese
+
+
+def test_riepiloghi_nel_pdf():
+    testi = _testi(_pagine(_genera([riga(100), riga(50, iva=10)], 150, 27, 177))[0])
+    inizio = testi.index("RIEPILOGHI")
+    voci = testi[inizio:]
+    assert voci[voci.index("22,00"):][:3] == ["22,00", "100,00", "22,00"]
+    assert voci[voci.index("10,00"):][:3] == ["10,00", "50,00", "5,00"]
+
+
+def test_riepilogo_esplicito_prevale():
+    esplicito = [{"Aliquota": 4.0, "Natura": "", "Imponibile": 10000, "IVA": 400}]
+    testi = _testi(_pagine(_genera([riga(100)], 100, 4, 104, riepilogo=esplicito))[0])
+    voci = testi[testi.index("RIEPILOGHI"):]
+    assert "4,00" in voci and "22,00" not in voci
+
+
+def test_riepilogo_salvato_con_il_documento(archivio):
+    da_righe = archivio.inserisci_documento(documento("FT1"), [riga(100), riga(10, iva=0, natura="N4")])
+    senza_righe = archivio.inserisci_documento(documento("FT2", Imponibile=200.0, IVA=20.0, Importo=220.0))
+    # DatiRiepilogo di un XML importato: prevale sul calcolo dalle righe
+    archivio.inserisci_documenti([(
+        documento("FT3"), [riga(100)],
+        [{"aliquota": 22.0, "natura": "", "imponibile": 100.0, "imposta": 21.99}],
+    )])
+    importato = archivio.trova_documento("FT3", "2026-03-01")
+
+    riepiloghi = archivio.carica_riepiloghi_documenti([da_righe, senza_righe, importato])
+    assert list(riepiloghi.values()) == [
+        [{"Aliquota": 0.0, "Natura": "N4", "Imponibile": 1000, "IVA": 0},
+         {"Aliquota": 22.0, "Natura": "", "Imponibile": 10000, "IVA": 2200}],
+        [{"Aliquota": 10.0, "Natura": "", "Imponibile": 20000, "IVA": 2000}],
+        [{"Aliquota": 22.0, "Natura": "", "Imponibile": 10000, "IVA": 2199}],
+    ]
+
+
+def test_riepilogo_ricalcolato_con_le_righe(archivio):
+    doc_id = archivio.inserisci_documento(documento("FT1"), [riga(100)])
+    archivio.aggiorna_documento(doc_id, {}, [riga(100, iva=10)])
+    assert archivio.carica_riepiloghi_documenti([doc_id])[doc_id] == [
+        {"Aliquota": 10.0, "Natura": "", "Imponibile": 10000, "IVA": 1000},
+    ]
+
+
+def test_registro_iva_per_mese_e_aliquota(archivio):
+    archivio.inserisci_documenti([
+        (documento("FT1", date(2026, 1, 10)), [riga(100), riga(50, iva=10)]),
+        (documento("FT2", date(2026, 1, 20)), [riga(200)]),
+        (documento("FT3", date(2026, 2, 5)), [riga(10, iva=0, natura="N2.2")]),
+        (documento("FT4", date(2025, 12, 31)), [riga(999)]),
+        (documento("A/1", date(2026, 1, 15), Tipo="Ricevuta", Emittente="05555555555"), [riga(40)]),
+    ])
+    registro = archivio.registro_iva(2026)
+    assert registro.values.tolist() == [
+        [1, 22.0, "", 30000, 6600],
+        [1, 10.0, "", 5000, 500],
+        [2, 0.0, "N2.2", 1000, 0],
+    ]
+    assert archivio.registro_iva(2026, ricevute=True).values.tolist() == [[1, 22.0, "", 4000, 880]]
+
+
+def test_note_di_credito_stornate_nel_registro(archivio):
+    archivio.inserisci_documenti([
+        (documento("FT1", date(2026, 1, 10)), [riga(100)]),
+        (documento("NC1", date(2026, 1, 20), TipoXML="TD04"), [riga(30)]),
+        (documento("A/1", date(2026, 1, 15), Tipo="Ricevuta", Emittente="05555555555", TipoXML="TD04"), [riga(40)]),
+    ])
+    assert archivio.registro_iva(2026).values.tolist() == [[1, 22.0, "", 7000, 1540]]
+    assert archivio.registro_iva(2026, ricevute=True).values.tolist() == [[1, 22.0, "", -4000, -880]]
+    # registro e liquidazione leggono gli stessi importi
+    liquidazione = report_utils.liquidazione_iva(2026)
+    assert liquidazione.loc[0, ["IVA a debito", "IVA a credito"]].tolist() == [1540, -880]
+    assert report_utils.riepilogo_aliquote_anno(2026)[["Imponibile", "IVA"]].values.tolist() == [[7000, 1540]]
+
+
+def test_totali_mensili_esatti_come_groupby():
+    rnd = random.Random(5)
+    n = 2000
+    df = pd.DataFrame({
+        "Anno": [rnd.choice([2025, 2026]) for _ in range(n)],
+        "Mese": [rnd.randint(1, 12) for _ in range(n)],
+        **{col: [rnd.randint(-10**12, 10**12) for _ in range(n)] for col in db_utils.COLONNE_IMPORTI},
+    })
+    totali = report_utils.totali_mensili(df, 2026)
+    attesi = df[df["Anno"] == 2026].groupby("Mese")[db_utils.COLONNE_IMPORTI].sum()
+    attesi = attesi.reindex(range(1, 13), fill_value=0)
+    for col in db_utils.COLONNE_IMPORTI:
+        assert totali[col].tolist() == attesi[col].tolist()
+        assert str(totali[col].dtype) == "int64"
+    assert totali["Documenti"].sum() == (df["Anno"] == 2026).sum()
+
+
+def test_riepilogo_periodi_trimestri_e_anno(archivio):
+    archivio.inserisci_documento(documento("FT2026001", date(2026, 1, 5), Importo=0.1))
+    archivio.inserisci_documento(documento("FT2026002", date(2026, 2, 5), Importo=0.2))
+    archivio.inserisci_documento(documento("FT2026003", date(2026, 11, 5), Importo=1.0))
+    riep = report_utils.riepilogo_periodi(archivio.carica_documenti(), 2026).set_index("Periodo")
+    assert riep.loc["1° Trimestre", "Importo"] == 30
+    assert riep.loc["4° Trimestre", "Importo"] == 100
+    assert riep.loc["Annuale", "Importo"] == 130
+    assert riep.loc["Marzo", "Importo"] == 0
@@ -0,0 +1,51 @@
+import os
+
+import pandas as pd
+import pytest
+
+import snapshot_utils
+from conftest import documento
+
+
+def test_snapshot_archivio_conserva_lo_schema(archivio, tmp_path):
+    archivio.inserisci_documento(documento("FT2026001", Importo=122.5))
+    archivio.inserisci_documento(documento("FT2026002", Controparte="BETA SPA"))
+    originale = archivio.carica_documenti()
+
+    percorsi = snapshot_utils.salva_snapshot(cartella=str(tmp_path))
+    assert set(percorsi) == set(snapshot_utils.TABELLE_ARCHIVIO)
+    riletto = snapshot_utils.carica_snapshot("documenti_emessi", str(tmp_path))
+
+    pd.testing.assert_frame_equal(riletto, originale)
+    assert isinstance(riletto["Controparte"].dtype, pd.CategoricalDtype)
+    assert str(riletto["Importo"].dtype) == "int64"
+    assert pd.api.types.is_datetime64_dtype(riletto["Data"].dtype)
+    assert riletto["Importo"].tolist() == [12250, 12200]
+
+
+def test_snapshot_mancante(tmp_path):
+    assert snapshot_utils.carica_snapshot("documenti_emessi", str(tmp_path)) is None
+
+
+def test_parquet_in_memoria(archivio):
+    archivio.inserisci_documento(documento())
+    df = archivio.carica_documenti()
+    pd.testing.assert_frame_equal(snapshot_utils.df_da_parquet(snapshot_utils.parquet_bytes(df)), df)
+    # senza indice: stesso contenuto, stessi byte
+    a = snapshot_utils.parquet_bytes(df.reset_index(drop=True), indice=False)
+    b = snapshot_utils.parquet_bytes(df.copy().reset_index(drop=True), indice=False)
+    assert a == b
+
+
+def test_scrittura_fallita_lascia_il_file_precedente(tmp_path, monkeypatch):
+    path = str(tmp_path / "tabella.parquet")
+    snapshot_utils.scrivi_parquet(pd.DataFrame({"a": [1, 2]}), path)
+
+    def guasto(df, indice=True):
+        raise OSError("disco pieno")
+
+    monkeypatch.setattr(snapshot_utils, "parquet_bytes", guasto)
+    with pytest.raises(OSError):
+        snapshot_utils.scrivi_parquet(pd.DataFrame({"a": [3]}), path)
+    assert snapshot_utils.leggi_parquet(path)["a"].tolist() == [1, 2]
+    assert os.listdir(tmp_path) == ["tabella.parquet"]
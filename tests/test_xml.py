@@ -0,0 +1,114 @@
+from datetime import date
+from decimal import Decimal
+
+import pytest
+from lxml import etree
+
+import importi_utils
+import xml_utils
+from conftest import documento, riga
+
+EMITTENTE = {
+    "Denominazione": "FISCO CHIARO CONSULTING", "Indirizzo": "Via Verdi 2", "CAP": "20100",
+    "Comune": "Milano", "Provincia": "MI", "CF": "01234567890", "PIVA": "01234567890",
+}
+CLIENTE = {
+    "Denominazione": "ACME SRL", "Indirizzo": "Via Roma 1", "CAP": "00100", "Comune": "Roma",
+    "Provincia": "rm", "PIVA": "09876543210", "PEC": "acme@pec.it",
+}
+
+
+def _fattura(righe, **opzioni) -> bytes:
+    return xml_utils.genera_xml_fattura("FT2026/001", date(2026, 3, 1), CLIENTE, righe, EMITTENTE, **opzioni)
+
+
+def _testi(xml: bytes, percorso: str) -> list:
+    return [e.text for e in etree.fromstring(xml).iterfind(percorso)]
+
+
+def test_testata_e_formato():
+    xml = _fattura([riga(100)])
+    radice = etree.fromstring(xml)
+    assert radice.tag == f"{{{xml_utils.NS_FATTURA}}}FatturaElettronica"
+    assert radice.get("versione") == "FPR12"
+    assert _testi(xml, ".//DatiTrasmissione/ProgressivoInvio") == ["FT2026001"]
+    assert _testi(xml, ".//DatiTrasmissione/CodiceDestinatario") == ["0000000"]
+    assert _testi(xml, ".//DatiTrasmissione/PECDestinatario") == ["acme@pec.it"]
+    assert _testi(xml, ".//CessionarioCommittente//Provincia") == ["RM"]
+    assert _testi(xml, ".//DatiGeneraliDocumento/Data") == ["2026-03-01"]
+
+    pa = xml_utils.genera_xml_fattura("1", date(2026, 3, 1), {**CLIENTE, "CodiceDestinatario": "UFABCD"}, [riga(1)], EMITTENTE)
+    assert etree.fromstring(pa).get("versione") == "FPA12"
+
+
+def test_linee_e_riepilogo_per_aliquota():
+    righe = [
+        riga(10.005, qta=1),
+        riga(0.1, qta=3),
+        riga(50, iva=10),
+        riga(20, iva=0, natura="N2.2"),
+        riga(5, iva=0, natura="N4"),
+    ]
+    xml = _fattura(righe)
+    assert _testi(xml, ".//DettaglioLinee/NumeroLinea") == ["1", "2", "3", "4", "5"]
+    assert _testi(xml, ".//DettaglioLinee/PrezzoTotale") == ["10.01", "0.30", "50.00", "20.00", "5.00"]
+    assert _testi(xml, ".//DettaglioLinee/Natura") == ["N2.2", "N4"]
+    assert _testi(xml, ".//DatiRiepilogo/AliquotaIVA") == ["22.00", "10.00", "0.00", "0.00"]
+    assert _testi(xml, ".//DatiRiepilogo/ImponibileImporto") == ["10.31", "50.00", "5.00", "20.00"]
+    # imposta arrotondata una volta per voce, non riga per riga
+    assert _testi(xml, ".//DatiRiepilogo/Imposta") == ["2.27", "5.00", "0.00", "0.00"]
+    assert _testi(xml, ".//DatiRiepilogo/EsigibilitaIVA") == ["I", "I"]
+
+
+def test_righe_da_generatore_e_totale_restituito(tmp_path):
+    percorso = tmp_path / "out" / "fattura.xml"
+    totale = xml_utils.scrivi_xml(
+        str(percorso), "FT1", date(2026, 3, 1), CLIENTE, (riga(100) for _ in range(3)), EMITTENTE,
+        pagamento={"modalita": "bonifico", "iban": "IT60 X054 2811 1010 0000 0123 456"},
+    )
+    assert totale == Decimal("366.00")
+    assert [p.name for p in percorso.parent.iterdir()] == ["fattura.xml"]
+    xml = percorso.read_bytes()
+    assert _testi(xml, ".//DettaglioPagamento/ModalitaPagamento") == ["MP05"]
+    assert _testi(xml, ".//DettaglioPagamento/ImportoPagamento") == ["366.00"]
+    assert _testi(xml, ".//DettaglioPagamento/IBAN") == ["IT60X0542811101000000123456"]
+
+
+def test_testo_libero_ripulito_e_causale_a_blocchi():
+    xml = _fattura([riga(1, desc="Voce\x01 <con> & simboli")], causale="x" * 450)
+    assert _testi(xml, ".//DettaglioLinee/Descrizione") == ["Voce <con> & simboli"]
+    assert [len(t) for t in _testi(xml, ".//DatiGeneraliDocumento/Causale")] == [200, 200, 50]
+
+
+def test_nome_file_sdi():
+    assert xml_utils.nome_file_xml(EMITTENTE, "FT2026/001") == "IT01234567890_FT2026001.xml"
+
+
+@pytest.mark.parametrize("doc_id, progressivo", [(1, "00001"), (36, "00010"), (60_466_175, "ZZZZZ")])
+def test_progressivo_documento(doc_id, progressivo):
+    assert xml_utils.progressivo_documento(doc_id) == progressivo
+
+
+def test_esportazione_senza_file_sovrascritti(archivio, tmp_path):
+    archivio.inserisci_documenti([
+        (documento("1", date(2026, 3, 1)), [riga(100)]),
+        (documento("1", date(2026, 3, 1), TipoXML="TD04"), [riga(50)]),
+        (documento("1", date(2026, 4, 1)), [riga(10)]),
+    ])
+    esito = xml_utils.esporta_xml_periodo(2026, emittente=EMITTENTE, cartella=str(tmp_path))
+
+    assert (esito["documenti"], esito["errori"]) == (3, {})
+    file = sorted(tmp_path.glob("*.xml"))
+    assert [f.name for f in file] == [f"IT01234567890_0000{i}.xml" for i in (1, 2, 3)]
+    assert [_testi(f.read_bytes(), ".//ProgressivoInvio")[0] for f in file] == ["00001", "00002", "00003"]
+    assert [_testi(f.read_bytes(), ".//TipoDocumento")[0] for f in file] == ["TD01", "TD04", "TD01"]
+
+
+def test_quantita_zero_come_nei_totali():
+    righe = [riga(100), riga(50, qta=0)]
+    xml = _fattura(righe)
+    assert _testi(xml, ".//DettaglioLinee/Quantita") == ["1.00", "0.00"]
+    assert _testi(xml, ".//DettaglioLinee/PrezzoTotale") == ["100.00", "0.00"]
+    assert _testi(xml, ".//DatiRiepilogo/ImponibileImporto") == [
+        f"{importi_utils.totali_fattura(righe)['Imponibile'] / 100:.2f}"
+    ]
@@ -0,0 +1,110 @@
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+import xml_utils
+import xsd_utils
+from conftest import riga
+from test_xml import CLIENTE, EMITTENTE
+
+
+def _fattura(numero="FT2026001", righe=None) -> bytes:
+    return xml_utils.genera_xml_fattura(
+        numero, date(2026, 3, 1), CLIENTE, righe or [riga(100), riga(20, iva=0, natura="N4")], EMITTENTE,
+        causale="Consulenza", importo_totale=142, pagamento={"modalita": "MP05", "giorni": 30},
+    )
+
+
+def test_fattura_generata_valida():
+    assert xsd_utils.valida_xml(_fattura()) == []
+
+
+def test_errori_di_schema_con_riga():
+    xml = _fattura().replace(b"<Divisa>EUR</Divisa>", b"<Divisa>EURO</Divisa>")
+    errori = xsd_utils.valida_xml(xml)
+    assert len(errori) == 1
+    assert errori[0].startswith("riga 2: ") and "Divisa" in errori[0]
+
+
+def test_xml_non_ben_formato():
+    (errore,) = xsd_utils.valida_xml(b"<FatturaElettronica>")
+    assert "XML non ben formato" in errore
+
+
+def test_entita_esterne_non_risolte(tmp_path):
+    segreto = tmp_path / "segreto.txt"
+    segreto.write_text("riservato")
+    xml = _fattura().replace(b"<Divisa>EUR", b"<Divisa>&x;EUR").replace(
+        b"?>", f'?><!DOCTYPE p [<!ENTITY x SYSTEM "file://{segreto}">]>'.encode(), 1
+    )
+    errori = xsd_utils.valida_xml(xml)
+    assert errori and not any("riservato" in e for e in errori)
+
+
+def test_schema_compilato_una_volta():
+    xsd_utils.schema_fatturapa.cache_clear()
+    for numero in ("1", "2", "3"):
+        xsd_utils.valida_xml(_fattura(numero))
+    assert xsd_utils.schema_fatturapa.cache_info().misses == 1
+
+
+def test_validazione_in_blocco_da_zip_e_cartella(tmp_path):
+    archivio = tmp_path / "fatture.zip"
+    with zipfile.ZipFile(archivio, "w") as zf:
+        for i in range(1, 6):
+            zf.writestr(f"IT_{i}.xml", _fattura(str(i)))
+        zf.writestr("IT_rotto.xml", _fattura("9").replace(b"<Divisa>EUR", b"<Divisa>XX"))
+        zf.writestr("leggimi.txt", "non xml")
+    fatti = []
+    esito = xsd_utils.valida_in_blocco(str(archivio), processi=1, avanzamento=lambda f, t: fatti.append((f, t)))
+    assert (esito["file"], esito["validi"]) == (6, 5)
+    assert list(esito["errori"]) == ["IT_rotto.xml"]
+    assert fatti == [(6, 6)]
+
+    cartella = tmp_path / "xml" / "marzo"
+    cartella.mkdir(parents=True)
+    for i in range(1, 4):
+        (cartella / f"{i}.xml").write_bytes(_fattura(str(i)))
+    esito = xsd_utils.valida_in_blocco(str(tmp_path / "xml"), processi=1)
+    assert (esito["file"], esito["validi"], esito["errori"]) == (3, 3, {})
+
+
+def test_errori_non_condivisi_tra_thread():
+    valido = _fattura()
+    errato = valido.replace(b"<Divisa>EUR", b"<Divisa>XX")
+
+    def valida(i):
+        return i, xsd_utils.valida_xml(errato if i % 2 else valido)
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        for i, errori in pool.map(valida, range(200)):
+            assert len(errori) == (1 if i % 2 else 0)
+
+
+def test_file_illeggibile_non_perde_il_blocco(tmp_path):
+    cartella = tmp_path / "xml"
+    cartella.mkdir()
+    for i in range(1, 4):
+        (cartella / f"{i}.xml").write_bytes(_fattura(str(i)))
+    (cartella / "collegamento.xml").symlink_to(tmp_path / "inesistente.xml")
+
+    esiti = dict(xsd_utils._valida_blocco(None, sorted(str(p) for p in cartella.iterdir())))
+
+    assert esiti[str(cartella / "1.xml")] == esiti[str(cartella / "3.xml")] == []
+    assert len(esiti[str(cartella / "collegamento.xml")]) == 1
+
+
+def test_membro_zip_corrotto(tmp_path):
+    archivio = tmp_path / "fatture.zip"
+    with zipfile.ZipFile(archivio, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("a.xml", _fattura("1"))
+        zf.writestr("b.xml", _fattura("2"))
+    dati = bytearray(archivio.read_bytes())
+    inizio = dati.index(b"b.xml") + len(b"b.xml")
+    dati[inizio + 10:inizio + 40] = bytes(30)
+    archivio.write_bytes(bytes(dati))
+
+    esito = xsd_utils.valida_in_blocco(str(archivio), processi=1)
+    assert (esito["file"], esito["validi"]) == (2, 1)
+    (errore,) = esito["errori"]["b.xml"]
+    assert errore.startswith("error: Error -3 while decompressing")
@@ -0,0 +1,388 @@
+import argparse
+import io
+import os
+import re
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import date, datetime
+from decimal import Decimal, ROUND_HALF_UP
+from xml.sax.saxutils import XMLGenerator
+
+import db_utils
+from pdf_utils import EMITTENTE_DEFAULT
+
+# Cartella degli XML FatturaPA generati
+XML_DIR = os.getenv("APPFATT_XML_DIR", "fatture_xml")
+
+NS_FATTURA = "http://ivaservizi.agenziaentrate.gov.it/docs/xsd/fatture/v1.2"
+NS_DS = "http://www.w3.org/2000/09/xmldsig#"
+NS_XSI = "http://www.w3.org/2001/XMLSchema-instance"
+SCHEMA_LOCATION = f"{NS_FATTURA} http://www.fatturapa.gov.it/export/fatturazione/sdi/fatturapa/v1.2/Schema_del_file_xml_FatturaPA_versione_1.2.xsd"
+
+REGIME_FISCALE_DEFAULT = "RF01"
+CODICE_DESTINATARIO_PEC = "0000000"
+
+MODALITA_PAGAMENTO = {
+    "CONTANTI": "MP01",
+    "BONIFICO": "MP05",
+    "CARTA": "MP08",
+    "ALTRO": "MP02",
+}
+
+CENTESIMO = Decimal("0.01")
+
+# Caratteri di controllo non ammessi in XML 1.0
+_RE_NON_XML = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+_RE_IBAN = re.compile(r"^[A-Z]{2}[0-9]{2}[A-Z0-9]{11,30}$")
+
+
+# ==========================
+# FORMATTAZIONE VALORI
+# ==========================
+def _decimale(val) -> Decimal:
+    return val if isinstance(val, Decimal) else Decimal(str(val or 0))
+
+
+def _importo(val: Decimal) -> str:
+    """Importo con 2 decimali (arrotondamento commerciale)."""
+    return str(val.quantize(CENTESIMO, rounding=ROUND_HALF_UP))
+
+
+def _quantita(val: Decimal) -> str:
+    """Da 2 a 8 decimali, come richiesto per Quantita e PrezzoUnitario."""
+    testo = f"{val:.8f}".rstrip("0")
+    intero, decimali = testo.split(".")
+    return f"{intero}.{decimali.ljust(2, '0')}"
+
+
+def _testo(val, lunghezza: int = None) -> str:
+    testo = _RE_NON_XML.sub("", str(val or "")).strip()
+    return testo[:lunghezza] if lunghezza else testo
+
+
+def _data(val) -> str:
+    """Data ISO da date/datetime o da stringa "dd/mm/YYYY" / ISO."""
+    if isinstance(val, date):
+        return val.strftime("%Y-%m-%d")
+    val = str(val)
+    if "/" in val:
+        return datetime.strptime(val, "%d/%m/%Y").strftime("%Y-%m-%d")
+    return val[:10]
+
+
+def _progressivo(numero: str) -> str:
+    """ProgressivoInvio: massimo 10 caratteri alfanumerici."""
+    return re.sub(r"[^A-Za-z0-9]", "", str(numero))[-10:] or "1"
+
+
+def progressivo_documento(doc_id: int) -> str:
+    """
+    ProgressivoInvio univoco dall'id del documento in archivio (base 36, 5
+    caratteri): numeri uguali in anni o tipi diversi non danno lo stesso file.
+    """
+    doc_id, cifre = int(doc_id), ""
+    while doc_id:
+        doc_id, resto = divmod(doc_id, 36)
+        cifre = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"[resto] + cifre
+    return cifre.rjust(5, "0")
+
+
+# ==========================
+# SERIALIZZAZIONE FATTURAPA
+# ==========================
+@contextmanager
+def _blocco(xg: XMLGenerator, nome: str, attributi: dict = None):
+    xg.startElement(nome, attributi or {})
+    yield
+    xg.endElement(nome)
+
+
+def _campo(xg: XMLGenerator, nome: str, valore) -> None:
+    xg.startElement(nome, {})
+    xg.characters(valore)
+    xg.endElement(nome)
+
+
+def _sede(xg: XMLGenerator, anagrafica: dict) -> None:
+    with _blocco(xg, "Sede"):
+        _campo(xg, "Indirizzo", _testo(anagrafica.get("Indirizzo"), 60) or "-")
+        _campo(xg, "CAP", _testo(anagrafica.get("CAP"), 5) or "00000")
+        _campo(xg, "Comune", _testo(anagrafica.get("Comune"), 60) or "-")
+        if anagrafica.get("Provincia"):
+            _campo(xg, "Provincia", _testo(anagrafica["Provincia"], 2).upper())
+        _campo(xg, "Nazione", "IT")
+
+
+def _dati_anagrafici(xg: XMLGenerator, anagrafica: dict, regime_fiscale: str = None) -> None:
+    piva = _testo(anagrafica.get("PIVA"))
+    cf = _testo(anagrafica.get("CF"))
+    with _blocco(xg, "DatiAnagrafici"):
+        if piva:
+            with _blocco(xg, "IdFiscaleIVA"):
+                _campo(xg, "IdPaese", "IT")
+                _campo(xg, "IdCodice", piva)
+        if cf:
+            _campo(xg, "CodiceFiscale", cf)
+        with _blocco(xg, "Anagrafica"):
+            _campo(xg, "Denominazione", _testo(anagrafica.get("Denominazione"), 80))
+        if regime_fiscale:
+            _campo(xg, "RegimeFiscale", regime_fiscale)
+
+
+def _testata(xg: XMLGenerator, progressivo: str, cliente: dict, emittente: dict, formato: str) -> None:
+    codice_dest = _testo(cliente.get("CodiceDestinatario")) or CODICE_DESTINATARIO_PEC
+    with _blocco(xg, "FatturaElettronicaHeader"):
+        with _blocco(xg, "DatiTrasmissione"):
+            with _blocco(xg, "IdTrasmittente"):
+                _campo(xg, "IdPaese", "IT")
+                _campo(xg, "IdCodice", _testo(emittente.get("CF") or emittente.get("PIVA")))
+            _campo(xg, "ProgressivoInvio", _progressivo(progressivo))
+            _campo(xg, "FormatoTrasmissione", formato)
+            _campo(xg, "CodiceDestinatario", codice_dest)
+            if codice_dest == CODICE_DESTINATARIO_PEC and cliente.get("PEC"):
+                _campo(xg, "PECDestinatario", _testo(cliente["PEC"], 256))
+        with _blocco(xg, "CedentePrestatore"):
+            _dati_anagrafici(
+                xg, emittente, emittente.get("RegimeFiscale") or REGIME_FISCALE_DEFAULT
+            )
+            _sede(xg, emittente)
+        with _blocco(xg, "CessionarioCommittente"):
+            _dati_anagrafici(xg, cliente)
+            _sede(xg, cliente)
+
+
+def _dettaglio_linee(xg: XMLGenerator, righe) -> dict:
+    """
+    Scrive le DettaglioLinee una alla volta e accumula gli imponibili
+    per (aliquota, natura), da cui si ricava DatiRiepilogo.
+    """
+    riepilogo = {}
+    for linea, r in enumerate(righe, start=1):
+        qta = _decimale(r.get("qta", 1))
+        prezzo = _decimale(r.get("prezzo", 0))
+        aliquota = _decimale(r.get("iva", 0)).quantize(CENTESIMO)
+        natura = _testo(r.get("natura")) if aliquota == 0 else ""
+        totale = (qta * prezzo).quantize(CENTESIMO, rounding=ROUND_HALF_UP)
+
+        with _blocco(xg, "DettaglioLinee"):
+            _campo(xg, "NumeroLinea", str(linea))
+            _campo(xg, "Descrizione", _testo(r.get("desc"), 1000) or "-")
+            _campo(xg, "Quantita", _quantita(qta))
+            _campo(xg, "PrezzoUnitario", _quantita(prezzo))
+            _campo(xg, "PrezzoTotale", _importo(totale))
+            _campo(xg, "AliquotaIVA", str(aliquota))
+            if natura:
+                _campo(xg, "Natura", natura)
+
+        chiave = (aliquota, natura)
+        voce = riepilogo.setdefault(chiave, {"imponibile": Decimal(0), "riferimento": ""})
+        voce["imponibile"] += totale
+        if natura and not voce["riferimento"]:
+            voce["riferimento"] = _testo(r.get("riferimento_normativo"), 100)
+    return riepilogo
+
+
+def _dati_riepilogo(xg: XMLGenerator, riepilogo: dict) -> Decimal:
+    """Un DatiRiepilogo per aliquota/natura; restituisce il totale documento."""
+    totale = Decimal(0)
+    for (aliquota, natura), voce in sorted(riepilogo.items(), reverse=True):
+        imponibile = voce["imponibile"]
+        imposta = (imponibile * aliquota / 100).quantize(CENTESIMO, rounding=ROUND_HALF_UP)
+        totale += imponibile + imposta
+        with _blocco(xg, "DatiRiepilogo"):
+            _campo(xg, "AliquotaIVA", str(aliquota))
+            if natura:
+                _campo(xg, "Natura", natura)
+            _campo(xg, "ImponibileImporto", _importo(imponibile))
+            _campo(xg, "Imposta", _importo(imposta))
+            if not natura:
+                _campo(xg, "EsigibilitaIVA", "I")
+            if voce["riferimento"]:
+                _campo(xg, "RiferimentoNormativo", voce["riferimento"])
+    return totale
+
+
+def _dati_pagamento(xg: XMLGenerator, pagamento: dict, importo: Decimal) -> None:
+    modalita = pagamento.get("modalita", "MP05")
+    modalita = MODALITA_PAGAMENTO.get(str(modalita).upper(), modalita)
+    with _blocco(xg, "DatiPagamento"):
+        _campo(xg, "CondizioniPagamento", pagamento.get("condizioni", "TP02"))
+        with _blocco(xg, "DettaglioPagamento"):
+            _campo(xg, "ModalitaPagamento", modalita)
+            if pagamento.get("giorni") not in (None, ""):
+                _campo(xg, "GiorniTerminiPagamento", str(int(pagamento["giorni"])))
+            if pagamento.get("scadenza"):
+                _campo(xg, "DataScadenzaPagamento", _data(pagamento["scadenza"]))
+            _campo(xg, "ImportoPagamento", _importo(importo))
+            # IBAN solo se ben formato (il campo del form è testo libero)
+            iban = _testo(pagamento.get("iban")).replace(" ", "").upper()
+            if _RE_IBAN.match(iban):
+                _campo(xg, "IBAN", iban)
+
+
+def scrivi_fattura_xml(
+    out,
+    numero: str,
+    data_f: date,
+    cliente: dict,
+    righe,
+    emittente: dict,
+    tipo_xml_codice: str = "TD01",
+    causale: str = "",
+    importo_totale: float = None,
+    pagamento: dict = None,
+    progressivo: str = None,
+) -> Decimal:
+    """
+    Serializza una FatturaPA 1.2.x direttamente sullo stream binario `out`,
+    un elemento alla volta (righe può essere un generatore).
+    Il formato è FPA12 se il codice destinatario ha 6 caratteri, altrimenti FPR12.
+    `pagamento` (facoltativo): modalita (MPxx o CONTANTI/BONIFICO/...),
+    condizioni, giorni, scadenza, iban.
+    `progressivo` (default: dal numero) è il ProgressivoInvio della testata.
+    Restituisce il totale documento ricalcolato dal riepilogo.
+    """
+    codice_dest = _testo(cliente.get("CodiceDestinatario"))
+    formato = "FPA12" if len(codice_dest) == 6 else "FPR12"
+
+    xg = XMLGenerator(out, encoding="utf-8", short_empty_elements=True)
+    xg.startDocument()
+    xg.startPrefixMapping("p", NS_FATTURA)
+    xg.startPrefixMapping("ds", NS_DS)
+    xg.startPrefixMapping("xsi", NS_XSI)
+    xg.startElementNS((NS_FATTURA, "FatturaElettronica"), None, {
+        (None, "versione"): formato,
+        (NS_XSI, "schemaLocation"): SCHEMA_LOCATION,
+    })
+
+    _testata(xg, progressivo or numero, cliente, emittente, formato)
+
+    with _blocco(xg, "FatturaElettronicaBody"):
+        with _blocco(xg, "DatiGenerali"):
+            with _blocco(xg, "DatiGeneraliDocumento"):
+                _campo(xg, "TipoDocumento", tipo_xml_codice or "TD01")
+                _campo(xg, "Divisa", "EUR")
+                _campo(xg, "Data", _data(data_f))
+                _campo(xg, "Numero", _testo(numero, 20))
+                if importo_totale is not None:
+                    _campo(xg, "ImportoTotaleDocumento", _importo(_decimale(importo_totale)))
+                # Causale: blocchi ripetuti da 200 caratteri
+                causale = _testo(causale)
+                for i in range(0, len(causale), 200):
+                    _campo(xg, "Causale", causale[i:i + 200])
+
+        with _blocco(xg, "DatiBeniServizi"):
+            riepilogo = _dettaglio_linee(xg, righe)
+            totale = _dati_riepilogo(xg, riepilogo)
+
+        if pagamento:
+            _dati_pagamento(xg, pagamento, totale)
+
+    xg.endElementNS((NS_FATTURA, "FatturaElettronica"), None)
+    xg.endDocument()
+    return totale
+
+
+def genera_xml_fattura(*args, **kwargs) -> bytes:
+    """Come scrivi_fattura_xml, ma restituisce i byte (anteprima e download)."""
+    buffer = io.BytesIO()
+    scrivi_fattura_xml(buffer, *args, **kwargs)
+    return buffer.getvalue()
+
+
+def scrivi_xml(xml_path: str, *args, **kwargs) -> Decimal:
+    """Serializza direttamente su file temporaneo e lo rinomina in modo atomico."""
+    cartella = os.path.dirname(os.path.abspath(xml_path))
+    os.makedirs(cartella, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cartella, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            totale = scrivi_fattura_xml(f, *args, **kwargs)
+        os.replace(tmp_path, xml_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return totale
+
+
+def nome_file_xml(emittente: dict, progressivo: str) -> str:
+    """Nome file SdI: IT + identificativo del trasmittente + _ + progressivo."""
+    return f"IT{_testo(emittente.get('CF') or emittente.get('PIVA'))}_{_progressivo(progressivo)}.xml"
+
+
+# ==========================
+# ESPORTAZIONE IN BLOCCO
+# ==========================
+def esporta_xml_periodo(
+    anno: int,
+    mese: int = None,
+    emittente: dict = None,
+    cartella: str = XML_DIR,
+) -> dict:
+    """
+    Scrive l'XML FatturaPA di tutti i documenti del periodo in `cartella`.
+    Righe e rubrica vengono lette una volta sola; ogni file è scritto in streaming.
+    Nome file e ProgressivoInvio derivano dall'id del documento (progressivo_documento).
+    Restituisce documenti, secondi, xml_al_secondo ed errori (id -> messaggio).
+    """
+    inizio = time.perf_counter()
+    emittente = emittente or EMITTENTE_DEFAULT
+    df = db_utils.carica_documenti()
+    mask = df["Anno"] == anno
+    if mese is not None:
+        mask &= df["Mese"] == mese
+    df = df[mask]
+
+    righe = db_utils.carica_righe_documenti(df.index)
+    clienti = {
+        c["Denominazione"]: c
+        for c in db_utils.carica_controparti().fillna("").to_dict("records")
+    }
+    errori = {}
+    for doc_id, numero, data_doc, controparte, importo, tipo_xml in zip(
+        df.index, df["Numero"], df["Data"], df["Controparte"], df["Importo"], df["TipoXML"],
+    ):
+        progressivo = progressivo_documento(doc_id)
+        try:
+            scrivi_xml(
+                os.path.join(cartella, nome_file_xml(emittente, progressivo)),
+                numero,
+                data_doc.date(),
+                clienti.get(controparte, {"Denominazione": controparte}),
+                righe[int(doc_id)],
+                emittente,
+                tipo_xml_codice=tipo_xml or "TD01",
+                importo_totale=db_utils.euro(importo),
+                progressivo=progressivo,
+            )
+        except Exception as e:
+            errori[int(doc_id)] = f"{type(e).__name__}: {e}"
+
+    secondi = time.perf_counter() - inizio
+    return {
+        "documenti": len(df),
+        "secondi": secondi,
+        "xml_al_secondo": len(df) / secondi if secondi > 0 else 0.0,
+        "errori": errori,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Esporta gli XML FatturaPA di un periodo.")
+    parser.add_argument("anno", type=int)
+    parser.add_argument("--mese", type=int, choices=range(1, 13))
+    parser.add_argument("--cartella", default=XML_DIR, help="cartella di destinazione")
+    args = parser.parse_args()
+
+    esito = esporta_xml_periodo(args.anno, args.mese, cartella=args.cartella)
+    print(
+        f"{esito['documenti']} XML in {esito['secondi']:.1f}s "
+        f"({esito['xml_al_secondo']:.1f} XML/s)"
+    )
+    for doc_id, errore in esito["errori"].items():
+        print(f"  documento {doc_id}: {errore}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+import argparse
+import multiprocessing
+import os
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+from lxml import etree
+
+# Schemi FatturaPA distribuiti con l'applicazione (nessun accesso alla rete)
+XSD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "xsd")
+XSD_FATTURAPA = os.path.join(XSD_DIR, "Schema_del_file_xml_FatturaPA_versione_1.2.2.xsd")
+
+# schemaLocation remote importate dallo schema FatturaPA -> copia locale
+SCHEMI_LOCALI = {
+    "http://www.w3.org/TR/2002/REC-xmldsig-core-20020212/xmldsig-core-schema.xsd":
+        os.path.join(XSD_DIR, "xmldsig-core-schema.xsd"),
+}
+
+# File per blocco inviato a ciascun processo nella validazione in blocco
+BLOCCO_VALIDAZIONE = 100
+
+# Lo schema compilato è condiviso dai thread (sessioni Streamlit) ma il suo
+# error_log no: validazione e lettura degli errori avvengono sotto lock
+_lock_schema = threading.Lock()
+
+
+class _ResolverLocale(etree.Resolver):
+    def resolve(self, url, pubid, context):
+        if url in SCHEMI_LOCALI:
+            return self.resolve_filename(SCHEMI_LOCALI[url], context)
+        return None
+
+
+def _parser(**opzioni) -> etree.XMLParser:
+    """Parser senza rete né espansione di entità esterne."""
+    return etree.XMLParser(no_network=True, resolve_entities=False, **opzioni)
+
+
+# ==========================
+# SCHEMA COMPILATO
+# ==========================
+@lru_cache(maxsize=1)
+def schema_fatturapa() -> etree.XMLSchema:
+    """Schema FatturaPA letto e compilato una sola volta per processo."""
+    parser = _parser()
+    parser.resolvers.add(_ResolverLocale())
+    return etree.XMLSchema(etree.parse(XSD_FATTURAPA, parser))
+
+
+def valida_xml(sorgente) -> list:
+    """
+    Valida un XML FatturaPA (bytes, percorso o file aperto) contro lo schema.
+    Restituisce la lista degli errori ("riga N: messaggio"); vuota se valido.
+    """
+    try:
+        if isinstance(sorgente, (bytes, bytearray)):
+            doc = etree.fromstring(bytes(sorgente), _parser())
+        else:
+            doc = etree.parse(sorgente, _parser())
+    except etree.XMLSyntaxError as e:
+        return [f"riga {e.lineno}: XML non ben formato: {e.msg}"]
+
+    schema = schema_fatturapa()
+    with _lock_schema:
+        try:
+            if schema.validate(doc):
+                return []
+        except etree.XMLSchemaValidateError as e:
+            # documento non validabile (es. riferimenti a entità non risolte)
+            return [f"riga 0: {e}"]
+        return [f"riga {err.line}: {err.message}" for err in schema.error_log]
+
+
+# ==========================
+# VALIDAZIONE IN BLOCCO
+# ==========================
+def _valida_blocco(archivio: str, nomi: list) -> list:
+    """
+    Eseguito nei processi del pool: valida un blocco di file di una cartella
+    (archivio = None) o di membri di uno ZIP, letti senza estrarli su disco.
+    Un file illeggibile diventa l'errore di quel file, non del blocco.
+    """
+    esiti = []
+    zf = zipfile.ZipFile(archivio) if archivio is not None else None
+    try:
+        for nome in nomi:
+            try:
+                if zf is None:
+                    errori = valida_xml(nome)
+                else:
+                    with zf.open(nome) as f:
+                        errori = valida_xml(f)
+            except Exception as e:
+                errori = [f"{type(e).__name__}: {e}"]
+            esiti.append((nome, errori))
+    finally:
+        if zf is not None:
+            zf.close()
+    return esiti
+
+
+def _elenco_xml(percorso: str) -> tuple:
+    """(archivio ZIP o None, nomi dei file .xml da validare)."""
+    if zipfile.is_zipfile(percorso):
+        with zipfile.ZipFile(percorso) as zf:
+            nomi = [
+                info.filename for info in zf.infolist()
+                if not info.is_dir() and info.filename.lower().endswith(".xml")
+            ]
+        return percorso, sorted(nomi)
+    nomi = [
+        os.path.join(radice, nome)
+        for radice, _, files in os.walk(percorso)
+        for nome in files
+        if nome.lower().endswith(".xml")
+    ]
+    return None, sorted(nomi)
+
+
+def valida_in_blocco(percorso: str, processi: int = None, avanzamento=None) -> dict:
+    """
+    Valida tutti gli XML di una cartella (anche sottocartelle) o di un archivio
+    ZIP, su un pool di processi (default: uno per core). Ogni processo compila
+    lo schema una volta e lo riusa per tutti i suoi blocchi.
+    `avanzamento(fatti, totale)` viene chiamata a ogni blocco completato.
+    Restituisce file, validi, secondi ed errori (nome file -> lista errori).
+    """
+    inizio = time.perf_counter()
+    archivio, nomi = _elenco_xml(percorso)
+    blocchi = [
+        nomi[i:i + BLOCCO_VALIDAZIONE]
+        for i in range(0, len(nomi), BLOCCO_VALIDAZIONE)
+    ]
+    processi = max(1, min(processi or os.cpu_count() or 1, len(blocchi)))
+
+    esiti = []
+    if processi == 1:
+        for blocco in blocchi:
+            esiti += _valida_blocco(archivio, blocco)
+            if avanzamento:
+                avanzamento(len(esiti), len(nomi))
+    else:
+        contesto = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=processi, mp_context=contesto) as pool:
+            for esito in pool.map(_valida_blocco, [archivio] * len(blocchi), blocchi):
+                esiti += esito
+                if avanzamento:
+                    avanzamento(len(esiti), len(nomi))
+
+    errori = {nome: errs for nome, errs in esiti if errs}
+    return {
+        "file": len(nomi),
+        "validi": len(nomi) - len(errori),
+        "processi": processi,
+        "secondi": time.perf_counter() - inizio,
+        "errori": errori,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Valida gli XML FatturaPA di una cartella o di uno ZIP.")
+    parser.add_argument("percorso")
+    parser.add_argument("--processi", type=int, help="default: numero di core")
+    args = parser.parse_args()
+
+    esito = valida_in_blocco(args.percorso, processi=args.processi)
+    print(
+        f"{esito['validi']}/{esito['file']} XML validi in {esito['secondi']:.1f}s "
+        f"({esito['processi']} processi)"
+    )
+    for nome, errs in esito["errori"].items():
+        print(nome)
+        for err in errs:
+            print(f"  {err}")
+
+
+if __name__ == "__main__":
+    main()